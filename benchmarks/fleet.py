@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Offline benchmark of the machine lifecycle against the fake pveproxy.
+
+Drives `VirtualMachineState.create`, a no-op redeploy, `_check` and
+`destroy` over a fleet of machines cloned from a template, as nixops does
+(one thread per machine), and reports the wall time and the API calls of
+each stage:
+
+    python -m benchmarks.fleet --machines 1,10,100 --nodes 3 --latency 0.005
+
+SSH is short-circuited: the machines are reachable as soon as their guest
+agent answers, and commands run over SSH succeed without output.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import Any, Dict, List
+from unittest import mock
+
+import nixops.known_hosts
+import nixops.logger
+import nixops.statefile
+from nixops.backends import CheckResult
+
+import nixops_proxmox.backends.proxmox
+from nixops_proxmox.backends.proxmox import VirtualMachineState
+from nixops_proxmox.instrumentation import api_metrics
+from nixops_proxmox.testing import FakeProxmox
+
+TEMPLATE_VMID = 9000
+LOADAVG = "0.00 0.01 0.05 1/100 1\n"
+
+
+class FleetMachine(VirtualMachineState):
+    """A Proxmox machine whose SSH side is instantaneous."""
+
+    def wait_for_ssh(self, check=False):
+        pass
+
+    def run_command(self, command, **kwargs):
+        if kwargs.get("capture_stdout"):
+            return LOADAVG if "loadavg" in command else ""
+        return 0
+
+    def write_ssh_private_key(self, private_key):
+        pass
+
+
+def machine_definition(name: str, server_url: str, args) -> SimpleNamespace:
+    """What `VirtualMachineDefinition` holds for a template clone."""
+    return SimpleNamespace(
+        name=name, profile=None, serverUrl=server_url, username="root@pam",
+        password="fake", tokenName=None, tokenValue=None, useSSH=False,
+        cacheTickets=False, usePrivateIPAddress=True,
+        node=None, pool=None, vmid=None,
+        placement=SimpleNamespace(enable=args.nodes > 1, nodes=None, antiAffinityGroup=None),
+        nbCpus=1, nbCores=1, memory=args.memory, startOnBoot=False, protectVM=False,
+        hotplugFeatures=None, cpuLimit=None, cpuUnits=None, cpuType=None, arch=None,
+        expertArgs="", installISO=None, installMode="nixos-install", shareDeployerStore=False,
+        partitions="", postPartitioningLocalCommands=[], tags={}, owners=[],
+        network=[SimpleNamespace(model="virtio", bridge="vmbr0", tag=None, trunks=[], ip=None)],
+        uefi=SimpleNamespace(enable=False, volume="local-lvm"),
+        template=SimpleNamespace(vmid=TEMPLATE_VMID, node="pve1", fullClone=None),
+        diskImage=SimpleNamespace(source=None, storage=None, format=None),
+        disks=[SimpleNamespace(size=args.disk_size, volume="local-lvm", candidates=None,
+                               storageType=None, benchmark=False, enableSSDEmulation=True,
+                               enableDiscard=True, aio=None)],
+        store_keys_on_machine=False, ssh_port=22, ssh_user="root",
+        has_fast_connection=True, provision_ssh_key=True, private_key=None, keys={},
+        host_key_type=lambda: "ed25519",
+    )
+
+
+def run_stage(pve: FakeProxmox, name: str, machines: List[FleetMachine], action) -> Dict[str, Any]:
+    calls_before = sum(pve.cluster.calls.values())
+    started = time.monotonic()
+    errors = []
+    with ThreadPoolExecutor(max_workers=len(machines)) as pool:
+        for future in [pool.submit(action, machine) for machine in machines]:
+            try:
+                future.result()
+            except Exception as e:
+                errors.append(e)
+    wall = time.monotonic() - started
+    calls = sum(pve.cluster.calls.values()) - calls_before
+    if errors:
+        print(f"  {name}: {len(errors)} machine(s) failed, first error: {errors[0]}", file=sys.stderr)
+    return {"stage": name, "wall_seconds": round(wall, 3), "api_calls": calls,
+            "calls_per_machine": round(calls / len(machines), 1), "errors": len(errors)}
+
+
+def run_fleet(count: int, args) -> Dict[str, Any]:
+    api_metrics.reset()
+    with tempfile.TemporaryDirectory(prefix="nixops-proxmox-bench-") as tmpdir, \
+            FakeProxmox(args.nodes, latency=args.latency, task_duration=args.task_duration,
+                        boot_time=args.boot_time, node_memory_gib=args.node_memory,
+                        storage_gib=args.storage_size) as pve:
+        pve.cluster.add_template(TEMPLATE_VMID, "pve1")
+
+        statefile = nixops.statefile.StateFile(os.path.join(tmpdir, "deployments.nixops"), writable=True)
+        depl = statefile.create_deployment()
+        depl.logger = nixops.logger.Logger(sys.stderr if args.verbose else open(os.devnull, "w"))
+        depl.logger.set_autoresponse("y")
+
+        machines = []
+        with depl._db:
+            for index in range(count):
+                name = f"machine-{index:03d}"
+                cursor = depl._db.cursor()
+                cursor.execute("insert into Resources(deployment, name, type) values (?, ?, ?)",
+                               (depl.uuid, name, "proxmox"))
+                machine = FleetMachine(depl, name, cursor.lastrowid)
+                depl.resources[name] = machine
+                machines.append(machine)
+        definitions = {m.name: machine_definition(m.name, pve.host, args) for m in machines}
+
+        def check(machine):
+            machine._check(CheckResult())
+
+        stages = [
+            ("create", lambda m: m.create(definitions[m.name], check=False,
+                                          allow_reboot=False, allow_recreate=False)),
+            ("redeploy", lambda m: m.create(definitions[m.name], check=False,
+                                            allow_reboot=False, allow_recreate=False)),
+            ("check", check),
+            ("destroy", lambda m: m.destroy()),
+        ]
+        results = [run_stage(pve, name, machines, action) for name, action in stages]
+        statefile.close()
+
+        return {"machines": count, "nodes": args.nodes, "stages": results,
+                "endpoints": {f"{method} {path}": calls
+                              for (method, path), calls in pve.cluster.calls.most_common()},
+                "client": api_metrics.snapshot()}
+
+
+def report(result: Dict[str, Any], top: int) -> str:
+    lines = [f"{result['machines']} machine(s) on {result['nodes']} node(s)",
+             f"  {'stage':<10} {'wall':>9} {'calls':>7} {'calls/machine':>14} {'errors':>7}"]
+    for stage in result["stages"]:
+        lines.append(f"  {stage['stage']:<10} {stage['wall_seconds']:>8.2f}s {stage['api_calls']:>7} "
+                     f"{stage['calls_per_machine']:>14} {stage['errors']:>7}")
+    lines.append("  busiest endpoints:")
+    for endpoint, calls in list(result["endpoints"].items())[:top]:
+        lines.append(f"  {calls:>7}  {endpoint}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--machines", default="1,10,50",
+                        help="comma-separated fleet sizes (default: 1,10,50)")
+    parser.add_argument("--nodes", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.002,
+                        help="seconds added to every API request")
+    parser.add_argument("--task-duration", type=float, default=0.1,
+                        help="seconds every Proxmox task runs for")
+    parser.add_argument("--boot-time", type=float, default=0.5,
+                        help="seconds before the guest agent of a started VM answers")
+    parser.add_argument("--memory", type=int, default=1024, help="MiB per machine")
+    parser.add_argument("--disk-size", default="16G")
+    parser.add_argument("--node-memory", type=int, default=1024, help="GiB per node")
+    parser.add_argument("--storage-size", type=int, default=16384, help="GiB per storage")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--top", type=int, default=8, help="endpoints to show per fleet")
+    parser.add_argument("--verbose", action="store_true", help="show the nixops logs")
+    args = parser.parse_args(argv)
+
+    # The fake pveproxy has a throwaway certificate.
+    warnings.filterwarnings("ignore", message="Unverified HTTPS request")
+
+    results = []
+    with mock.patch.object(nixops_proxmox.backends.proxmox, "try_ssh", return_value=True), \
+            mock.patch.object(nixops.known_hosts, "add"), \
+            mock.patch.object(nixops.known_hosts, "remove"):
+        for count in (int(n) for n in args.machines.split(",")):
+            result = run_fleet(count, args)
+            print(report(result, args.top))
+            results.append(result)
+
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
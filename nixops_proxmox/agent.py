@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+import base64
+import hashlib
+import io
+import secrets
+import shlex
+import time
+from typing import Optional, List, Sequence, Callable, NamedTuple, Union, BinaryIO, Iterator
+
+from nixops_proxmox.tasks import Backoff
+
+
+class ExecResult(NamedTuple):
+    exitcode: int
+    out: str
+    err: str
+
+
+class StepResult(NamedTuple):
+    command: str
+    exitcode: Optional[int]  # None if the step did not run.
+    out: str
+
+
+class AgentTimeout(Exception):
+    pass
+
+
+class TransferFailed(Exception):
+    pass
+
+
+# pveproxy limits `input-data` to 64KiB, a 32KiB chunk is ~43KiB of base64
+# once embedded in the script appending it.
+TRANSFER_CHUNK_SIZE = 32 * 1024
+
+
+class AgentExecutor:
+    """
+    Run commands inside a VM through the QEMU guest agent.
+
+    `vm` is a callable returning the `nodes/{node}/qemu/{vmid}` resource, so
+    that the executor always goes through the current pooled session.
+    """
+
+    def __init__(self, vm: Callable, *,
+                 initial_delay: float = 0.05, max_delay: float = 2.0):
+        self.vm = vm
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+
+    def exec(self, command: Union[str, Sequence[str]], stdin_data: str = '', *,
+             timeout: Optional[float] = None) -> ExecResult:
+        params = {"command": command}
+        if stdin_data:
+            params["input-data"] = stdin_data
+        res = self.vm().agent.exec.post(**params)
+        pid = int(res['pid'])
+
+        # Most commands are over in a few dozen milliseconds, a long
+        # `nixos-install` is polled at most every `max_delay` seconds.
+        backoff = Backoff(self.initial_delay, self.max_delay)
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            status = self.vm().agent("exec-status").get(pid=pid)
+            if status.get("exited"):
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                raise AgentTimeout(
+                    f"Command '{command}' (pid {pid}) did not exit within {timeout}s")
+            backoff.sleep(deadline)
+
+        # pveproxy has already decoded the base64 payloads of the guest agent.
+        return ExecResult(int(status.get("exitcode", -1)),
+                          status.get("out-data", ""),
+                          status.get("err-data", ""))
+
+    def run_steps(self, steps: Sequence[str], *, stop_on_error: bool = True,
+                  timeout: Optional[float] = None) -> List[StepResult]:
+        """
+        Run several shell steps in a single exec round-trip.
+
+        Each step is followed by a marker line carrying its exit code, the
+        output is split back per step in one pass over the lines. The marker
+        is preceded by a newline, so that it starts a line of its own even
+        when the output of the step does not end with one.
+        """
+        marker = f"__nixops_step_{secrets.token_hex(8)}"
+        script = []
+        for index, step in enumerate(steps):
+            script.append(step)
+            script.append(f"__rc=$?; printf '\\n%s %d %d\\n' {marker} {index} \"$__rc\"")
+            if stop_on_error:
+                script.append("[ $__rc -eq 0 ] || exit $__rc")
+
+        result = self.exec("sh", "\n".join(script) + "\n", timeout=timeout)
+
+        exitcodes: List[Optional[int]] = [None] * len(steps)
+        outputs: List[List[str]] = [[] for _ in steps]
+        current = 0
+        for line in result.out.splitlines(keepends=True):
+            if line.startswith(marker):
+                _, step_index, exitcode = line.split()
+                current = int(step_index)
+                exitcodes[current] = int(exitcode)
+                # Drop the newline printed before the marker.
+                if outputs[current]:
+                    outputs[current][-1] = outputs[current][-1][:-1]
+                current += 1
+            elif current < len(steps):
+                outputs[current].append(line)
+
+        return [StepResult(step, exitcodes[index], "".join(outputs[index]))
+                for index, step in enumerate(steps)]
+
+    def _remote_size(self, path: str) -> int:
+        result = self.exec("sh", f"stat -c %s {shlex.quote(path)} 2>/dev/null || echo 0\n")
+        return int(result.out.strip() or 0)
+
+    def _remote_sha256(self, path: str) -> Optional[str]:
+        result = self.exec("sh", f"sha256sum {shlex.quote(path)}\n")
+        if result.exitcode != 0:
+            return None
+        return result.out.split()[0]
+
+    def write_file(self, source: Union[bytes, str, BinaryIO], path: str, *,
+                   mode: Optional[str] = None, resume: bool = True,
+                   chunk_size: int = TRANSFER_CHUNK_SIZE) -> str:
+        """
+        Stream `source` to `path` in the guest, return its SHA-256.
+
+        The content is appended chunk by chunk to `path.partial`, so memory
+        stays bounded by the chunk size. A partial file left by an
+        interrupted transfer is resumed if its content matches ours. The
+        file is only moved in place once its checksum has been verified.
+        """
+        if isinstance(source, str):
+            source = source.encode()
+        if isinstance(source, bytes):
+            source = io.BytesIO(source)
+
+        partial = shlex.quote(path + ".partial")
+        digest = hashlib.sha256()
+
+        offset = self._remote_size(path + ".partial") if resume else 0
+        if offset:
+            # Only resume if the partial file is a prefix of our content.
+            source.seek(0)
+            remaining = offset
+            while remaining:
+                chunk = source.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                digest.update(chunk)
+                remaining -= len(chunk)
+            if remaining or self._remote_sha256(path + ".partial") != digest.hexdigest():
+                offset = 0
+                digest = hashlib.sha256()
+
+        source.seek(offset)
+        if not offset:
+            check_steps(self.run_steps([f"mkdir -p \"$(dirname {partial})\"", f": > {partial}"]))
+
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+            encoded = base64.b64encode(chunk).decode()
+            result = self.exec("sh", f"base64 -d >> {partial} <<'EOF'\n{encoded}\nEOF\n")
+            if result.exitcode != 0:
+                raise TransferFailed(
+                    f"Failed to append to {path}.partial through the QEMU agent: {result.err}")
+
+        expected = digest.hexdigest()
+        steps = [f"[ \"$(sha256sum < {partial} | cut -d' ' -f1)\" = {expected} ]"]
+        if mode is not None:
+            steps.append(f"chmod {shlex.quote(mode)} {partial}")
+        steps.append(f"mv {partial} {shlex.quote(path)}")
+        results = self.run_steps(steps)
+        if results[0].exitcode != 0:
+            raise TransferFailed(f"Checksum mismatch after transferring {path} through the QEMU agent")
+        check_steps(results)
+
+        return expected
+
+    def iter_file(self, path: str, *,
+                  chunk_size: int = TRANSFER_CHUNK_SIZE) -> Iterator[bytes]:
+        """Stream a guest file back, chunk by chunk."""
+        size = self._remote_size(path)
+        quoted = shlex.quote(path)
+        for index in range(-(-size // chunk_size)):
+            result = self.exec("sh",
+                f"dd if={quoted} bs={chunk_size} skip={index} count=1 2>/dev/null | base64 -w0\n")
+            if result.exitcode != 0:
+                raise TransferFailed(f"Failed to read {path} through the QEMU agent: {result.err}")
+            yield base64.b64decode(result.out)
+
+    def read_file(self, path: str, destination: BinaryIO, *,
+                  chunk_size: int = TRANSFER_CHUNK_SIZE) -> str:
+        """Copy a guest file into `destination`, verify and return its SHA-256."""
+        digest = hashlib.sha256()
+        for chunk in self.iter_file(path, chunk_size=chunk_size):
+            digest.update(chunk)
+            destination.write(chunk)
+
+        if self._remote_sha256(path) != digest.hexdigest():
+            raise TransferFailed(f"Checksum mismatch after reading {path} through the QEMU agent")
+        return digest.hexdigest()
+
+
+def check_steps(results: Sequence[StepResult]) -> None:
+    for step in results:
+        if step.exitcode != 0:
+            raise Exception(
+                f"Step '{step.command.splitlines()[0]}' failed through the QEMU agent "
+                f"(exit code: {step.exitcode}): {step.out}")
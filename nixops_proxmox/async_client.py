@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio client of the Proxmox API, over pooled keep-alive HTTP/1.1
+connections, with nothing but the standard library.
+
+The client runs on a process-wide event loop thread. `AsyncSession` stands
+in for the requests session of a `ProxmoxAPI`, so that the synchronous
+code keeps using proxmoxer while every machine thread shares the same few
+connections; `SyncProxmoxClient` runs the client operations from
+synchronous code.
+"""
+import asyncio
+import json
+import ssl
+import threading
+import time
+from http.client import responses
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Tuple
+from urllib.parse import urlencode, urlsplit
+
+from proxmoxer.core import ResourceException
+
+from nixops_proxmox.agent import ExecResult
+from nixops_proxmox.tasks import (Backoff, TaskFailed, TaskTimeout, has_warnings, is_successful,
+                                  parse_upid, warning_lines)
+
+# pveproxy serves every connection from a handful of workers, a few
+# keep-alive connections are plenty for hundreds of in-flight requests.
+DEFAULT_MAX_CONNECTIONS = 16
+DEFAULT_TIMEOUT = 30.0
+
+
+class HttpResponse:
+    """Enough of `requests.Response` for proxmoxer and the instrumentation."""
+
+    __slots__ = ("status_code", "reason", "headers", "content")
+
+    def __init__(self, status_code: int, reason: str, headers: Dict[str, str], content: bytes):
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+
+    def data(self) -> Any:
+        if self.status_code >= 400:
+            body = self.content.decode("utf-8", errors="replace")
+            try:
+                errors = json.loads(body).get("errors")
+            except (ValueError, AttributeError):
+                errors = None
+            # pveproxy puts its error message in the reason phrase.
+            raise ResourceException(self.status_code, self.reason or responses.get(self.status_code, ""),
+                                    body, errors)
+        return json.loads(self.content.decode("utf-8"))["data"]
+
+
+class _Connection:
+    __slots__ = ("reader", "writer", "uses")
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.uses = 0
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+class StaleConnection(Exception):
+    """The server closed a kept-alive connection before answering."""
+
+
+def auth_headers(auth, method: str) -> Dict[str, str]:
+    """The headers a proxmoxer authentication adds to a request, tickets renewed."""
+    if auth is None:
+        return {}
+
+    class Prepared:
+        def __init__(self):
+            self.method = method
+            self.headers: Dict[str, str] = {}
+
+    prepared = auth(Prepared())
+    headers = dict(prepared.headers)
+    cookies = "; ".join(f"{cookie.name}={cookie.value}" for cookie in auth.get_cookies())
+    if cookies:
+        headers["Cookie"] = cookies
+    return headers
+
+
+class AsyncProxmoxClient:
+    def __init__(self, base_url: str, *, auth=None, verify_ssl: bool = False,
+                 max_connections: int = DEFAULT_MAX_CONNECTIONS,
+                 timeout: float = DEFAULT_TIMEOUT):
+        url = urlsplit(base_url)
+        self.base_url = base_url.rstrip("/")
+        self.base_path = url.path.rstrip("/")
+        self.host = url.hostname
+        self.port = url.port or 8006
+        self.auth = auth
+        self.verify_ssl = verify_ssl
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self._ssl = ssl.create_default_context()
+        if not verify_ssl:
+            self._ssl.check_hostname = False
+            self._ssl.verify_mode = ssl.CERT_NONE
+        # Bound to the event loop of the first request.
+        self._idle: List[_Connection] = []
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.opened = 0
+
+    # Connections --------------------------------------------------------
+
+    async def _acquire(self) -> _Connection:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_connections)
+        await self._slots.acquire()
+        while self._idle:
+            conn = self._idle.pop()
+            if not conn.reader.at_eof():
+                return conn
+            conn.close()
+        try:
+            reader, writer = await asyncio.open_connection(self.host, self.port, ssl=self._ssl)
+        except BaseException:
+            self._slots.release()
+            raise
+        self.opened += 1
+        return _Connection(reader, writer)
+
+    def _release(self, conn: _Connection, reusable: bool) -> None:
+        if reusable:
+            self._idle.append(conn)
+        else:
+            conn.close()
+        assert self._slots is not None
+        self._slots.release()
+
+    async def close(self) -> None:
+        while self._idle:
+            self._idle.pop().close()
+
+    # HTTP/1.1 -----------------------------------------------------------
+
+    def _target(self, path_or_url: str, params: Optional[Dict[str, Any]]) -> str:
+        path = urlsplit(path_or_url).path if "://" in path_or_url else self.base_path + path_or_url
+        query = urlencode({key: value for key, value in (params or {}).items() if value is not None},
+                          doseq=True)
+        return path + (f"?{query}" if query else "")
+
+    async def _exchange(self, conn: _Connection, method: str, target: str,
+                        headers: Dict[str, str], body: bytes) -> Tuple[HttpResponse, bool]:
+        lines = [f"{method} {target} HTTP/1.1", f"Host: {self.host}:{self.port}",
+                 "Accept: application/json", "Connection: keep-alive",
+                 f"Content-Length: {len(body)}"]
+        if body:
+            lines.append("Content-Type: application/x-www-form-urlencoded")
+        lines.extend(f"{name}: {value}" for name, value in headers.items())
+        conn.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+        await conn.writer.drain()
+
+        status_line = await conn.reader.readline()
+        if not status_line:
+            raise StaleConnection()
+        version, _, rest = status_line.decode("latin-1").rstrip("\r\n").partition(" ")
+        status, _, reason = rest.partition(" ")
+
+        response_headers: Dict[str, str] = {}
+        while True:
+            line = await conn.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            response_headers[name.strip().lower()] = value.strip()
+
+        keep_alive = (version == "HTTP/1.1"
+                      and response_headers.get("connection", "").lower() != "close")
+        if "chunked" in response_headers.get("transfer-encoding", ""):
+            content = await self._read_chunked(conn.reader)
+        elif "content-length" in response_headers:
+            content = await conn.reader.readexactly(int(response_headers["content-length"]))
+        else:
+            content = await conn.reader.read()
+            keep_alive = False
+        return HttpResponse(int(status), reason, response_headers, content), keep_alive
+
+    @staticmethod
+    async def _read_chunked(reader: asyncio.StreamReader) -> bytes:
+        content = bytearray()
+        while True:
+            size = int((await reader.readline()).split(b";")[0].strip(), 16)
+            if size == 0:
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                return bytes(content)
+            content += await reader.readexactly(size)
+            await reader.readexactly(2)
+
+    async def request(self, method: str, path_or_url: str, *,
+                      params: Optional[Dict[str, Any]] = None,
+                      data: Optional[Dict[str, Any]] = None,
+                      headers: Optional[Dict[str, str]] = None) -> HttpResponse:
+        """One request, `path_or_url` is relative to `/api2/json` or a full URL."""
+        target = self._target(path_or_url, params)
+        body = urlencode({key: value for key, value in (data or {}).items() if value is not None},
+                         doseq=True).encode()
+        if headers is None:
+            headers = auth_headers(self.auth, method)
+
+        # A kept-alive connection may have been closed by pveproxy in the
+        # meantime: retried once on a fresh one, nothing was processed.
+        for attempt in range(2):
+            conn = await self._acquire()
+            reused = conn.uses > 0
+            conn.uses += 1
+            try:
+                resp, keep_alive = await asyncio.wait_for(
+                    self._exchange(conn, method, target, headers, body), self.timeout)
+            except (StaleConnection, ConnectionResetError, BrokenPipeError,
+                    asyncio.IncompleteReadError) as e:
+                self._release(conn, False)
+                if reused and attempt == 0:
+                    continue
+                raise ConnectionError(f"Proxmox API connection failed during {method} {target}: {e!r}")
+            except BaseException:
+                self._release(conn, False)
+                raise
+            self._release(conn, keep_alive)
+            return resp
+        raise AssertionError("unreachable")
+
+    async def call(self, method: str, path: str, **kwargs) -> Any:
+        """The `data` of a request, `ResourceException` on errors as with proxmoxer."""
+        return (await self.request(method, path, **kwargs)).data()
+
+    async def get(self, path: str, **params) -> Any:
+        return await self.call("GET", path, params=params)
+
+    async def post(self, path: str, **data) -> Any:
+        return await self.call("POST", path, data=data)
+
+    async def put(self, path: str, **data) -> Any:
+        return await self.call("PUT", path, data=data)
+
+    async def delete(self, path: str, **params) -> Any:
+        return await self.call("DELETE", path, params=params)
+
+    # Operations of the backend ------------------------------------------
+
+    async def cluster_resources(self, type: Optional[str] = None) -> List[Dict[str, Any]]:
+        return await self.get("/cluster/resources", type=type)
+
+    async def vm_status(self, node: str, vmid: int) -> Dict[str, Any]:
+        return await self.get(f"/nodes/{node}/qemu/{vmid}/status/current")
+
+    async def vm_config(self, node: str, vmid: int) -> Dict[str, Any]:
+        return await self.get(f"/nodes/{node}/qemu/{vmid}/config")
+
+    async def storage_content(self, node: str, storage: str,
+                              content: Optional[str] = None) -> List[Dict[str, Any]]:
+        return await self.get(f"/nodes/{node}/storage/{storage}/content", content=content)
+
+    async def task_status(self, upid: str) -> Dict[str, Any]:
+        return await self.get(f"/nodes/{parse_upid(upid).node}/tasks/{upid}/status")
+
+    async def task_log(self, upid: str, limit: int = 1000) -> List[str]:
+        try:
+            log = await self.get(f"/nodes/{parse_upid(upid).node}/tasks/{upid}/log", limit=limit)
+        except Exception:
+            return []
+        return [entry.get("t", "") for entry in log]
+
+    async def wait_for_task(self, upid: str, *, timeout: Optional[float] = None,
+                            warn: Optional[Callable[[str], None]] = None) -> Dict[str, Any]:
+        """
+        Wait for a task to stop, `TaskFailed` unless it succeeded, see
+        `tasks.wait_for_tasks`.
+        """
+        backoff = Backoff()
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            status = await self.task_status(upid)
+            if status.get("status") == "stopped":
+                break
+            if timeout is not None and deadline is not None and time.monotonic() >= deadline:
+                raise TaskTimeout([upid], timeout)
+            await asyncio.sleep(backoff.next_delay())
+
+        if not is_successful(status):
+            log = await self.task_log(upid)
+            raise TaskFailed(upid, status.get("exitstatus", ""), log[-20:])
+        if has_warnings(status):
+            status["log"] = warning_lines(await self.task_log(upid))
+            if warn:
+                warn(f"Proxmox task {upid} ended with {status['exitstatus']}:\n"
+                     + "\n".join(status["log"]))
+        return status
+
+    async def agent_exec(self, node: str, vmid: int, command: Any, input_data: str = "", *,
+                         timeout: Optional[float] = None) -> ExecResult:
+        vm = f"/nodes/{node}/qemu/{vmid}"
+        params: Dict[str, Any] = {"command": command}
+        if input_data:
+            params["input-data"] = input_data
+        pid = int((await self.call("POST", f"{vm}/agent/exec", data=params))["pid"])
+
+        backoff = Backoff(0.05, 2.0)
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            status = await self.get(f"{vm}/agent/exec-status", pid=pid)
+            if status.get("exited"):
+                return ExecResult(int(status.get("exitcode", -1)),
+                                  status.get("out-data", ""), status.get("err-data", ""))
+            if deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError(f"Command '{command}' (pid {pid}) did not exit within {timeout}s")
+            await asyncio.sleep(backoff.next_delay())
+
+    async def wait_for_agent(self, node: str, vmid: int, *, timeout: Optional[float] = None) -> None:
+        backoff = Backoff(0.5, 2.0)
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            try:
+                await self.call("POST", f"/nodes/{node}/qemu/{vmid}/agent/ping")
+                return
+            except ResourceException as e:
+                if "not running" not in str(e):
+                    raise
+            if deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError(f"The QEMU agent of VM {vmid} did not answer within {timeout}s")
+            await asyncio.sleep(backoff.next_delay())
+
+
+class EventLoopThread:
+    """An event loop running forever in a daemon thread, started on first use."""
+
+    def __init__(self, name: str = "proxmox-api-loop"):
+        self.name = name
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name=self.name, daemon=True).start()
+                self._loop = loop
+            return self._loop
+
+    def run(self, coro: Coroutine[Any, Any, Any], timeout: Optional[float] = None) -> Any:
+        """Run `coro` on the loop, from any other thread, and wait for its result."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+
+event_loop_thread = EventLoopThread()
+
+
+class SyncProxmoxClient:
+    """
+    Synchronous facade of an `AsyncProxmoxClient`: every coroutine method is
+    available as a blocking one.
+    """
+
+    def __init__(self, client: AsyncProxmoxClient, loop_thread: EventLoopThread = event_loop_thread):
+        self.aio = client
+        self.loop_thread = loop_thread
+
+    def __getattr__(self, name: str) -> Callable:
+        method = getattr(self.aio, name)
+        if not asyncio.iscoroutinefunction(method):
+            return method
+        return lambda *args, **kwargs: self.loop_thread.run(method(*args, **kwargs))
+
+
+class AsyncSession:
+    """
+    Stands in for the requests session of a `ProxmoxAPI`: proxmoxer builds
+    the requests, the shared event loop sends them over the pooled
+    connections of the client.
+    """
+
+    def __init__(self, client: AsyncProxmoxClient, auth,
+                 loop_thread: EventLoopThread = event_loop_thread):
+        self.client = client
+        self.auth = auth
+        self.loop_thread = loop_thread
+
+    def request(self, method: str, url: str, params=None, data=None, **kwargs) -> HttpResponse:
+        # Tickets are renewed (synchronously) by proxmoxer in the calling thread.
+        headers = auth_headers(self.auth, method)
+        return self.loop_thread.run(
+            self.client.request(method, url, params=params, data=data, headers=headers))
+
+
+_clients_lock = threading.Lock()
+_clients: Dict[Any, AsyncProxmoxClient] = {}
+
+
+def client_for(key, base_url: str, *, auth=None, verify_ssl: bool = False) -> AsyncProxmoxClient:
+    """The client of a connection key, its authentication refreshed."""
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = AsyncProxmoxClient(base_url, auth=auth, verify_ssl=verify_ssl)
+        elif auth is not None:
+            client.auth = auth
+        return client
+
+
+def use_async_session(api, key, *, verify_ssl: bool = False):
+    """Route the requests of an HTTPS `ProxmoxAPI` through the asyncio client of `key`."""
+    auth = api._backend.auth
+    client = client_for(key, api._backend.get_base_url(), auth=auth, verify_ssl=verify_ssl)
+    api._store["session"] = AsyncSession(client, auth)
+    return api
@@ -17,7 +17,10 @@ class NetworkOptions(ResourceOptions):
             IPOptions]
 
 class DiskOptions(ResourceOptions):
-    volume: str
+    volume: Optional[str]
+    candidates: Sequence[str]
+    storageType: Optional[str]
+    benchmark: bool
     size: str
     aio: Optional[str]
     enableSSDEmulation: bool
@@ -27,6 +30,21 @@ class UefiOptions(ResourceOptions):
     enable: bool
     volume: str
 
+class TemplateOptions(ResourceOptions):
+    vmid: Optional[int]
+    node: Optional[str]
+    fullClone: Optional[bool]
+
+class DiskImageOptions(ResourceOptions):
+    source: Optional[str]
+    format: str
+    storage: str
+
+class PlacementOptions(ResourceOptions):
+    enable: bool
+    nodes: Sequence[str]
+    antiAffinityGroup: Optional[str]
+
 class ProxmoxOptions(ResourceOptions):
     profile: Optional[str]
     serverUrl: Optional[str]
@@ -35,7 +53,9 @@ class ProxmoxOptions(ResourceOptions):
     tokenName: Optional[str]
     tokenValue: Optional[str]
     useSSH: bool
+    cacheTickets: bool
     node: Optional[str]
+    placement: PlacementOptions
     pool: Optional[str]
 
     partitions: str # Kickstart format.
@@ -43,6 +63,11 @@ class ProxmoxOptions(ResourceOptions):
     network: Sequence[NetworkOptions]
     disks: Sequence[DiskOptions]
     uefi: UefiOptions
+    template: TemplateOptions
+    diskImage: DiskImageOptions
+    installMode: Union[Literal["nixos-install"], Literal["closure"]]
+    shareDeployerStore: bool
+    installISO: Optional[str]
 
     nbCpus: int
     nbCores: int
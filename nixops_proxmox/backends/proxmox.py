@@ -1,17 +1,34 @@
 # -*- coding: utf-8 -*-
+import os
+import re
+import subprocess
+import tempfile
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from nixops.backends import MachineDefinition, MachineState
 from nixops.nix_expr import Function, Call, RawValue, py2nix
-from typing import Optional
+from typing import Optional, Dict, Iterable, Hashable, List, Tuple
 import nixops.known_hosts
 from ipaddress import ip_address, IPv4Address, IPv6Address
 from itertools import dropwhile, takewhile, chain
 import nixops_proxmox.proxmox_utils
+import nixops_proxmox.cluster
+import nixops_proxmox.vmid
+import nixops_proxmox.images
+import nixops_proxmox.reconcile
+import nixops_proxmox.coordinator
+import nixops_proxmox.placement
+import nixops_proxmox.storage
+import nixops_proxmox.checkpoints
+from nixops_proxmox.substituter import shared_substituter
+from nixops_proxmox import timing
+from nixops_proxmox.tasks import wait_for_task, TaskFailed, TaskTimeout
+from nixops_proxmox.agent import AgentExecutor, check_steps
 from proxmoxer.core import ResourceException
-from nixops.ssh_util import SSHCommandFailed, SSH
+from nixops.ssh_util import SSHCommandFailed, SSHConnectionFailed, SSH
 import nixops.util
 from urllib.parse import quote
-from functools import partial
 from collections import defaultdict
 from .options import ProxmoxMachineOptions, DiskOptions, NetworkOptions, UefiOptions
 
@@ -20,10 +37,10 @@ def to_prox_bool(b):
 
 # TODO: remove the dependency on the machine logger
 # I'd like to code-reuse SSH/SSHMaster but that requires decoupling the logger.
-def try_ssh(user, ip, logger) -> bool:
+def try_ssh(user, ip, logger, port: int = 22) -> bool:
     ssh = SSH(logger)
     ssh.register_host_fun(lambda: ip)
-    ssh.register_flag_fun(lambda: ["-o", "StrictHostKeyChecking=no", "-o", "UserKnownHostsFile=/dev/null"])
+    ssh.register_flag_fun(lambda: ["-o", "StrictHostKeyChecking=no", "-o", "UserKnownHostsFile=/dev/null", "-p", str(port)])
     # TODO: such hacky, wow.
     ssh.register_passwd_fun(lambda: "")
     try:
@@ -32,24 +49,112 @@ def try_ssh(user, ip, logger) -> bool:
     except Exception:
         return False
 
-def can_reach(logger, ip, user: str = "root", timeout: int = 10, callback = None):
+# Endpoints known to answer SSH, shared by all machines of this process so
+# that the same address is not probed again during the same deploy.
+REACHABILITY_TTL = 300
+_reachable_lock = threading.Lock()
+_reachable: Dict[Tuple[str, str, int], float] = {}
+
+def _known_reachable(user, ip, port) -> bool:
+    with _reachable_lock:
+        seen_at = _reachable.get((user, ip, port))
+    return seen_at is not None and time.monotonic() - seen_at < REACHABILITY_TTL
+
+def _mark_reachable(user, ip, port):
+    with _reachable_lock:
+        _reachable[(user, ip, port)] = time.monotonic()
+
+def forget_reachable(ips: Iterable[str]):
+    """Drop what is known of `ips`, for every user and port."""
+    ips = set(ips)
+    with _reachable_lock:
+        for key in [key for key in _reachable if key[1] in ips]:
+            del _reachable[key]
+
+def can_reach(logger, ip, user: str = "root", timeout: int = 10, callback = None, cancelled: Optional[threading.Event] = None, port: int = 22):
     # TODO: in that case, we need to determine the correct link, is there a way?
     if ip_address(ip).is_link_local:
         return False
 
-    return nixops.util.wait_for_success(partial(try_ssh, user, ip, logger), timeout, callback)
+    if _known_reachable(user, ip, port):
+        return True
 
-def first_reachable_or_none(logger, S, user: str = "root", timeout_per_ip: int = 10, callback = None):
-    for ip in S:
-        logger.log("testing {}".format(ip))
-        if can_reach(logger, ip, user, timeout_per_ip, callback):
-            return ip
+    cancelled = cancelled or threading.Event()
+    deadline = time.monotonic() + timeout
+    while not cancelled.is_set():
+        if try_ssh(user, ip, logger, port):
+            _mark_reachable(user, ip, port)
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        if callback:
+            callback()
+        cancelled.wait(1)
+
+    return False
+
+def select_reachable(logger, candidates: Dict[Hashable, Iterable[str]], user: str = "root", timeout_per_ip: int = 10, callback = None, port: int = 22) -> Dict[Hashable, Optional[str]]:
+    """
+    Probe every candidate address at once and return, for each class of
+    addresses, the first one found reachable (or None).
+
+    As soon as a class is decided, the probes of its other addresses are
+    cancelled.
+    """
+    results: Dict[Hashable, Optional[str]] = {cls: None for cls in candidates}
+    probes = [(cls, ip) for cls, ips in candidates.items() for ip in ips]
+    if not probes:
+        return results
+
+    decided = {cls: threading.Event() for cls in candidates}
+    with ThreadPoolExecutor(max_workers=len(probes)) as pool:
+        futures = {}
+        for cls, ip in probes:
+            logger.log("testing {}".format(ip))
+            futures[pool.submit(can_reach, logger, ip, user, timeout_per_ip, callback, decided[cls], port)] = (cls, ip)
+
+        for future in as_completed(futures):
+            cls, ip = futures[future]
+            if future.cancelled() or decided[cls].is_set():
+                continue
+            if future.result():
+                results[cls] = ip
+                decided[cls].set()
+                for other, (other_cls, _) in futures.items():
+                    if other_cls == cls:
+                        other.cancel()
+
+    return results
+
+def first_reachable_or_none(logger, S, user: str = "root", timeout_per_ip: int = 10, callback = None, port: int = 22):
+    return select_reachable(logger, {None: S}, user, timeout_per_ip, callback, port)[None]
+
+# Storage allocations are slow tasks on LVM-thin or Ceph, a few of them can
+# run side by side but not unboundedly on the same storage.
+MAX_ALLOCATIONS_PER_STORAGE = 2
+_storage_slots_lock = threading.Lock()
+_storage_slots: Dict[Hashable, threading.BoundedSemaphore] = {}
+
+def storage_slot(node: str, storage: str) -> threading.BoundedSemaphore:
+    with _storage_slots_lock:
+        key = (node, storage)
+        if key not in _storage_slots:
+            _storage_slots[key] = threading.BoundedSemaphore(MAX_ALLOCATIONS_PER_STORAGE)
+        return _storage_slots[key]
+
+# Storage types on which Proxmox can make linked clones of a template, the
+# file-based ones only for qcow2 images.
+LINKED_CLONE_STORAGE_TYPES = {"lvmthin", "zfspool", "rbd", "dir", "nfs", "cifs", "glusterfs"}
+FILE_STORAGE_TYPES = {"dir", "nfs", "cifs", "glusterfs"}
+DISK_KEY_RE = re.compile(r"^(scsi|virtio|sata|ide|efidisk)\d+$")
+EFI_DISK_SIZE = "4M"
 
 profile_fields_mapping = {
     'server_url': 'serverUrl',
     'token_name': 'tokenName',
     'token_value': 'tokenValue',
-    'use_ssh': 'useSSH'
+    'use_ssh': 'useSSH',
+    'cache_tickets': 'cacheTickets'
 }
 
 class VirtualMachineDefinition(MachineDefinition):
@@ -68,13 +173,15 @@ class VirtualMachineDefinition(MachineDefinition):
 
         for key in ('profile', 'serverUrl', 'username', 'tokenName',
                 'tokenValue', 'password', 'useSSH', 'disks',
-                'node', 'pool', 'nbCpus', 'nbCores', 'memory',
+                'node', 'placement', 'pool', 'nbCpus', 'nbCores', 'memory',
                 'startOnBoot', 'protectVM', 'hotplugFeatures',
                 'cpuLimit', 'cpuUnits', 'cpuType', 'arch',
                 'vmid',
                 'postPartitioningLocalCommands',
                 'partitions', 'expertArgs', 'installISO', 'network',
-                'uefi', 'useSSH', 'usePrivateIPAddress'):
+                'uefi', 'useSSH', 'usePrivateIPAddress',
+                'cacheTickets', 'template', 'diskImage', 'installMode',
+                'shareDeployerStore'):
             setattr(self, key, getattr(self.config.proxmox, key))
 
     def show_type(self):
@@ -103,14 +210,21 @@ class VirtualMachineState(MachineState[VirtualMachineDefinition]):
 
     public_dns_name = nixops.util.attr_property("publicDNSName", None)
 
+    # Fastest reachable management address, measured by TCP ping.
+    fastest_address = nixops.util.attr_property("proxmox.fastestAddress", None)
+
     use_private_ip_address = nixops.util.attr_property(
             "proxmox.usePrivateIPAddress",
             False,
             type=bool
     )
 
+    profile = nixops.util.attr_property("proxmox.profile", None)
     serverUrl = nixops.util.attr_property("proxmox.serverUrl", None)
     node = nixops.util.attr_property("proxmox.node", None)
+    # Why the placement scheduler picked `node`, if it did.
+    placement = nixops.util.attr_property("proxmox.placement", None)
+    anti_affinity_group = nixops.util.attr_property("proxmox.antiAffinityGroup", None)
     username = nixops.util.attr_property("proxmox.username", None)
     password = nixops.util.attr_property("proxmox.password", None)
 
@@ -121,8 +235,24 @@ class VirtualMachineState(MachineState[VirtualMachineDefinition]):
 
     verifySSL = nixops.util.attr_property("proxmox.verifySSL", False)
 
+    cacheTickets = nixops.util.attr_property(
+            "proxmox.cacheTickets",
+            False,
+            type=bool
+    )
+
+    # VM id leased for this machine but not created yet.
+    reserved_vmid = nixops.util.attr_property("proxmox.reservedVmid", None, int)
+
     partitions = nixops.util.attr_property("proxmox.partitions", None)
 
+    # Storage of each disk, and why it was picked.
+    disk_storages = nixops.util.attr_property("proxmox.diskStorages", [], 'json')
+    storage_choices = nixops.util.attr_property("proxmox.storageChoices", [], 'json')
+
+    # Timing spans of the last create(), see nixops_proxmox.timing.
+    timings = nixops.util.attr_property("proxmox.timings", [], 'json')
+
     public_host_key = nixops.util.attr_property("proxmox.publicHostKey", None)
     private_host_key = nixops.util.attr_property("proxmox.privateHostKey", None)
 
@@ -140,6 +270,10 @@ class VirtualMachineState(MachineState[VirtualMachineDefinition]):
             False,
             type=bool)
 
+    # Completed provisioning phases and the hash of their inputs, see
+    # nixops_proxmox.checkpoints.
+    checkpoints = nixops.util.attr_property("proxmox.checkpoints", [], 'json')
+
 
     def __init__(self, depl, name, id):
         super().__init__(depl, name, id)
@@ -155,17 +289,20 @@ class VirtualMachineState(MachineState[VirtualMachineDefinition]):
             self._reset_network_knowledge()
             self.public_host_key = None
             self.private_host_key = None
+            self.checkpoints = []
             self._conn = None
             self._node = None
             self._vm = None
             self._cached_instance = None
 
+    def _known_addresses(self):
+        return [ip for ip in (self.public_ipv4, self.public_ipv6,
+                self.private_ipv4, self.private_ipv6) if ip]
+
     def _reset_network_knowledge(self):
-        for ip in (self.public_ipv4,
-                self.public_ipv6,
-                self.private_ipv4,
-                self.private_ipv6):
-            if ip and self.public_host_key:
+        forget_reachable(self._known_addresses())
+        for ip in self._known_addresses():
+            if self.public_host_key:
                 nixops.known_hosts.remove(
                         ip,
                         self.public_host_key)
@@ -175,6 +312,7 @@ class VirtualMachineState(MachineState[VirtualMachineDefinition]):
             self.public_ipv6 = None
             self.private_ipv4 = None
             self.private_ipv6 = None
+            self.fastest_address = None
 
     def _learn_known_hosts(self, public_key: Optional[str] = None):
         if public_key is None:
@@ -184,17 +322,34 @@ class VirtualMachineState(MachineState[VirtualMachineDefinition]):
             if ip:
                 nixops.known_hosts.add(ip, public_key)
 
-    def get_ssh_name(self):
+    def _management_addresses(self):
         if self.use_private_ip_address:
-            if not self.private_ipv4 and not self.private_ipv6:
-                raise Exception(
-                    f"Proxmox machine '{self.name}' does not have a private (v4 or v6) address (yet)")
-            return self.private_ipv6 or self.private_ipv4
+            return [ip for ip in (self.private_ipv6, self.private_ipv4) if ip]
         else:
-            if not self.public_ipv4 and not self.public_ipv6:
-                raise Exception(
-                        f"Proxmox machine '{self.name}' does not have a public (v4 or v6) address (yet)")
-            return self.public_ipv6 or self.public_ipv4
+            return [ip for ip in (self.public_ipv6, self.public_ipv4) if ip]
+
+    def _preferred_address(self):
+        addresses = self._management_addresses()
+        if self.fastest_address in addresses:
+            return self.fastest_address
+        # Not measured (yet): IPv6 first.
+        return addresses[0] if addresses else None
+
+    def _measure_fastest_address(self) -> Optional[str]:
+        addresses = self._management_addresses()
+        if len(addresses) < 2:
+            return addresses[0] if addresses else None
+
+        ranked = nixops_proxmox.proxmox_utils.select_fastest_ip_address(addresses)
+        return ranked[0] if ranked else None
+
+    def get_ssh_name(self):
+        address = self._preferred_address()
+        if not address:
+            kind = "private" if self.use_private_ip_address else "public"
+            raise Exception(
+                f"Proxmox machine '{self.name}' does not have a {kind} (v4 or v6) address (yet)")
+        return address
 
     def get_ssh_private_key_file(self):
         if self._ssh_private_key_file:
@@ -206,6 +361,18 @@ class VirtualMachineState(MachineState[VirtualMachineDefinition]):
 
         return super_flags + (["-i", file] if file else []) + (["-o", "StrictHostKeyChecking=accept-new"] if self.has_temporary_key() else [])
 
+    def run_command(self, command, **kwargs):
+        try:
+            return super().run_command(command, **kwargs)
+        except SSHConnectionFailed:
+            forget_reachable(self._known_addresses())
+            raise
+        except SSHCommandFailed as failed_command:
+            # ssh exits with 255 when the connection itself failed.
+            if failed_command.exitcode == 255:
+                forget_reachable(self._known_addresses())
+            raise
+
     def get_physical_spec(self):
         return {
         }
@@ -238,16 +405,45 @@ class VirtualMachineState(MachineState[VirtualMachineDefinition]):
         return self.public_ipv6 or self.public_ipv4
 
     def _connect(self):
-        if self._conn:
-            return self._conn
+        # Sessions are pooled process-wide: this is a dictionary lookup once
+        # any machine has authenticated against the same endpoint, and it lets
+        # the pool re-authenticate lazily when the ticket expires.
         self._conn = nixops_proxmox.proxmox_utils.connect(
                 self.serverUrl, self.username,
                 password=self.password,
                 token_name=self.tokenName, token_value=self.tokenValue,
                 use_ssh=self.useSSH,
-                verify_ssl=self.verifySSL)
+                verify_ssl=self.verifySSL,
+                ticket_cache_key=(self.profile or f"{self.username}@{self.serverUrl}") if self.cacheTickets else None)
         return self._conn
 
+    def _connection_key(self):
+        return nixops_proxmox.proxmox_utils.connection_key(
+                self.serverUrl, self.username, self.tokenName, self.useSSH)
+
+    def _cluster_snapshot(self):
+        return nixops_proxmox.cluster.snapshot_for(self._connection_key())
+
+    def _get_status(self, instance_id: Optional[int] = None, *, allow_missing: bool = False):
+        """Status of the VM, as seen by the cluster-wide snapshot."""
+        if not instance_id:
+            instance_id = self.resource_id
+
+        assert instance_id, "Cannot get status of a non-created virtual machine!"
+        status = self._cluster_snapshot().get(self._connect(), instance_id)
+        if status is None and not allow_missing:
+            raise Exception(f"Proxmox VM '{instance_id}' does not exist in the cluster")
+
+        return status
+
+    def _wait_for_task(self, upid, **kwargs):
+        """Wait for a Proxmox task, the VM status changed once it is over."""
+        kwargs.setdefault("warn", self.warn)
+        try:
+            return wait_for_task(self._connect(), upid, **kwargs)
+        finally:
+            self._cluster_snapshot().invalidate()
+
     def _connect_node(self, node: Optional[str] = None):
         self._node = self._connect().nodes(node or self.node)
         return self._node
@@ -282,7 +478,9 @@ class VirtualMachineState(MachineState[VirtualMachineDefinition]):
             instance_id = self.resource_id
 
         assert instance_id, "Cannot get instance of a non-created virtual machine!"
-        ins = self._get_instance(instance_id, update=True)
+        # Whether the agent is enabled is part of the VM configuration, it does
+        # not change over the VM lifetime: no need to refresh the status here.
+        ins = self._get_instance(instance_id)
 
         assert bool(ins['agent']), "Cannot get network interfaces without QEMU Agent!"
         try:
@@ -293,36 +491,32 @@ class VirtualMachineState(MachineState[VirtualMachineDefinition]):
 
         return net_interfaces
 
+    def _agent(self, instance_id: Optional[int] = None):
+        return AgentExecutor(lambda: self._connect_vm(instance_id))
+
     def _execute_command_with_agent(self, command, stdin_data: str='', *, instance_id: Optional[int] = None):
-        res = self._connect_vm(instance_id).agent.exec.post(**{
-            "command": command,
-            "input-data": stdin_data
-        })
-
-        get_status = lambda: self._connect_vm(instance_id).agent("exec-status").get(pid=int(res['pid']))
-        current_status = get_status()
-        while not current_status["exited"]:
-            current_status = get_status()
-
-        return current_status["exitcode"], current_status.get("out-data", "")
-
-    def _file_write_through_agent(self, content, filename, *, instance_id: Optional[int] = None):
-        self._connect_vm(instance_id).agent("file-write").post(
-                content=content,
-                file=filename
-        )
-        # TODO: ensure file exists.
+        res = self._agent(instance_id).exec(command, stdin_data)
+        return res.exitcode, res.out
 
+    def _file_write_through_agent(self, content, filename, *, instance_id: Optional[int] = None, mode: Optional[str] = None):
+        return self._agent(instance_id).write_file(content, filename, mode=mode)
+
+    @timing.timed("provision ssh key")
     def _provision_ssh_key_through_agent(self, instance_id: Optional[int] = None):
         self.log_start("provisionning SSH key through QEMU Agent... ")
-        self._execute_command_with_agent("mkdir -p /root/.ssh")
-        self._file_write_through_agent(f"""# This was generated by NixOps during initial installation phase.
+        check_steps(self._agent(instance_id).run_steps([
+            "mkdir -p /root/.ssh",
+            f"""cat > /root/.ssh/authorized_keys <<'EOF'
+# This was generated by NixOps during initial installation phase.
 # Do not edit.
-{self.public_host_key}""", "/root/.ssh/authorized_keys")
-        self._execute_command_with_agent("chown -R root /root/.ssh")
-        self._execute_command_with_agent("chmod 755 /root/.ssh/authorized_keys")
+{self.public_host_key}
+EOF""",
+            "chown -R root /root/.ssh",
+            "chmod 755 /root/.ssh/authorized_keys"
+        ]))
         self.log_end("provisionned")
 
+    @timing.timed("partition disks")
     def _partition_disks(self, partitions, postPartitionHook: Optional[str] = None, instance_id: Optional[int] = None):
         self.log_start("partitioning disks... ")
         try:
@@ -353,6 +547,7 @@ class VirtualMachineState(MachineState[VirtualMachineDefinition]):
         # self._mount_disks(partitions, instance_id)
         return out
 
+    @timing.timed("mount disks")
     def _mount_disks(self, partitions, instance_id: Optional[int] = None):
         assert self.partitioned, "The system has not been partitioned yet!"
         self.log_start("mounting disks... ")
@@ -373,11 +568,7 @@ class VirtualMachineState(MachineState[VirtualMachineDefinition]):
         self.log_end("disk mounted")
         return out
 
-    def _configure_initial_nix(self, uefi: bool, instance_id: Optional[int] = None):
-        self.log_start("generating the initial configuration... ")
-        # 1. We generate the HW configuration and the standard configuration.
-        out = self.run_command("nixos-generate-config --root /mnt", capture_stdout=True)
-        # 2. We will override the configuration.nix
+    def _initial_configuration(self, uefi: bool):
         nixos_cfg = {
             "imports": [
                 RawValue("./hardware-configuration.nix")
@@ -388,7 +579,7 @@ class VirtualMachineState(MachineState[VirtualMachineDefinition]):
             ("services", "openssh", "enable"): True,
             ("services", "qemuGuest", "enable"): True,
             ("systemd", "services", "qemu-guest-agent", "serviceConfig", "RuntimeDirectory"): "qemu-ga",
-            ("systemd", "services", "qemu-guest-agent", "serviceConfig", "ExecStart"): RawValue("lib.mkForce \"\\${pkgs.qemu.ga}/bin/qemu-ga -t /var/run/qemu-ga\""),
+            ("systemd", "services", "qemu-guest-agent", "serviceConfig", "ExecStart"): RawValue("lib.mkForce \"${pkgs.qemu.ga}/bin/qemu-ga -t /var/run/qemu-ga\""),
             ("services", "getty", "autologinUser"): "root",
             ("networking", "firewall", "allowedTCPPorts"): [ 22 ],
             ("users", "users", "root"): {
@@ -407,17 +598,88 @@ class VirtualMachineState(MachineState[VirtualMachineDefinition]):
             # Use nix2py to read self.fs_info.
             nixos_cfg[("boot", "loader", "grub", "devices")] = [ "/dev/sda" ];
 
-        nixos_initial_postinstall_conf = py2nix(Function("{ config, pkgs, lib, ... }", nixos_cfg))
-        self.run_command(f"cat <<EOF > /mnt/etc/nixos/configuration.nix\n{nixos_initial_postinstall_conf}\nEOF")
+        return py2nix(Function("{ config, pkgs, lib, ... }", nixos_cfg))
+
+    @timing.timed("build system")
+    def _build_initial_system(self, nixos_config: str, hardware_config: str, arch: Optional[str] = None) -> str:
+        """Build the initial system on the deployer, return its store path."""
+        with tempfile.TemporaryDirectory(prefix="nixops-proxmox-") as tmp:
+            for name, content in (("configuration.nix", nixos_config),
+                    ("hardware-configuration.nix", hardware_config)):
+                with open(os.path.join(tmp, name), "w") as f:
+                    f.write(content)
+
+            system = "aarch64-linux" if arch == "aarch64" else "x86_64-linux"
+            return subprocess.check_output(
+                    ["nix-build", "<nixpkgs/nixos>", "-A", "system", "--no-out-link",
+                     "--argstr", "system", system,
+                     "-I", f"nixos-config={os.path.join(tmp, 'configuration.nix')}"]
+                    + self.depl._nix_path_flags(),
+                    text=True).strip().splitlines()[-1]
+
+    @timing.timed("copy closure")
+    def _copy_closure_to_mnt(self, path: str):
+        """Stream the closure of `path` into the store mounted on /mnt."""
+        env = dict(os.environ, NIX_SSHOPTS=" ".join(self.get_ssh_flags()))
+        address = self.get_ssh_name()
+        host = f"[{address}]" if ":" in address else address
+        # The remote store is itself a URL, its `?` and `=` must not leak into ours.
+        remote_store = quote("local?root=/mnt", safe="")
+        subprocess.check_call(
+                ["nix", "--extra-experimental-features", "nix-command", "copy",
+                 "--to", f"ssh://root@{host}?remote-store={remote_store}&compress=true",
+                 path],
+                env=env)
+
+    @timing.timed("nixos-install")
+    def _nixos_install(self, share_deployer_store: bool = False):
+        if not share_deployer_store:
+            return self.run_command("nixos-install --no-root-passwd", capture_stdout=True)
+
+        cache = shared_substituter.acquire()
+        try:
+            url = cache.url_for(self.get_ssh_name())
+            self.log(f"using the deployer store as a substituter ({url})")
+            return self.run_command(
+                    f"nixos-install --no-root-passwd --option extra-substituters '{url}' --option extra-trusted-public-keys '{cache.key.public_key}'",
+                    capture_stdout=True)
+        finally:
+            shared_substituter.release(log=self.log)
+
+    @timing.timed("configure initial nix")
+    def _configure_initial_nix(self, nixos_config: str):
+        self.log_start("generating the initial configuration... ")
+        # 1. We generate the HW configuration and the standard configuration.
+        self.run_command("nixos-generate-config --root /mnt", capture_stdout=True)
+        # 2. We will override the configuration.nix
+        self.run_command(f"cat <<'EOF' > /mnt/etc/nixos/configuration.nix\n{nixos_config}\nEOF")
         self.run_command("echo preinstall > /mnt/.install_status")
         self.log_end("initial configuration generated")
-        self.log_start("installing NixOS... ")
-        out = self.run_command("nixos-install --no-root-passwd", capture_stdout=True)
+
+    @timing.timed("install initial system")
+    def _install_initial_system(self, nixos_config: str, install_mode: str = "nixos-install", arch: Optional[str] = None, share_deployer_store: bool = False):
+        if install_mode == "closure":
+            # Evaluate and build on the deployer, then only ship store paths
+            # over the LAN: the guest neither evaluates nor downloads anything.
+            self.log_start("building the initial system on the deployer... ")
+            hardware_config = self.run_command("cat /mnt/etc/nixos/hardware-configuration.nix", capture_stdout=True)
+            system = self._build_initial_system(nixos_config, hardware_config, arch)
+            self.log_end(system)
+            self.log_start("copying the system closure to /mnt... ")
+            self._copy_closure_to_mnt(system)
+            self.log_end("copied")
+            self.log_start("installing NixOS... ")
+            out = self.run_command(f"nixos-install --system {system} --no-root-passwd --no-channel-copy", capture_stdout=True)
+        else:
+            self.log_start("installing NixOS... ")
+            out = self._nixos_install(share_deployer_store)
         self.log_end("NixOS installed")
         self.run_command("echo installed > /mnt/.install_status")
 
+    @timing.timed("wait for ip")
     def _wait_for_ip(self):
         self.log_start("waiting for at least a reachable IP address... ")
+        user, port = self.ssh_user, self.ssh_port or 22
 
         def _instance_ip_ready(net_ifs):
             potential_ips = []
@@ -430,10 +692,11 @@ class VirtualMachineState(MachineState[VirtualMachineDefinition]):
             if not potential_ips:
                 return False
 
-            return any((can_reach(self.logger, i['ip-address'], self.ssh_user) for i in potential_ips))
+            return first_reachable_or_none(self.logger, {i['ip-address'] for i in potential_ips}, user, port=port) is not None
 
+        net_ifs = {}
         while True:
-            instance = self._get_instance(update=True)
+            instance = self._get_status()
             self.log_continue(f"[{instance['status']}]")
 
             if instance['status'] == 'running':
@@ -449,7 +712,7 @@ class VirtualMachineState(MachineState[VirtualMachineDefinition]):
             if _instance_ip_ready(net_ifs):
                 break
 
-            time.sleep(3)
+            timing.sleep(3)
 
         ip_addresses = list(chain.from_iterable(map(lambda i: ip_address(i['ip-address']), if_['ip-addresses']) for name, if_ in net_ifs.items() if if_['ip-addresses'] and name != "lo"))
         private_ips = {str(ip) for ip in ip_addresses if ip.is_private and not ip.is_link_local}
@@ -457,13 +720,24 @@ class VirtualMachineState(MachineState[VirtualMachineDefinition]):
         ip_v6 = {str(ip) for ip in ip_addresses if isinstance(ip, IPv6Address)}
         ip_v4 = {str(ip) for ip in ip_addresses if isinstance(ip, IPv4Address)}
 
+        reachable = select_reachable(self.logger, {
+            "private_ipv4": private_ips & ip_v4,
+            "public_ipv4": public_ips & ip_v4,
+            "private_ipv6": private_ips & ip_v6,
+            "public_ipv6": public_ips & ip_v6
+        }, user, port=port)
         with self.depl._db:
-            self.private_ipv4 = first_reachable_or_none(self.logger, private_ips & ip_v4)
-            self.public_ipv4 = first_reachable_or_none(self.logger, public_ips & ip_v4)
-            self.private_ipv6 = first_reachable_or_none(self.logger, private_ips & ip_v6)
-            self.public_ipv6 = first_reachable_or_none(self.logger, public_ips & ip_v6)
+            self.private_ipv4 = reachable["private_ipv4"]
+            self.public_ipv4 = reachable["public_ipv4"]
+            self.private_ipv6 = reachable["private_ipv6"]
+            self.public_ipv6 = reachable["public_ipv6"]
             self.ssh_pinged = False
 
+        # The probes take a few round-trips, the state file stays unlocked.
+        fastest_address = self._measure_fastest_address()
+        with self.depl._db:
+            self.fastest_address = fastest_address
+
         self.log_end(
             f"[IPv4: {self.public_ipv4} / {self.private_ipv4}][IPv6: {self.public_ipv6} / {self.private_ipv6}]")
 
@@ -471,14 +745,12 @@ class VirtualMachineState(MachineState[VirtualMachineDefinition]):
             self._learn_known_hosts()
 
     def _ip_for_ssh_key(self):
-        if self.use_private_ip_address:
-            return self.private_ipv6 or self.private_ipv4
-        else:
-            return self.public_ipv6 or self.private_ipv6
+        return self._preferred_address()
 
     def has_temporary_key(self):
         return "NixOps auto-generated key" in self.public_host_key
 
+    @timing.timed("reinstall host key")
     def _reinstall_host_key(self, key_type):
         self.log_start("reinstalling new host keys... ")
         attempts = 0
@@ -496,7 +768,8 @@ class VirtualMachineState(MachineState[VirtualMachineDefinition]):
                 if attempts >= 10:
                     raise e # bubble the error.
                 self.log(f"failed to read SSH host key (attempt {attempts + 1}/10), retrying...")
-                time.sleep(1)
+                timing.retry()
+                timing.sleep(1)
 
         self._learn_known_hosts(new_key)
         self.log_end("installed")
@@ -504,26 +777,92 @@ class VirtualMachineState(MachineState[VirtualMachineDefinition]):
     def create_after(self, resources, defn):
         return {}
 
+    def _proxmox_machines(self):
+        return [m for m in self.depl.resources.values() if isinstance(m, VirtualMachineState)]
+
+    @timing.timed("allocate vmid")
     def _get_free_vmid(self):
-        return self._connect().cluster.nextid.get()
+        if self.reserved_vmid:
+            return self.reserved_vmid
+
+        machines = self._proxmox_machines()
+        reserved = {m.vm_id or m.reserved_vmid for m in machines if m is not self} - {None}
+        pending = sum(1 for m in machines if not m.vm_id)
+        vmid = nixops_proxmox.vmid.allocator_for(self._connection_key()).allocate(
+                self._connect(), {int(v) for v in reserved}, pending)
+        self.reserved_vmid = vmid
+        return vmid
 
     def _allocate_disk_image(self, filename, size, storage, vmid):
+        """Allocate a volume, returns its volume id and whether we created it."""
+        with storage_slot(self.node, storage):
+            try:
+                return self._connect_node().storage(storage).content.post(
+                        filename=filename,
+                        size=size,
+                        vmid=vmid), True
+            except ResourceException as e:
+                if "already exists" in str(e):
+                    return f'{storage}:{filename}', False
+                else:
+                    raise e
+
+    def _free_disk_images(self, volids):
+        for volid in volids:
+            storage = volid.split(':', 1)[0]
+            try:
+                self._connect_node().storage(storage).content(quote(volid, safe='')).delete()
+            except Exception as e:
+                self.warn(f"failed to free volume '{volid}' after a failed creation: {e}")
+
+    def _discard_failed_vm(self, vmid, volids):
+        """
+        Undo a creation whose task failed: if the VM exists, it owns the
+        volumes and is destroyed along with them, otherwise they are freed.
+        """
         try:
-            return self._connect_node().storage(storage).content.post(
-                    filename=filename,
-                    size=size,
-                    vmid=vmid)
-        except ResourceException as e:
-            if "already exists" in str(e):
-                return f'{storage}:{filename}'
-            else:
-                raise e
+            self._connect_vm(vmid).status.current.get()
+        except ResourceException:
+            self._free_disk_images(volids)
+            return
 
-    def create_instance(self, defn, vmid):
-        tags = [f'{name}={value}' for name, value in {"Name": f"{self.depl.description} [{self.name}]"}.items()]
-        # tags.update(defn.tags)
-        # tags.update(self.get_common_tags())
+        try:
+            self._wait_for_task(self._connect_vm(vmid).delete(purge=1))
+        except Exception as e:
+            self.warn(f"failed to destroy VM {vmid} after a failed creation: {e}")
+
+    @timing.timed("allocate disks")
+    def _allocate_disk_images(self, allocations, vmid):
+        """
+        Allocate all the volumes concurrently, bounded per storage.
+
+        Returns the volumes created by this call. If any allocation fails, the
+        ones that succeeded are freed before raising.
+        """
+        if not allocations:
+            return []
+
+        created = []
+        errors = []
+        with ThreadPoolExecutor(max_workers=len(allocations)) as pool:
+            futures = [pool.submit(self._allocate_disk_image, filename, size, storage, vmid)
+                    for filename, size, storage in allocations]
+            for future in as_completed(futures):
+                try:
+                    volid, is_new = future.result()
+                    if is_new:
+                        created.append(volid)
+                except Exception as e:
+                    errors.append(e)
 
+        if errors:
+            self._free_disk_images(created)
+            raise errors[0]
+
+        return created
+
+    @timing.timed("generate keys")
+    def _ensure_ssh_key_pair(self, defn):
         if not self.public_host_key or self.provision_ssh_key:
             self.log_start("generating new SSH key pair... ")
             (private, public) = nixops.util.create_key_pair(
@@ -536,31 +875,18 @@ class VirtualMachineState(MachineState[VirtualMachineDefinition]):
 
             self.log_end("done")
 
+    def _hardware_options(self, defn):
+        """VM options derived from the definition, shared by creation and cloning."""
         options = {
-                'vmid': vmid,
-                'name': defn.name,
-                # 'tags': (','.join(tags)),
                 'agent': "enabled=1,type=virtio",
-                'vga': 'qxl',
                 'args': defn.expertArgs,
-                'bios': ("ovmf" if defn.uefi.enable else "seabios"),
                 'cores': defn.nbCores or 1,
                 'cpu': defn.cpuType or "cputype=kvm64",
                 'cpulimit': defn.cpuLimit or 0,
                 'cpuunits': defn.cpuUnits or 1024,
-                'description': "NixOps-managed VM",
-                'pool': defn.pool,
                 'hotplug': defn.hotplugFeatures or "1",
                 'memory': defn.memory,
                 'onboot': to_prox_bool(defn.startOnBoot),
-                'ostype': "l26", # Linux kernel 2.6 - 5.X
-                'protection': to_prox_bool(defn.protectVM),
-                'cdrom': defn.installISO,
-                'serial0': 'socket',
-                'scsihw': 'virtio-scsi-pci',
-                'start': 1,
-                'unique': 1,
-                'archive': 0,
         }
 
         if defn.arch is not None:
@@ -586,29 +912,225 @@ class VirtualMachineState(MachineState[VirtualMachineDefinition]):
                 if ipConfig:
                     options[f"ipconfig{index}"] = ",".join(ipConfig)
 
+        return options
 
+    @timing.timed("create instance")
+    def create_instance(self, defn, vmid):
+        tags = [f'{name}={value}' for name, value in {"Name": f"{self.depl.description} [{self.name}]"}.items()]
+        # tags.update(defn.tags)
+        # tags.update(self.get_common_tags())
+
+        self._ensure_ssh_key_pair(defn)
+
+        image_volid = None
+        if defn.diskImage.source is not None:
+            image_volid = self._prepare_disk_image(defn)
+        else:
+            assert defn.installISO is not None, "There is no install ISO, set `deployment.proxmox.installISO`, `deployment.proxmox.template.vmid` or `deployment.proxmox.diskImage.source`"
+
+        options = {
+                **self._hardware_options(defn),
+                'vmid': vmid,
+                'name': defn.name,
+                # 'tags': (','.join(tags)),
+                'vga': 'qxl',
+                'bios': ("ovmf" if defn.uefi.enable else "seabios"),
+                'description': "NixOps-managed VM",
+                'pool': defn.pool,
+                'ostype': "l26", # Linux kernel 2.6 - 5.X
+                'protection': to_prox_bool(defn.protectVM),
+                'cdrom': defn.installISO,
+                'serial0': 'socket',
+                'scsihw': 'virtio-scsi-pci',
+                'start': 1,
+                'unique': 1,
+                'archive': 0,
+        }
+
+        allocations = []
         max_indexes = defaultdict(lambda: 0)
+        if image_volid is not None:
+            # The first disk is imported from the uploaded image, grown once
+            # the VM exists, and the VM boots from it instead of the ISO.
+            del options['cdrom']
+            options['start'] = 0
+            options['boot'] = "order=scsi0"
+
         for index, disk in enumerate(defn.disks):
             filename = f"vm-{vmid}-disk-{index}"
-            options[f"scsi{index}"] = (",".join([
-                f"file={disk.volume}:{filename}",
-                f"size={disk.size}",
+            disk_flags = ([
                 f"ssd={1 if disk.enableSSDEmulation else 0}",
                 f"discard={'on' if disk.enableDiscard else 'ignore'}"
             ]
-            + ([f"aio={disk.aio}"] if disk.aio else [])))
-            self._allocate_disk_image(filename, disk.size, disk.volume, vmid)
-            max_indexes[disk.volume] += 1
+            + ([f"aio={disk.aio}"] if disk.aio else []))
+            storage = self._disk_storage(index, disk)
+            if index == 0 and image_volid is not None:
+                options[f"scsi{index}"] = ",".join([f"{storage}:0", f"import-from={image_volid}"] + disk_flags)
+                continue
+
+            options[f"scsi{index}"] = ",".join([
+                f"file={storage}:{filename}",
+                f"size={disk.size}"] + disk_flags)
+            allocations.append((filename, disk.size, storage))
+            max_indexes[storage] += 1
 
         if defn.uefi and defn.uefi.enable:
             filename = f'vm-{vmid}-disk-{max_indexes[defn.uefi.volume] + 1}'
             options['efidisk0'] = f'{defn.uefi.volume}:{filename}'
-            self._allocate_disk_image(filename,
-                    '4M',
-                    defn.uefi.volume,
-                    vmid)
+            allocations.append((filename, EFI_DISK_SIZE, defn.uefi.volume))
+
+        created_volumes = self._allocate_disk_images(allocations, vmid)
+        try:
+            upid = self._connect_node().qemu.post(**options)
+        except Exception:
+            # Do not leave orphan volumes behind, a rerun would hit "already exists".
+            self._free_disk_images(created_volumes)
+            raise
+
+        try:
+            # The creation task also starts the VM (`start=1`).
+            self._wait_for_task(upid)
+        except TaskFailed:
+            self._discard_failed_vm(vmid, created_volumes)
+            raise
+
+        if image_volid is not None:
+            self._grow_disks(self._connect_vm(vmid), defn)
+            self._wait_for_task(self._connect_vm(vmid).status.start.post())
+
+        return vmid, upid
+
+    def _supports_linked_clone(self, node, template_config):
+        storage_types = {st['storage']: st.get('type') for st in self._connect().nodes(node).storage.get()}
+        for key, value in template_config.items():
+            if not DISK_KEY_RE.match(key) or "media=cdrom" in str(value):
+                continue
+            volid = str(value).split(",")[0]
+            storage_type = storage_types.get(volid.split(":")[0])
+            if storage_type not in LINKED_CLONE_STORAGE_TYPES:
+                return False
+            if storage_type in FILE_STORAGE_TYPES and not volid.endswith(".qcow2"):
+                return False
+        return True
+
+    @timing.timed("clone instance")
+    def clone_instance(self, defn, vmid):
+        """Create the VM as a clone of a pre-installed NixOS template."""
+        self._ensure_ssh_key_pair(defn)
+
+        template_node = defn.template.node or self.node
+        template = self._connect().nodes(template_node).qemu(defn.template.vmid)
+        template_config = template.config.get()
+
+        full = defn.template.fullClone
+        if full is None:
+            # Linked clones are only possible from templates, on storages
+            # that can snapshot their base images.
+            full = not (template_config.get('template')
+                    and self._supports_linked_clone(template_node, template_config))
+
+        params = {
+                'newid': vmid,
+                'name': defn.name,
+                'description': "NixOps-managed VM",
+                'full': to_prox_bool(full),
+                'pool': defn.pool,
+        }
+        if template_node != self.node:
+            params['target'] = self.node
+
+        self.log(f"cloning template {defn.template.vmid} ({'full' if full else 'linked'} clone)...")
+        self._wait_for_task(template.clone.post(**params))
+
+        vm = self._connect_vm(vmid)
+        vm.config.put(**self._hardware_options(defn),
+                protection=to_prox_bool(defn.protectVM))
+
+        self._grow_disks(vm, defn)
+        self._wait_for_task(vm.status.start.post())
+        return vmid, None
+
+    @timing.timed("prepare image")
+    def _prepare_disk_image(self, defn):
+        """Build and upload (once per storage) the disk image, return its volume id."""
+        path = nixops_proxmox.images.resolve_image(defn.diskImage.source)
+        return nixops_proxmox.images.ensure_image_uploaded(
+                self._connect(), self.node, defn.diskImage.storage, path,
+                defn.diskImage.format, log=self.log)
+
+    @timing.timed("grow disks")
+    def _grow_disks(self, vm, defn, config=None):
+        """Grow the pre-built disks to the requested sizes, add the missing ones."""
+        if config is None:
+            config = vm.config.get()
+        for index, disk in enumerate(defn.disks):
+            key = f"scsi{index}"
+            wanted = nixops_proxmox.proxmox_utils.parse_size(disk.size)
+            if key not in config:
+                size_gib = max(1, -(-wanted // 1024 ** 3))
+                vm.config.put(**{key: f"{self._disk_storage(index, disk)}:{size_gib}"})
+                continue
+
+            current = re.search(r"size=([^,]+)", config[key])
+            if current and nixops_proxmox.proxmox_utils.parse_size(current.group(1), 'B') >= wanted:
+                continue
+            vm.resize.put(disk=key, size=nixops_proxmox.proxmox_utils.format_size_kib(wanted))
+
+    @timing.timed("reconcile config")
+    def _reconcile_config(self, defn) -> List[str]:
+        """
+        Bring the configuration of the existing VM in line with its
+        definition in a single `config.put`, grow its disks, and return the
+        options left pending until the next boot.
+        """
+        vm = self._connect_vm()
+        # Pending values included, so that we never re-apply them.
+        current = vm.config.get()
+        wanted = {
+                **self._hardware_options(defn),
+                'protection': to_prox_bool(defn.protectVM),
+        }
+        changes = nixops_proxmox.reconcile.diff_config(current, wanted)
+        if changes:
+            self.log(f"updating the VM configuration: {', '.join(map(str, changes))}")
+            vm.config.put(**nixops_proxmox.reconcile.config_update(changes, current))
+
+        # Disks added since the creation need a storage too.
+        self._select_disk_storages(defn, current)
+        self._grow_disks(vm, defn, current)
 
-        return vmid, self._connect_node().qemu.post(**options)
+        with self.depl._db:
+            self.memory = defn.memory
+            self.cpus = defn.nbCpus
+            self.cores = defn.nbCores
+
+        # qemu-server knows best what it could hotplug.
+        return nixops_proxmox.reconcile.pending_keys(vm.pending.get())
+
+    def _is_prebuilt(self, defn):
+        return defn.template.vmid is not None or defn.diskImage.source is not None
+
+    @timing.timed("personalize prebuilt")
+    def _provision_prebuilt_instance(self):
+        """Make a fresh clone of a template or a disk image unique, and let us in."""
+        self.log_start("personalizing the pre-built VM through QEMU Agent... ")
+        check_steps(self._agent().run_steps([
+            # Clones and images share the host keys and machine id of their source.
+            "rm -f /etc/ssh/ssh_host_* && ssh-keygen -A",
+            "rm -f /etc/machine-id && systemd-machine-id-setup",
+            "mkdir -p /root/.ssh",
+            f"""cat > /root/.ssh/authorized_keys <<'EOF'
+# This was generated by NixOps during initial installation phase.
+# Do not edit.
+{self.public_host_key}
+EOF""",
+            "chown -R root /root/.ssh",
+            "chmod 755 /root/.ssh/authorized_keys",
+            "echo cloned > /.install_status",
+            "systemctl restart sshd.service",
+            "systemctl try-restart dhcpcd.service systemd-networkd.service || true"
+        ]))
+        self.log_end("personalized")
 
     def _qemu_agent_is_running(self):
         try:
@@ -624,16 +1146,17 @@ class VirtualMachineState(MachineState[VirtualMachineDefinition]):
         return bool(self._execute_command_with_agent("test -e /.install_status")[0])
 
     def wait_for_running(self):
-        instance = self._get_instance(update=True)
+        instance = self._get_status()
         if instance['status'] == 'running':
             return
 
         self.log_start("waiting for the VM to be running... ")
         while instance['status'] != 'running':
-            time.sleep(1)
-            instance = self._get_instance(update=True)
+            timing.sleep(1)
+            instance = self._get_status()
         self.log_end("running.")
 
+    @timing.timed("wait for qemu agent")
     def wait_for_qemu_agent(self, callback=None):
         self.wait_for_running()
         if self._qemu_agent_is_running():
@@ -645,11 +1168,12 @@ class VirtualMachineState(MachineState[VirtualMachineDefinition]):
         while not self._qemu_agent_is_running():
             if callback:
                 callback()
-            time.sleep(1)
+            timing.sleep(1)
 
         if not callback:
             self.log_end("ready.")
 
+    @timing.timed("postinstall")
     def _postinstall(self, key_type, check):
         # Re-compute current addresses.
         self._wait_for_ip()
@@ -662,13 +1186,38 @@ class VirtualMachineState(MachineState[VirtualMachineDefinition]):
         self.installed = True
         self.state = self.UP
 
+    def _provisioning_plan(self, defn):
+        return nixops_proxmox.checkpoints.provisioning_plan(
+                self.vm_id, partitions=defn.partitions,
+                post_partitioning_commands=defn.postPartitioningLocalCommands,
+                disk_sizes=[disk.size for disk in defn.disks],
+                initial_configuration=self._initial_configuration(defn.uefi.enable),
+                install_mode=defn.installMode, arch=defn.arch,
+                host_key_type=defn.host_key_type(), host_key=self.private_host_key)
+
+    def _rescue_progress(self):
+        """The live CD phases whose effects are still there: /mnt mounted, install markers."""
+        return nixops_proxmox.checkpoints.rescue_progress(self.run_command(
+                nixops_proxmox.checkpoints.RESCUE_PROGRESS_COMMAND, capture_stdout=True))
+
+    def _record_checkpoint(self, phase, phase_digest):
+        journal = nixops_proxmox.checkpoints.CheckpointJournal(self.checkpoints)
+        journal.record(phase, phase_digest)
+        with self.depl._db:
+            self.checkpoints = journal.to_json()
+
     def after_activation(self, defn):
         pass
 
     def read_from_profile(self, defn: VirtualMachineDefinition) -> bool:
         if self.profile is not None:
+            if not nixops_proxmox.proxmox_utils.has_proxmox_profile(self.profile):
+                raise Exception(
+                    f"There is no `{self.profile}` profile in the Proxmox credentials file "
+                    f"({nixops_proxmox.proxmox_utils.get_credentials_file_path()}), "
+                    f"check `deployment.proxmox.profile` of '{self.name}'")
             credentials = nixops_proxmox.proxmox_utils.read_proxmox_profile(self.profile)
-            for attr in ('server_url', 'username', 'password', 'token_name', 'token_value', 'use_ssh'):
+            for attr in ('server_url', 'username', 'password', 'token_name', 'token_value', 'use_ssh', 'cache_tickets'):
                 local_attr_name = profile_fields_mapping.get(attr, attr)
                 if local_attr_name in credentials and getattr(defn, local_attr_name, None) is not None:
                     self.warn(f'`{local_attr_name}` is already set in the `{self.profile}` profile, its Nix expression value will be ignored.')
@@ -679,7 +1228,128 @@ class VirtualMachineState(MachineState[VirtualMachineDefinition]):
         else:
             return False
 
+    @timing.timed("place")
+    def _place(self, defn):
+        """Pick the node of a new VM from the cluster load, and keep the choice."""
+        group = defn.placement.antiAffinityGroup
+        members = {}
+        if group is not None:
+            members = {m.name: m.node for m in self.depl.resources.values()
+                    if isinstance(m, VirtualMachineState) and m is not self
+                    and m.serverUrl == self.serverUrl and m.vm_id and m.node
+                    and m.anti_affinity_group == group}
+
+        # Disks without a fixed volume count against one of their candidates.
+        disks = [nixops_proxmox.placement.DiskRequest(
+                    nixops_proxmox.proxmox_utils.parse_size(disk.size),
+                    (disk.volume,) if disk.volume is not None else tuple(disk.candidates or ()),
+                    None if disk.volume is not None else disk.storageType)
+                 for disk in defn.disks]
+        if defn.uefi and defn.uefi.enable:
+            disks.append(nixops_proxmox.placement.DiskRequest(
+                nixops_proxmox.proxmox_utils.parse_size(EFI_DISK_SIZE), (defn.uefi.volume,)))
+
+        node, reason = nixops_proxmox.placement.placer_for(self._connection_key()).place(
+                self._connect(), self.name,
+                memory_mib=defn.memory, cores=(defn.nbCpus or 1) * (defn.nbCores or 1), disks=disks,
+                eligible=defn.placement.nodes, group=group, group_members=members)
+        self.log(f"placing the VM on node {node} ({reason})")
+        with self.depl._db:
+            self.node = node
+            self.placement = reason
+
+    def _disk_storage(self, index, disk):
+        if disk.volume is not None:
+            return disk.volume
+        return self.disk_storages[index]
+
+    @timing.timed("select storages")
+    def _select_disk_storages(self, defn, config=None):
+        """
+        Pick the storage of the disks without a fixed one, and keep the choices.
+
+        For an existing VM, `config` is its configuration: the disks it has
+        stay where they are, and the storages picked before are kept.
+        """
+        known = self.disk_storages if config is not None else []
+        if config is not None and all(disk.volume is not None or index < len(known)
+                                      for index, disk in enumerate(defn.disks)):
+            return
+
+        previous = {choice.split(":", 1)[0]: choice for choice in self.storage_choices} \
+            if config is not None else {}
+        storages = []
+        choices = []
+        template_config = None
+        selector = nixops_proxmox.storage.selector_for(self._connection_key())
+        for index, disk in enumerate(defn.disks):
+            key = f"scsi{index}"
+            if disk.volume is not None:
+                storages.append(disk.volume)
+                continue
+            if index < len(known):
+                storages.append(known[index])
+                if key in previous:
+                    choices.append(previous[key])
+                continue
+
+            assert disk.candidates or disk.storageType, f"Disk {index} has no storage, set its `volume`, `candidates` or `storageType`"
+            if config is None and defn.template.vmid is not None and template_config is None:
+                template_config = self._connect().nodes(defn.template.node or self.node).qemu(defn.template.vmid).config.get()
+            if config is not None and key in config:
+                # Created before the storages were kept.
+                storage, reason = config[key].split(":")[0], "where the VM has it"
+            elif template_config and key in template_config:
+                # Cloned disks stay where the template has them.
+                storage, reason = template_config[key].split(":")[0], "cloned from the template storage"
+            else:
+                image_storage = defn.diskImage.storage if index == 0 and defn.diskImage.source is not None else None
+                storage, reason = selector.select(
+                        self._connect(), self.node, nixops_proxmox.proxmox_utils.parse_size(disk.size),
+                        candidates=disk.candidates, storage_type=disk.storageType,
+                        benchmark=disk.benchmark, prefer=image_storage, log=self.log)
+            self.log(f"storing {key} on {storage} ({reason})")
+            storages.append(storage)
+            choices.append(f"{key}: {storage} ({reason})")
+
+        with self.depl._db:
+            self.disk_storages = storages
+            self.storage_choices = choices
+
+    def _storages(self, defn):
+        """Storages the creation of this VM writes to."""
+        storages = {self._disk_storage(index, disk) for index, disk in enumerate(defn.disks)}
+        if defn.uefi and defn.uefi.enable:
+            storages.add(defn.uefi.volume)
+        if defn.diskImage.source is not None:
+            storages.add(defn.diskImage.storage)
+        return storages
+
+    def wait_for_ssh(self, check=False):
+        with timing.span("wait for ssh"):
+            return super().wait_for_ssh(check=check)
+
     def create(self, defn: VirtualMachineDefinition, check, allow_reboot, allow_recreate):
+        coordinator = nixops_proxmox.coordinator.coordinator_for(self.depl.uuid)
+        timeline = timing.Timeline(self.name)
+        # Every Proxmox machine of the deployment takes part in the batch.
+        coordinator.enter(self.name, [name for name, machine in (self.depl.definitions or {}).items()
+                                      if isinstance(machine, VirtualMachineDefinition)])
+        try:
+            with timing.recording(timeline), timing.span("create"):
+                self._create(defn, check, allow_reboot, allow_recreate, coordinator)
+        except Exception:
+            if not self.vm_id and self.serverUrl:
+                # Nothing was created, hand the capacity reserved for it back.
+                nixops_proxmox.placement.placer_for(self._connection_key()).release(self.name)
+            raise
+        finally:
+            if timeline.spans:
+                with self.depl._db:
+                    self.timings = timeline.to_json()
+            coordinator.leave(self.name, self.log, timeline, self.depl.uuid)
+
+    def _create(self, defn: VirtualMachineDefinition, check, allow_reboot, allow_recreate, coordinator):
         if self.state != self.UP:
             check = True
 
@@ -695,15 +1365,26 @@ class VirtualMachineState(MachineState[VirtualMachineDefinition]):
         self.tokenValue = defn.tokenValue
 
         self.useSSH = defn.useSSH
+        self.cacheTickets = defn.cacheTickets
 
         has_profile = self.read_from_profile(defn)
         assert self.serverUrl is not None, "There is no Proxmox server URL set{0}, set `deployment.proxmox.serverUrl` or a valid `deployment.proxmox.profile`".format(' (using a profile)' if has_profile else '')
 
         self.use_private_ip_address = defn.usePrivateIPAddress
 
-        nodes = self._connect().nodes.get()
-        assert len(nodes) == 1 or defn.node is not None, "There is no node or multiple nodes, ensure you set 'deployment.proxmox.node' or verify your Proxmox cluster."
-        self.node = defn.node or nodes[0]['node']
+        with self.depl._db:
+            self.anti_affinity_group = defn.placement.antiAffinityGroup
+
+        if defn.node is not None:
+            self.node = defn.node
+        elif defn.placement.enable:
+            # Placed once, existing VMs are never moved.
+            if not (self.vm_id and self.node):
+                self._place(defn)
+        else:
+            nodes = self._connect().nodes.get()
+            assert len(nodes) == 1, "There is no node or multiple nodes, ensure you set 'deployment.proxmox.node', enable 'deployment.proxmox.placement' or verify your Proxmox cluster."
+            self.node = nodes[0]['node']
 
         # check if there is actually the right pool
         pools = self._connect().pools.get()
@@ -711,12 +1392,18 @@ class VirtualMachineState(MachineState[VirtualMachineDefinition]):
 
         # self.private_key_file = defn.private_key or None
 
+        if self.vm_id and self._get_status(allow_missing=True) is not None:
+            pending = self._reconcile_config(defn)
+            if pending and not allow_reboot:
+                self.warn(f"the following options will only apply after a reboot: {', '.join(pending)}; use '--allow-reboot' to reboot now")
+
+        # Stopping the VM also applies the pending options.
         if self.resource_id and allow_reboot:
             self.stop()
             check = True
 
         if self.vm_id and check:
-            instance = self._get_instance(allow_missing=True)
+            instance = self._get_status(allow_missing=True)
 
             if instance is None:
                 if not allow_recreate:
@@ -734,6 +1421,7 @@ class VirtualMachineState(MachineState[VirtualMachineDefinition]):
 
         # Create the QEMU.
         if not self.resource_id:
+            self._select_disk_storages(defn)
             created = False
             has_user_vmid = defn.vmid is not None
             while not created:
@@ -741,7 +1429,12 @@ class VirtualMachineState(MachineState[VirtualMachineDefinition]):
                 self.log(
                         f"creating the Proxmox VM (in node {self.node}, free supposedly VM id: {vmid}, memory {defn.memory} MiB)...")
                 try:
-                    vmid, instance = self.create_instance(defn, vmid)
+                    with coordinator.phase(self.name, "provision", endpoint=self.serverUrl,
+                            node=self.node, storages=self._storages(defn)):
+                        if defn.template.vmid is not None:
+                            vmid, instance = self.clone_instance(defn, vmid)
+                        else:
+                            vmid, instance = self.create_instance(defn, vmid)
                     created = True
                 except Exception as e:
                     if "already exist" in str(e):
@@ -751,24 +1444,40 @@ class VirtualMachineState(MachineState[VirtualMachineDefinition]):
                         else:
                             self.log(
                                 f"vmid collision, trying another one.")
+                            timing.retry()
+                            nixops_proxmox.vmid.allocator_for(self._connection_key()).mark_taken(int(vmid))
+                            self.reserved_vmid = None
                     else:
-                        print('Failure', e)
+                        raise
+
 
+            self._cluster_snapshot().invalidate()
 
             with self.depl._db:
                 self.vm_id = int(vmid)
+                self.reserved_vmid = None
+                self.checkpoints = []
                 self.memory = defn.memory
                 self.cpus = defn.nbCpus
                 self.cores = defn.nbCores
                 self.state = self.RESCUE
 
+            if self._is_prebuilt(defn):
+                # Pre-installed: skip the live CD and go straight to the
+                # post-installation.
+                with coordinator.phase(self.name, "boot"):
+                    self.wait_for_qemu_agent()
+                with coordinator.phase(self.name, "personalize"):
+                    self._provision_prebuilt_instance()
+                self.state = self.UP
+
         if self.state not in (self.UP, self.RESCUE) or check:
             while True:
-                if self._get_instance(allow_missing=True):
+                if self._get_status(allow_missing=True):
                     break
                 self.log(
                     f"Proxmox VM instance '{self.vm_id}' not known yet, waiting...")
-                time.sleep(3)
+                timing.sleep(3)
 
         instance = self._get_instance()
         # common_tags = dict(defn.tags)
@@ -784,44 +1493,68 @@ class VirtualMachineState(MachineState[VirtualMachineDefinition]):
             self.log("In live CD (rescue mode)")
             self._provision_ssh_key_through_agent()
             self.write_ssh_private_key(self.private_host_key)
-            time.sleep(1) # give some time to SSH/IP to be ready.
+            timing.sleep(1) # give some time to SSH/IP to be ready.
 
         if self.public_ip or (self.use_private_ip_address and not self.private_ip) or check:
             self._wait_for_ip()
-            time.sleep(1)
+            timing.sleep(1)
 
         if self.state == self.RESCUE:
             self.log("Initial installation in rescue mode")
             old_ssh_user = self.ssh_user
             self.ssh_user = "root"
             self.wait_for_ssh(check=check)
-            # Partition table changed.
-            if self.partitions and self.partitions != defn.partitions:
-                # TODO: use remapper.
-                if self.depl.logger.confirm("Partition table changed, do you want to re-run the partitionning phase?"):
-                    self.partitioned = False
-
-            if self.partitioned:
-                self._partition_disks(defn.partitions, defn.postPartitioningLocalCommands)
-            else:
-                rebooted = self._partition_disks(defn.partitions, defn.postPartitioningLocalCommands)
-                if rebooted:
-                    time.sleep(1)
-                    self._provision_ssh_key_through_agent()
-                    self.write_ssh_private_key(self.private_host_key)
-                    self.wait_for_ssh(check=check)
-            self._configure_initial_nix(defn.uefi.enable)
-            self.reboot()
-            self.wait_for_qemu_agent()
-            self._postinstall(defn.host_key_type(), check)
+
+            # Resume after the phases which completed with the same inputs
+            # (partition script, generated configuration, keys) and whose
+            # effects are still there.
+            journal = nixops_proxmox.checkpoints.CheckpointJournal(self.checkpoints)
+            plan = self._provisioning_plan(defn)
+            rescue_plan = [(phase, plan[phase]) for phase in nixops_proxmox.checkpoints.RESCUE_PHASES]
+            start = journal.resume_from(rescue_plan, self._rescue_progress())
+            if start:
+                self.log(f"resuming the installation, already done: {', '.join(phase for phase, _ in rescue_plan[:start])}")
+            if start < len(rescue_plan) and journal.stale(*rescue_plan[start]):
+                self.log(f"the inputs of the {rescue_plan[start][0]} phase changed, running it again")
+
+            if start <= 0:
+                with coordinator.phase(self.name, "partition", node=self.node):
+                    if self._partition_disks(defn.partitions, defn.postPartitioningLocalCommands) is None:
+                        # The script asked for a reboot, to reload the partition table.
+                        timing.sleep(1)
+                        self._provision_ssh_key_through_agent()
+                        self.write_ssh_private_key(self.private_host_key)
+                        self.wait_for_ssh(check=check)
+                        if self._partition_disks(defn.partitions, defn.postPartitioningLocalCommands) is None:
+                            raise Exception(f"The partitioning script of '{self.name}' asked for a reboot twice")
+                    self._record_checkpoint("partition", plan["partition"])
+            if start <= 2:
+                with coordinator.phase(self.name, "install", install=True):
+                    nixos_config = self._initial_configuration(defn.uefi.enable)
+                    if start <= 1:
+                        self._configure_initial_nix(nixos_config)
+                        self._record_checkpoint("configure", plan["configure"])
+                    self._install_initial_system(nixos_config, install_mode=defn.installMode, arch=defn.arch, share_deployer_store=defn.shareDeployerStore)
+                    self._record_checkpoint("install", plan["install"])
+            with coordinator.phase(self.name, "boot"):
+                self.reboot()
+                self.wait_for_qemu_agent()
+            with coordinator.phase(self.name, "postinstall"):
+                self._postinstall(defn.host_key_type(), check)
+                self._record_checkpoint("postinstall", plan["postinstall"])
             self.ssh_user = old_ssh_user
 
         # Maybe, we installed but the process has crashed before.
-        if self.state != self.RESCUE and not self.installed:
+        postinstall = self._provisioning_plan(defn)["postinstall"]
+        journal = nixops_proxmox.checkpoints.CheckpointJournal(self.checkpoints)
+        # Machines deployed before the journal only have `installed`.
+        postinstalled = journal.completed("postinstall", postinstall) or (self.installed and not self.checkpoints)
+        if self.state != self.RESCUE and not postinstalled:
             self.log_start("Resuming the post-installation... ")
             old_ssh_user = self.ssh_user
             self.ssh_user = "root"
             self._postinstall(defn.host_key_type(), check)
+            self._record_checkpoint("postinstall", postinstall)
             self.log_end("Post-installed")
             self.ssh_user = old_ssh_user
 
@@ -845,18 +1578,14 @@ class VirtualMachineState(MachineState[VirtualMachineDefinition]):
 
         instance = None
         if self.vm_id:
-            instance = self._get_instance(allow_missing=True)
+            instance = self._get_status(allow_missing=True)
 
         if instance:
-            self._connect_vm().status.stop.post()
-
-            instance = self._get_instance(update=True)
-            while instance['status'] != 'stopped':
-                self.log_continue(f"[{instance['status']}]")
-                time.sleep(3)
-                instance = self._get_instance(update=True)
-
-            self._connect_vm().delete(purge=1)
+            if instance['status'] != 'stopped':
+                self._wait_for_task(self._connect_vm().status.stop.post(),
+                        callback=lambda: self.log_continue("."))
+            self._wait_for_task(self._connect_vm().delete(purge=1))
+        nixops_proxmox.placement.placer_for(self._connection_key()).release(self.name)
 
         self.log_end("")
         self._reset_network_knowledge()
@@ -870,31 +1599,18 @@ class VirtualMachineState(MachineState[VirtualMachineDefinition]):
 
         self.log_start("stopping Proxmox VM...")
 
-        self._connect_vm().status.shutdown.post()
         self.state = self.STOPPING
-
-        def check_stopped():
-            instance = self._get_instance(update=True)
-            self.log_continue(f"[{instance['state']}]")
-
-            if instance['state'] == 'stopped':
-                return True
-
-            if instance['state'] != "running":
-                raise Exception(
-                    f"Proxmox VM '{self.vm_id}' failed to stop (state is '{instance['state']}')"
-                )
-
-            return False
-
-        if not nixops.util.check_wait(
-                check_stopped, initial=3, max_tries=300, exception=False):
-            self.log_end("(timed out)")
+        progress = lambda: self.log_continue(".")
+        try:
+            # Proxmox enforces the shutdown timeout itself and fails the task.
+            self._wait_for_task(
+                    self._connect_vm().status.shutdown.post(timeout=300),
+                    timeout=330, callback=progress)
+        except (TaskFailed, TaskTimeout) as e:
+            self.log_end(f"(failed: {e.exitstatus if isinstance(e, TaskFailed) else 'timed out'})")
             self.log_start("force-stopping Proxmox VM... ")
-            self._connect_vm().status.stop.post()
-            nixops.util.check_wait(
-                    check_stopped, initial=3, max_tries=100
-            )
+            self._wait_for_task(self._connect_vm().status.stop.post(),
+                    timeout=300, callback=progress)
 
         self.log_end("")
         self.state = self.STOPPED
@@ -903,7 +1619,7 @@ class VirtualMachineState(MachineState[VirtualMachineDefinition]):
     def start(self):
         self.log("starting Proxmox VM machine...")
 
-        self._connect_vm().status.start()
+        self._wait_for_task(self._connect_vm().status.start.post())
         self.state = self.STARTING
         with self._check_ip_changes() as old_addresses:
             self._wait_for_ip()
@@ -917,7 +1633,7 @@ class VirtualMachineState(MachineState[VirtualMachineDefinition]):
             res.exists = False
             return
 
-        instance = self._get_instance(allow_missing=True)
+        instance = self._get_status(allow_missing=True)
 
         if instance is None:
             self.state = self.MISSING
@@ -938,26 +1654,28 @@ class VirtualMachineState(MachineState[VirtualMachineDefinition]):
             self.state = self.STOPPED
 
     def reboot_sync(self, hard: bool = False):
-        self.reboot(hard=hard)
-
         self.log_start("waiting for the machine to finish rebooting... ")
         def progress_cb() -> None:
             self.log_continue(".")
 
-        self.wait_for_down(callback=progress_cb)
-        self.log_continue("[down] ")
+        # The reboot task is only over once the VM went down and came back.
+        self.reboot(hard=hard, callback=progress_cb)
+        self.log_continue("[rebooted] ")
         self.wait_for_qemu_agent(callback=progress_cb)
         self.log_end("[qemu agent up]")
 
 
-    def reboot(self, hard: bool = False):
+    @timing.timed("reboot")
+    def reboot(self, hard: bool = False, callback=None):
         self.log("rebooting Proxmox VM machine...")
         status = self._connect_vm().status
         if hard:
-            status.reset.post()
+            upid = status.reset.post()
         else:
-            status.reboot.post()
+            upid = status.reboot.post()
+        forget_reachable(self._known_addresses())
         self.state = self.STARTING
+        self._wait_for_task(upid, callback=callback)
 
     def get_console_output(self):
         if not self.vm_id:
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+Record and replay of the Proxmox API traffic, as cassettes.
+
+`PROXMOX_CASSETTE=record:deploy.jsonl.gz` records every request made
+through the pooled sessions, with its response and its timing, secrets
+redacted. `PROXMOX_CASSETTE=replay:deploy.jsonl.gz` answers the requests
+from the cassette, without any network access, at the recorded pace
+scaled by `PROXMOX_CASSETTE_SPEED` (1 by default, 10 for ten times
+faster, 0 for no waiting at all).
+"""
+import atexit
+import gzip
+import json
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Dict, IO, List, Optional, Tuple, cast
+from urllib.parse import urlsplit
+
+from nixops_proxmox.instrumentation import API_PREFIX_RE
+
+CASSETTE_VERSION = 1
+
+REDACTED = "<redacted>"
+SECRET_KEY_RE = re.compile(r"password|passwd|ticket|csrf|token|secret|private", re.IGNORECASE)
+SECRET_VALUE_RES = [
+    re.compile(r"-----BEGIN [A-Z ]*PRIVATE KEY-----.*?-----END [A-Z ]*PRIVATE KEY-----", re.DOTALL),
+    re.compile(r"PVE:[^:\s]+:[0-9A-F]{8}::\S+"),
+    re.compile(r"PVEAPIToken=\S+"),
+]
+# Request payloads are only kept for the record, large ones are cut short.
+MAX_RECORDED_STRING = 512
+
+# `run_steps` markers are random, replayed outputs get the live ones.
+STEP_MARKER_RE = re.compile(r"__nixops_step_[0-9a-f]+")
+STEP_MARKER_PLACEHOLDER = "__nixops_step_{marker}"
+AGENT_EXEC_RE = re.compile(r"^(.*/qemu/\d+)/agent/exec$")
+AGENT_EXEC_STATUS_RE = re.compile(r"^(.*/qemu/\d+)/agent/exec-status$")
+
+
+class CassetteMiss(Exception):
+    pass
+
+
+def redact(value: Any, *, truncate: bool = False) -> Any:
+    if isinstance(value, dict):
+        return {key: REDACTED if SECRET_KEY_RE.search(str(key)) and value_ is not None
+                else redact(value_, truncate=truncate)
+                for key, value_ in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(item, truncate=truncate) for item in value]
+    if isinstance(value, str):
+        for secret_re in SECRET_VALUE_RES:
+            value = secret_re.sub(REDACTED, value)
+        value = STEP_MARKER_RE.sub(STEP_MARKER_PLACEHOLDER, value)
+        if truncate and len(value) > MAX_RECORDED_STRING:
+            value = f"{value[:MAX_RECORDED_STRING // 2]}...<{len(value)} characters>"
+        return value
+    return value
+
+
+def api_path(url: str) -> str:
+    return API_PREFIX_RE.sub("", urlsplit(url).path)
+
+
+def request_key(method: str, path: str, params: Optional[Dict[str, Any]]) -> str:
+    """What a request is matched on: its method, path and query parameters."""
+    query = "&".join(f"{key}={value}" for key, value in sorted((params or {}).items()))
+    return f"{method} {path}" + (f"?{query}" if query else "")
+
+
+def _open(path: str, mode: str) -> IO[str]:
+    if path.endswith(".gz"):
+        return cast(IO[str], gzip.open(path, mode + "t", encoding="utf-8"))
+    return open(path, mode, encoding="utf-8")
+
+
+def _decode(content: Any, envelope: bool) -> Any:
+    """The `data` of a response, pveproxy wraps it in `{"data": ...}`, pvesh does not."""
+    if isinstance(content, bytes):
+        content = content.decode("utf-8", errors="replace")
+    try:
+        decoded = json.loads(content)
+    except (TypeError, ValueError):
+        return content
+    if envelope and isinstance(decoded, dict):
+        return decoded.get("data")
+    return decoded
+
+
+class CassetteRecorder:
+    """Append the requests to a cassette, one JSON line each."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = _open(path, "w")
+        self._started = time.monotonic()
+        self._write({"version": CASSETTE_VERSION, "recorded_at": time.time()})
+
+    def _write(self, entry: Dict[str, Any]) -> None:
+        self._file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+        self._file.flush()
+
+    def record(self, method: str, url: str, params: Optional[Dict[str, Any]],
+               data: Optional[Dict[str, Any]], resp: Any, started: float,
+               envelope: bool = True) -> None:
+        entry = {
+            "t": round(started - self._started, 4),
+            "dt": round(time.monotonic() - started, 4),
+            "m": method,
+            "p": api_path(url),
+            "s": resp.status_code,
+        }
+        if params:
+            entry["q"] = redact({key: str(value) for key, value in params.items()})
+        if data:
+            entry["d"] = redact(data, truncate=True)
+        if resp.status_code >= 400:
+            entry["r"] = redact(getattr(resp, "reason", ""))
+        entry["b"] = redact(_decode(resp.content, envelope))
+        with self._lock:
+            self._write(entry)
+
+    def wrap(self, api):
+        """Record every request going through the session of a `ProxmoxAPI`."""
+        session = api._store["session"]
+        if getattr(session, "_nixops_recorded", False):
+            return api
+
+        request = session.request
+        envelope = type(api._backend).__module__ == "proxmoxer.backends.https"
+
+        def recorded_request(method, url, *args, **kwargs):
+            started = time.monotonic()
+            resp = request(method, url, *args, **kwargs)
+            self.record(method, url, kwargs.get("params"), kwargs.get("data"), resp, started, envelope)
+            return resp
+
+        session.request = recorded_request
+        session._nixops_recorded = True
+        return api
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+class ReplayedResponse:
+    """Enough of `requests.Response` for proxmoxer and the instrumentation."""
+
+    def __init__(self, status_code: int, reason: str, data: Any):
+        self.status_code = status_code
+        self.reason = reason
+        self.content = json.dumps({"data": data}).encode()
+        self.headers = {"content-type": "application/json"}
+
+
+class CassetteReplayer:
+    """
+    Answer the requests from a cassette.
+
+    Requests are matched on their method, path and query parameters. Without
+    pacing (`speed=0`), the recorded responses of a request are returned in
+    order, the last one repeated once they are exhausted. With pacing, the
+    responses also take their recorded time, and a polled resource (a task,
+    a VM status, an agent command) goes through its recorded states at the
+    recorded pace from its first request on: polling faster returns the
+    same state more often, polling slower skips states.
+    """
+
+    def __init__(self, path: str, speed: float = 1.0):
+        self.path = path
+        self.speed = speed
+        self._lock = threading.Lock()
+        self._entries: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        self._cursors: Dict[str, int] = defaultdict(int)
+        self._anchors: Dict[str, float] = {}
+        self._markers: Dict[str, str] = {}
+        self.misses = 0
+        with _open(path, "r") as cassette:
+            header = json.loads(cassette.readline())
+            if header.get("version") != CASSETTE_VERSION:
+                raise ValueError(f"'{path}' is not a version {CASSETTE_VERSION} cassette")
+            for line in cassette:
+                entry = json.loads(line)
+                self._entries[request_key(entry["m"], entry["p"], entry.get("q"))].append(entry)
+
+    def _pick(self, key: str, method: str) -> Dict[str, Any]:
+        entries = self._entries.get(key)
+        if not entries:
+            self.misses += 1
+            raise CassetteMiss(f"No recorded response for '{key}' in the cassette '{self.path}'")
+
+        cursor = self._cursors[key]
+        if not self.speed or method != "GET":
+            self._cursors[key] = min(cursor + 1, len(entries) - 1)
+            return entries[cursor]
+
+        now = time.monotonic()
+        anchor = self._anchors.setdefault(key, now)
+        recorded_now = entries[0]["t"] + (now - anchor) * self.speed
+        while cursor + 1 < len(entries) and entries[cursor + 1]["t"] <= recorded_now:
+            cursor += 1
+        self._cursors[key] = cursor
+        return entries[cursor]
+
+    def request(self, method: str, url: str, *args, **kwargs) -> ReplayedResponse:
+        path = api_path(url)
+        params = {key: str(value) for key, value in (kwargs.get("params") or {}).items()}
+        key = request_key(method, path, redact(params))
+        with self._lock:
+            entry = self._pick(key, method)
+
+            exec_call = AGENT_EXEC_RE.match(path)
+            if exec_call and method == "POST":
+                sent = STEP_MARKER_RE.search(str((kwargs.get("data") or {}).get("input-data", "")))
+                if sent:
+                    self._markers[exec_call.group(1)] = sent.group(0)
+            status_call = AGENT_EXEC_STATUS_RE.match(path)
+            marker = self._markers.get(status_call.group(1)) if status_call else None
+
+        if self.speed:
+            # The server latency, not a wait of ours.
+            time.sleep(entry["dt"] / self.speed)
+
+        body = entry.get("b")
+        if marker is not None:
+            body = json.loads(json.dumps(body).replace(STEP_MARKER_PLACEHOLDER, marker))
+        return ReplayedResponse(entry["s"], entry.get("r", ""), body)
+
+    def api(self, server_url: str, username: str):
+        """A `ProxmoxAPI` answered by the cassette."""
+        from proxmoxer import ProxmoxAPI
+        # An empty API token makes proxmoxer build its session without any
+        # network round-trip.
+        api = ProxmoxAPI(server_url, user=username, token_name='', token_value='',
+                         verify_ssl=False, backend='https')
+        api._store["session"].request = self.request
+        return api
+
+
+_cassette_lock = threading.Lock()
+_cassette: Optional[Tuple[str, Any]] = None
+
+
+def cassette_from_env() -> Optional[Tuple[str, Any]]:
+    """
+    The process-wide `("record", CassetteRecorder)` or `("replay",
+    CassetteReplayer)` asked by `PROXMOX_CASSETTE=record:PATH|replay:PATH`.
+    """
+    global _cassette
+    setting = os.environ.get("PROXMOX_CASSETTE")
+    if not setting:
+        return None
+
+    with _cassette_lock:
+        if _cassette is None:
+            mode, sep, path = setting.partition(":")
+            if not sep or mode not in ("record", "replay"):
+                raise ValueError(f"PROXMOX_CASSETTE must be 'record:PATH' or 'replay:PATH', not '{setting}'")
+            if mode == "record":
+                recorder = CassetteRecorder(path)
+                # Flushed after each request, but gzip needs its trailer.
+                atexit.register(recorder.close)
+                _cassette = (mode, recorder)
+            else:
+                speed = float(os.environ.get("PROXMOX_CASSETTE_SPEED", "1"))
+                _cassette = (mode, CassetteReplayer(path, speed))
+        return _cassette
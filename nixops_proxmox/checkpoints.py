@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import time
+from typing import Any, Container, Dict, Iterable, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+# Provisioning phases, in order: completing one invalidates the later ones.
+PHASES = ("partition", "configure", "install", "postinstall")
+# The phases run from the live CD, against the disks mounted on /mnt.
+RESCUE_PHASES = PHASES[:3]
+# Prints `mounted` and the install marker if the disks are mounted on /mnt.
+RESCUE_PROGRESS_COMMAND = \
+    "if mountpoint -q /mnt; then echo mounted; cat /mnt/.install_status 2>/dev/null || true; fi"
+
+
+def digest(previous: Optional[str], *inputs: Any) -> str:
+    """
+    Hash of the inputs of a phase, chained to the hash of the phase it
+    builds upon: a change invalidates every phase from there on.
+    """
+    payload = json.dumps([previous, *inputs], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:32]
+
+
+def provisioning_plan(vm_id: Any, *, partitions: str, post_partitioning_commands: Any,
+                      disk_sizes: List[str], initial_configuration: str,
+                      install_mode: str, arch: Optional[str],
+                      host_key_type: str, host_key: Optional[str]) -> Dict[str, str]:
+    """Hash of the inputs of each provisioning phase, chained from the VM id."""
+    partition = digest(str(vm_id), partitions, post_partitioning_commands, disk_sizes)
+    configure = digest(partition, initial_configuration)
+    install = digest(configure, install_mode, arch)
+    # Pre-built VMs are post-installed too, without the live CD phases.
+    postinstall = digest(str(vm_id), host_key_type, host_key)
+    return {"partition": partition, "configure": configure,
+            "install": install, "postinstall": postinstall}
+
+
+def rescue_progress(output: str) -> Set[str]:
+    """The live CD phases whose effects are still there, from `RESCUE_PROGRESS_COMMAND`."""
+    words = output.split()
+    if "mounted" not in words:
+        return set()
+    if "installed" in words:
+        return {"partition", "configure", "install"}
+    if "preinstall" in words:
+        return {"partition", "configure"}
+    return {"partition"}
+
+
+class Checkpoint(NamedTuple):
+    phase: str
+    digest: str
+    at: float
+
+
+class CheckpointJournal:
+    """Completed provisioning phases of a machine, with the hash of their inputs."""
+
+    def __init__(self, entries: Iterable[Dict[str, Any]] = ()):
+        self.entries = [Checkpoint(entry["phase"], entry["digest"], entry.get("at", 0.0))
+                        for entry in entries]
+
+    def get(self, phase: str) -> Optional[Checkpoint]:
+        return next((entry for entry in self.entries if entry.phase == phase), None)
+
+    def completed(self, phase: str, phase_digest: str) -> bool:
+        entry = self.get(phase)
+        return entry is not None and entry.digest == phase_digest
+
+    def stale(self, phase: str, phase_digest: str) -> bool:
+        """Whether `phase` completed, but with other inputs."""
+        entry = self.get(phase)
+        return entry is not None and entry.digest != phase_digest
+
+    def resume_from(self, plan: Sequence[Tuple[str, str]], in_effect: Container[str]) -> int:
+        """
+        Index of the first phase of `plan` to run: the ones before it
+        completed with the same inputs, and their effects are still there.
+        """
+        for index, (phase, phase_digest) in enumerate(plan):
+            if phase not in in_effect or not self.completed(phase, phase_digest):
+                return index
+        return len(plan)
+
+    def record(self, phase: str, phase_digest: str) -> None:
+        later = PHASES[PHASES.index(phase):]
+        self.entries = [entry for entry in self.entries if entry.phase not in later]
+        self.entries.append(Checkpoint(phase, phase_digest, time.time()))
+
+    def to_json(self) -> List[Dict[str, Any]]:
+        return [entry._asdict() for entry in self.entries]
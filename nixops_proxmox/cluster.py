@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from typing import Optional, Dict, Any
+
+from nixops_proxmox.proxmox_utils import ConnectionKey
+
+# Waiters poll every second or so, a snapshot this young is good enough for
+# every one of them and keeps the refresh rate at one request per tick.
+DEFAULT_MAX_AGE = 2.0
+
+
+class ClusterStatusSnapshot:
+    """
+    Time-bounded view of every VM of a cluster.
+
+    It is built from a single `cluster/resources?type=vm` call and shared by
+    all the machine states talking to the same endpoint, so that checking or
+    waiting on N machines costs one request per refresh instead of N.
+    """
+
+    def __init__(self, max_age: float = DEFAULT_MAX_AGE):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._vms: Dict[int, Dict[str, Any]] = {}
+        self._fetched_at: Optional[float] = None
+        self.refreshes = 0
+
+    def _is_fresh(self, max_age: float) -> bool:
+        return (self._fetched_at is not None
+                and time.monotonic() - self._fetched_at < max_age)
+
+    def refresh(self, api) -> None:
+        resources = api.cluster.resources.get(type="vm")
+        self._vms = {int(res["vmid"]): res for res in resources
+                     if res.get("type") == "qemu"}
+        self._fetched_at = time.monotonic()
+        self.refreshes += 1
+
+    def get(self, api, vmid: int,
+            max_age: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """Return the `cluster/resources` entry of `vmid`, None if it is missing."""
+        if max_age is None:
+            max_age = self.max_age
+
+        # Threads arriving while a refresh is in flight block on the lock and
+        # then reuse its result instead of issuing their own request.
+        with self._lock:
+            if not self._is_fresh(max_age):
+                self.refresh(api)
+            return self._vms.get(int(vmid))
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._fetched_at = None
+
+
+_snapshots_lock = threading.Lock()
+_snapshots: Dict[ConnectionKey, ClusterStatusSnapshot] = {}
+
+
+def snapshot_for(key: ConnectionKey) -> ClusterStatusSnapshot:
+    with _snapshots_lock:
+        if key not in _snapshots:
+            _snapshots[key] = ClusterStatusSnapshot()
+        return _snapshots[key]
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Dict, Hashable, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+from nixops_proxmox import timing
+
+# How many machines may be in a limited phase at once, per API endpoint,
+# per node, per storage, and overall for the installations (which pull
+# from the deployer or the binary caches).
+DEFAULT_LIMITS = {"endpoint": 8, "node": 4, "storage": 2, "install": 4}
+
+# Seconds to wait for expected machines which may never join the batch
+# (left out by `--include`/`--exclude`) before reporting without them.
+REPORT_GRACE = 5.0
+
+
+def get_limits() -> Dict[str, int]:
+    """Default limits, overridden by `PROXMOX_CREATE_LIMITS=node=2,storage=1`."""
+    limits = dict(DEFAULT_LIMITS)
+    for item in os.environ.get("PROXMOX_CREATE_LIMITS", "").split(","):
+        kind, sep, value = item.partition("=")
+        if sep and kind.strip() in limits:
+            limits[kind.strip()] = max(1, int(value))
+    return limits
+
+
+class PhaseTiming(NamedTuple):
+    machine: str
+    phase: str
+    start: float
+    end: float
+    waited: float  # Time spent waiting for the slots, not included in start..end.
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+class CreateCoordinator:
+    """
+    Admission control shared by the machines of a deployment.
+
+    nixops creates the machines in parallel threads. Each of them runs its
+    creation as a sequence of phases, and a phase only holds the slots of
+    the resources it actually stresses: a VM can be partitioned while
+    another one boots, but no more than `limits["storage"]` VMs get their
+    disks provisioned on the same storage at once.
+    """
+
+    def __init__(self, limits: Optional[Dict[str, int]] = None):
+        self.limits = limits or get_limits()
+        self._lock = threading.Lock()
+        self._semaphores: Dict[Tuple[str, Hashable], threading.BoundedSemaphore] = {}
+        self._timings: List[PhaseTiming] = []
+        self._timelines: Dict[str, List[Dict[str, Any]]] = {}
+        self._active = 0
+        self._expected: Set[str] = set()
+        self._done: Set[str] = set()
+        self._report_timer: Optional[threading.Timer] = None
+
+    def _semaphore(self, kind: str, name: Hashable) -> threading.BoundedSemaphore:
+        with self._lock:
+            key = (kind, name)
+            if key not in self._semaphores:
+                self._semaphores[key] = threading.BoundedSemaphore(self.limits[kind])
+            return self._semaphores[key]
+
+    @contextmanager
+    def phase(self, machine: str, name: str, *,
+              endpoint: Optional[str] = None, node: Optional[str] = None,
+              storages: Iterable[str] = (), install: bool = False) -> Iterator[None]:
+        # Always acquired in the same order, so that no two phases deadlock.
+        wanted: List[Tuple[str, Hashable]] = []
+        if endpoint is not None:
+            wanted.append(("endpoint", endpoint))
+        if node is not None:
+            wanted.append(("node", node))
+        wanted.extend(("storage", (node, storage)) for storage in sorted(set(storages)))
+        if install:
+            wanted.append(("install", None))
+
+        acquired = []
+        queued_at = time.monotonic()
+        with timing.span(name):
+            try:
+                if wanted:
+                    with timing.span("wait for slots"):
+                        for kind, key in wanted:
+                            semaphore = self._semaphore(kind, key)
+                            semaphore.acquire()
+                            acquired.append(semaphore)
+                start = time.monotonic()
+                yield
+            finally:
+                end = time.monotonic()
+                for semaphore in reversed(acquired):
+                    semaphore.release()
+                if len(acquired) == len(wanted):
+                    with self._lock:
+                        self._timings.append(PhaseTiming(machine, name, start, end, start - queued_at))
+
+    def enter(self, machine: str, expected: Iterable[str] = ()) -> None:
+        """
+        Join the current batch. `expected` are the machines the batch is
+        made of: it is only over once every one of them has left.
+        """
+        with self._lock:
+            if self._report_timer is not None:
+                self._report_timer.cancel()
+                self._report_timer = None
+            self._expected.update(expected)
+            self._expected.add(machine)
+            self._active += 1
+
+    def leave(self, machine: str, log=None, timeline: Optional[timing.Timeline] = None,
+              deployment: Optional[str] = None) -> None:
+        """Report once the last expected machine of the current batch is done."""
+        with self._lock:
+            if timeline is not None and timeline.spans:
+                self._timelines[timeline.machine] = timeline.to_json()
+            self._active -= 1
+            self._done.add(machine)
+            if self._active > 0:
+                return
+            if not self._expected <= self._done:
+                # Some machines did not even start their creation yet.
+                self._report_timer = threading.Timer(REPORT_GRACE, self._report, (log, deployment))
+                self._report_timer.daemon = True
+                self._report_timer.start()
+                return
+        self._report(log, deployment)
+
+    def _report(self, log, deployment: Optional[str]) -> None:
+        with self._lock:
+            if self._active > 0:
+                return
+            self._report_timer = None
+            self._expected, self._done = set(), set()
+            timings, self._timings = self._timings, []
+            timelines, self._timelines = self._timelines, {}
+        if not timings:
+            return
+        if log:
+            log(self.summary(timings))
+            if timelines:
+                log("slowest phases across the machines:\n" + timing.fleet_summary(timelines))
+        timing.write_exports(timelines, deployment)
+
+    @staticmethod
+    def summary(timings: List[PhaseTiming]) -> str:
+        wall_clock = max(t.end for t in timings) - min(t.start - t.waited for t in timings)
+        per_phase: Dict[str, float] = defaultdict(float)
+        for phase_timing in timings:
+            per_phase[phase_timing.phase] += phase_timing.duration
+        summed = sum(per_phase.values())
+        waited = sum(t.waited for t in timings)
+        machines = len({t.machine for t in timings})
+        phases = ", ".join(f"{phase} {duration:.1f}s" for phase, duration in per_phase.items())
+        return (f"created {machines} machine(s) in {wall_clock:.1f}s wall-clock for "
+                f"{summed:.1f}s of summed phases ({summed / max(wall_clock, 1e-6):.1f}x overlap, "
+                f"{waited:.1f}s waiting for slots): {phases}")
+
+
+_coordinators_lock = threading.Lock()
+_coordinators: Dict[Hashable, CreateCoordinator] = {}
+
+
+def coordinator_for(key: Hashable) -> CreateCoordinator:
+    with _coordinators_lock:
+        if key not in _coordinators:
+            _coordinators[key] = CreateCoordinator()
+        return _coordinators[key]
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+import glob
+import hashlib
+import mmap
+import os
+import subprocess
+import threading
+import time
+import uuid
+from typing import Dict, Hashable, Optional
+
+import requests
+
+from nixops_proxmox.instrumentation import api_metrics
+from nixops_proxmox.tasks import wait_for_task
+
+CHUNK_SIZE = 4 * 1024 * 1024
+IMAGE_EXTENSIONS = ("qcow2", "raw", "img", "vmdk")
+
+
+def build_image(expression: str) -> str:
+    """Build a Nix expression producing a disk image, return the image path."""
+    out = subprocess.check_output(
+        ["nix-build", expression, "--no-out-link"], text=True).strip().splitlines()[-1]
+    if os.path.isfile(out):
+        return out
+
+    candidates = sorted(path for ext in IMAGE_EXTENSIONS
+                        for path in glob.glob(os.path.join(out, f"*.{ext}")))
+    if len(candidates) != 1:
+        raise Exception(f"Expected exactly one disk image in '{out}', found {len(candidates)}")
+    return candidates[0]
+
+
+def resolve_image(source: str) -> str:
+    if source.endswith(".nix"):
+        return build_image(source)
+    if not os.path.isfile(source):
+        raise Exception(f"Disk image '{source}' does not exist")
+    return source
+
+
+def image_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as image:
+        if os.fstat(image.fileno()).st_size == 0:
+            return digest.hexdigest()
+        with mmap.mmap(image.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for offset in range(0, len(mapped), CHUNK_SIZE):
+                digest.update(mapped[offset:offset + CHUNK_SIZE])
+    return digest.hexdigest()
+
+
+def image_volume_name(digest: str, image_format: str) -> str:
+    # Content-addressed: the same image always gets the same name.
+    return f"nixops-{digest[:32]}.{image_format}"
+
+
+class MultipartUpload:
+    """
+    File-like multipart/form-data body streamed from a memory-mapped file.
+
+    requests reads it block by block thanks to `read`, and sends a proper
+    Content-Length thanks to `__len__`, so the image is never held in memory.
+    """
+
+    def __init__(self, path: str, fields: Dict[str, str], filename: str):
+        self.boundary = uuid.uuid4().hex
+        head = b"".join(
+            f"--{self.boundary}\r\n"
+            f"Content-Disposition: form-data; name=\"{name}\"\r\n\r\n"
+            f"{value}\r\n".encode()
+            for name, value in fields.items())
+        head += (f"--{self.boundary}\r\n"
+                 f"Content-Disposition: form-data; name=\"filename\"; filename=\"{filename}\"\r\n"
+                 "Content-Type: application/octet-stream\r\n\r\n").encode()
+        self._head = head
+        self._tail = f"\r\n--{self.boundary}--\r\n".encode()
+        self._file = open(path, "rb")
+        self._size = os.fstat(self._file.fileno()).st_size
+        self._mapped = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) \
+            if self._size else b""
+        self._position = 0
+
+    @property
+    def content_type(self) -> str:
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self) -> int:
+        return len(self._head) + self._size + len(self._tail)
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = len(self) - self._position
+        parts = []
+        end = min(len(self), self._position + size)
+        for start, data in ((0, self._head),
+                            (len(self._head), self._mapped),
+                            (len(self._head) + self._size, self._tail)):
+            lo = max(self._position, start) - start
+            hi = min(end, start + len(data)) - start
+            if hi > lo:
+                parts.append(bytes(data[lo:hi]))
+        self._position = end
+        return b"".join(parts)
+
+    def close(self) -> None:
+        if isinstance(self._mapped, mmap.mmap):
+            self._mapped.close()
+        self._file.close()
+
+
+def find_uploaded_image(api, node: str, storage: str, name: str) -> Optional[str]:
+    for volume in api.nodes(node).storage(storage).content.get(content="import"):
+        if volume.get("volid", "").endswith(f"import/{name}"):
+            return volume["volid"]
+    return None
+
+
+def upload_image(api, node: str, storage: str, path: str, name: str, digest: str) -> str:
+    """Stream the image to the `import` content of a storage, return its volume id."""
+    if "session" not in api._store or not api._store["base_url"]:
+        raise Exception("Disk image uploads require the HTTPS Proxmox API backend")
+
+    session = api._store["session"]
+    if isinstance(session, requests.Session):
+        uploader = session
+    else:
+        # The asyncio session (PROXMOX_API_CLIENT=async) does not stream
+        # request bodies, upload through a plain requests session instead.
+        uploader = requests.Session()
+        uploader.auth = session.auth
+        uploader.verify = session.client.verify_ssl
+    url = f"{api._store['base_url']}/nodes/{node}/storage/{storage}/upload"
+    body = MultipartUpload(path, {
+        "content": "import",
+        # pveproxy verifies the checksum once the upload is complete.
+        "checksum-algorithm": "sha256",
+        "checksum": digest,
+    }, name)
+    started = time.monotonic()
+    try:
+        # Bypass proxmoxer's session override, which only handles dict bodies.
+        resp = requests.Session.request(
+            uploader, "POST", url, data=body,
+            headers={"Content-Type": body.content_type},
+            cookies=session.auth.get_cookies() if session.auth else None,
+            # Explicit, lest REQUESTS_CA_BUNDLE override the session setting.
+            verify=uploader.verify)
+    finally:
+        body.close()
+        if uploader is not session:
+            uploader.close()
+    api_metrics.record("POST", url, resp.status_code, len(body), time.monotonic() - started)
+
+    if resp.status_code >= 400:
+        raise Exception(f"Failed to upload disk image '{path}' to {storage}: {resp.status_code} {resp.reason} {resp.text}")
+
+    wait_for_task(api, resp.json()["data"])
+    return f"{storage}:import/{name}"
+
+
+_upload_locks_lock = threading.Lock()
+_upload_locks: Dict[Hashable, threading.Lock] = {}
+
+
+def ensure_image_uploaded(api, node: str, storage: str, path: str,
+                          image_format: str, log=None) -> str:
+    """
+    Upload the image once per storage, return the volume id to import from.
+
+    Machines sharing the same image wait for a single upload and then reuse
+    the uploaded volume, as do later deployments.
+    """
+    digest = image_digest(path)
+    name = image_volume_name(digest, image_format)
+    with _upload_locks_lock:
+        lock = _upload_locks.setdefault((node, storage, name), threading.Lock())
+
+    with lock:
+        volid = find_uploaded_image(api, node, storage, name)
+        if volid is not None:
+            return volid
+
+        if log:
+            log(f"uploading disk image {os.path.basename(path)} ({digest[:12]}) to {storage}...")
+        return upload_image(api, node, storage, path, name, digest)
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+import atexit
+import bisect
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import unquote, urlsplit
+
+# Upper bounds of the latency buckets, in seconds.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+# Path segments following these ones are identifiers, templated out so that
+# calls aggregate per endpoint and not per VM.
+TEMPLATED_SEGMENTS = {
+    "nodes": "{node}",
+    "qemu": "{vmid}",
+    "lxc": "{vmid}",
+    "storage": "{storage}",
+    "content": "{volume}",
+    "tasks": "{upid}",
+    "pools": "{pool}",
+}
+API_PREFIX_RE = re.compile(r"^.*?/api2/json")
+
+
+def normalize_path(url: str) -> str:
+    path = API_PREFIX_RE.sub("", urlsplit(url).path)
+    segments = [unquote(segment) for segment in path.strip("/").split("/")]
+    normalized = []
+    for index, segment in enumerate(segments):
+        previous = segments[index - 1] if index else None
+        if previous in TEMPLATED_SEGMENTS:
+            normalized.append(TEMPLATED_SEGMENTS[previous])
+        elif segment.isdigit():
+            normalized.append("{id}")
+        else:
+            normalized.append(segment)
+    return "/" + "/".join(normalized)
+
+
+class Histogram:
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the `q` quantile."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class EndpointStats:
+    __slots__ = ("latency", "statuses", "bytes")
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.statuses: Counter = Counter()
+        self.bytes = 0
+
+
+class ApiMetrics:
+    """
+    Per-endpoint call counts, statuses, bytes and latency histograms.
+
+    Recording a call is a dictionary lookup and a bisection under a lock,
+    cheap enough to stay enabled all the time.
+    """
+
+    def __init__(self, slow_threshold: Optional[float] = None):
+        self.slow_threshold = slow_threshold
+        self._lock = threading.Lock()
+        self._endpoints: Dict[Tuple[str, str], EndpointStats] = {}
+        self.started_at = time.monotonic()
+
+    def record(self, method: str, url: str, status: Any, nbytes: int, seconds: float) -> None:
+        path = normalize_path(url)
+        with self._lock:
+            stats = self._endpoints.get((method, path))
+            if stats is None:
+                stats = self._endpoints[method, path] = EndpointStats()
+            stats.latency.observe(seconds)
+            stats.statuses[status] += 1
+            stats.bytes += nbytes
+
+        if self.slow_threshold is not None and seconds >= self.slow_threshold:
+            sys.stderr.write(f"slow Proxmox API call: {method} {urlsplit(url).path} "
+                             f"-> {status} in {seconds * 1000:.0f} ms\n")
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [{
+                "method": method,
+                "path": path,
+                "count": stats.latency.count,
+                "statuses": {str(status): count for status, count in stats.statuses.items()},
+                "bytes": stats.bytes,
+                "seconds_total": round(stats.latency.total, 6),
+                "seconds_max": round(stats.latency.max, 6),
+                "buckets": {("+Inf" if bound == float("inf") else str(bound)): count
+                            for bound, count in zip(BUCKETS, stats.latency.counts)},
+            } for (method, path), stats in sorted(self._endpoints.items())]
+
+    def summary(self) -> str:
+        with self._lock:
+            rows = sorted(self._endpoints.items(), key=lambda item: -item[1].latency.total)
+            total_calls = sum(stats.latency.count for _, stats in rows)
+            lines = [f"Proxmox API: {total_calls} calls over "
+                     f"{time.monotonic() - self.started_at:.1f}s",
+                     f"{'calls':>6} {'total':>8} {'p50':>7} {'p90':>7} {'max':>7} {'bytes':>9}  endpoint"]
+            for (method, path), stats in rows:
+                latency = stats.latency
+                errors = sum(count for status, count in stats.statuses.items()
+                             if not (isinstance(status, int) and status < 400))
+                lines.append(
+                    f"{latency.count:>6} {latency.total:>7.2f}s {latency.quantile(.5) * 1000:>5.0f}ms "
+                    f"{latency.quantile(.9) * 1000:>5.0f}ms {latency.max * 1000:>5.0f}ms "
+                    f"{stats.bytes:>9}  {method} {path}" + (f" ({errors} errors)" if errors else ""))
+        return "\n".join(lines)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._endpoints = {}
+            self.started_at = time.monotonic()
+
+    def dump(self) -> None:
+        """
+        Report at the end of the command, as asked by `PROXMOX_API_METRICS`:
+        `-` prints a summary on stderr, `off` disables the instrumentation,
+        any other value is a JSON file path.
+        """
+        target = os.environ.get("PROXMOX_API_METRICS")
+        if not target or target == "off" or not self._endpoints:
+            return
+        if target == "-":
+            sys.stderr.write(self.summary() + "\n")
+            return
+        with open(target, "w") as metrics_file:
+            json.dump({"endpoints": self.snapshot()}, metrics_file, indent=2)
+
+
+def _slow_threshold_from_env() -> Optional[float]:
+    value = os.environ.get("PROXMOX_API_SLOW_MS")
+    return float(value) / 1000 if value else None
+
+
+api_metrics = ApiMetrics(_slow_threshold_from_env())
+atexit.register(api_metrics.dump)
+
+
+def instrument(api, metrics: ApiMetrics = api_metrics):
+    """Record every request going through the session of a `ProxmoxAPI`."""
+    session = api._store["session"]
+    if getattr(session, "_nixops_instrumented", False):
+        return api
+
+    request = session.request
+
+    def instrumented_request(method, url, *args, **kwargs):
+        started = time.monotonic()
+        try:
+            resp = request(method, url, *args, **kwargs)
+        except Exception:
+            metrics.record(method, url, "error", 0, time.monotonic() - started)
+            raise
+        metrics.record(method, url, resp.status_code, len(resp.content or b""),
+                       time.monotonic() - started)
+        return resp
+
+    session.request = instrumented_request
+    session._nixops_instrumented = True
+    return api
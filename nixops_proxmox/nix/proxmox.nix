@@ -75,9 +75,42 @@ let
   disksOptions = { config, ... }: {
     options = {
       volume = mkOption {
-        type = types.str;
+        type = types.nullOr types.str;
+        default = null;
         example = "local";
-        description = "Storage volume where to store the disk";
+        description = ''
+          Storage volume where to store the disk.
+          When null, the storage is picked among `candidates` or the
+          storages of type `storageType` when the VM is created.
+        '';
+      };
+      candidates = mkOption {
+        type = types.listOf types.str;
+        default = [];
+        example = [ "local-lvm" "ssd-thin" ];
+        description = ''
+          Storages the disk may be stored on, when `volume` is null.
+          The eligible storage with the most free space is picked, or the
+          fastest one with `benchmark`. The choice is kept in the state.
+        '';
+      };
+      storageType = mkOption {
+        type = types.nullOr types.str;
+        default = null;
+        example = "lvmthin";
+        description = "Only pick among storages of this type (optional)";
+      };
+      benchmark = mkOption {
+        type = types.bool;
+        default = false;
+        description = ''
+          Pick the eligible storage with the best write throughput.
+          It is measured once a week at most, as root on the node through
+          SSH, and cached in $XDG_CACHE_HOME/proxmox/storage-benchmarks.json.
+          Storages whose volumes have no path on the node (rbd, iSCSI,
+          ZFS over iSCSI, GlusterFS) cannot be measured and are left out
+          of the comparison.
+        '';
       };
       size = mkOption {
         type = types.either types.int types.str;
@@ -104,6 +137,99 @@ let
       };
     };
   };
+  templateOptions = { config, ... }: {
+    options = {
+      vmid = mkOption {
+        type = types.nullOr types.int;
+        default = null;
+        example = 9000;
+        description = ''
+          VM id of a template with NixOS pre-installed (optional).
+          When set, the virtual machine is cloned from it instead of being
+          installed from `installISO`, which takes seconds instead of minutes.
+
+          The template must run the QEMU agent and sshd, its disks are grown
+          to the sizes of `disks`.
+        '';
+      };
+      node = mkOption {
+        type = types.nullOr types.str;
+        default = null;
+        description = "Node hosting the template (optional), defaults to the VM node";
+      };
+      fullClone = mkOption {
+        type = types.nullOr types.bool;
+        default = null;
+        description = ''
+          Whether to make a full clone of the template.
+          By default, a linked clone is made when the template storages
+          support it and a full clone otherwise.
+        '';
+      };
+    };
+  };
+  diskImageOptions = { config, ... }: {
+    options = {
+      source = mkOption {
+        type = types.nullOr types.str;
+        default = null;
+        example = "./images/worker.nix";
+        description = ''
+          Pre-built NixOS disk image to boot from (optional).
+          Either the path of a raw/qcow2 image, or of a Nix expression
+          building one (e.g. with `make-disk-image.nix`), which is built on
+          the deployer.
+
+          The image is uploaded once per storage, named after its SHA-256,
+          and imported as the first disk instead of partitioning and
+          installing from `installISO`. It must run the QEMU agent and sshd.
+          Requires a Proxmox version supporting `import` content.
+        '';
+      };
+      format = mkOption {
+        type = types.enum [ "raw" "qcow2" ];
+        default = "qcow2";
+        description = "Format of the disk image";
+      };
+      storage = mkOption {
+        type = types.str;
+        default = "local";
+        description = "Storage receiving the uploaded image (with `import` content enabled)";
+      };
+    };
+  };
+  placementOptions = { config, ... }: {
+    options = {
+      enable = mkOption {
+        type = types.bool;
+        default = false;
+        description = ''
+          Whether to pick the node of the virtual machine automatically,
+          when `node` is not set.
+
+          Eligible nodes are the online ones with enough free memory and
+          storage for the VM, the least loaded one (memory and CPU) is
+          picked. The decision is kept in the deployment state, the VM is
+          never moved afterwards.
+        '';
+      };
+      nodes = mkOption {
+        type = types.listOf types.str;
+        default = [];
+        example = [ "pve1" "pve2" ];
+        description = "Nodes eligible for placement, all the online ones if empty";
+      };
+      antiAffinityGroup = mkOption {
+        type = types.nullOr types.str;
+        default = null;
+        example = "database";
+        description = ''
+          Machines of the same group are spread across distinct nodes, as
+          long as there are enough eligible nodes.
+        '';
+      };
+    };
+  };
 in
 {
   options = {
@@ -182,12 +308,33 @@ in
         Require that the host is configured to SSH to Proxmox host.
       '';
     };
+    deployment.proxmox.cacheTickets = mkOption {
+      default = false;
+      type = types.bool;
+      description = ''
+        Cache the authentication tickets obtained through username/password
+        authentication in $XDG_CONFIG_HOME/proxmox/tickets (or
+        $PROXMOX_TICKET_CACHE_FILE), so that subsequent NixOps invocations
+        can skip the login round-trip while the ticket is valid.
+
+        The cache is keyed by profile, it can also be enabled with
+        `cache_tickets = true` in the profile itself.
+      '';
+    };
     deployment.proxmox.node = mkOption {
       type = types.nullOr types.str;
       default = null;
       description = ''
         Node name for Proxmox host (optional)
-        By default, it will select the first one found.
+        By default, it will select the first one found, or the one picked
+        by `placement` if enabled.
+      '';
+    };
+    deployment.proxmox.placement = mkOption {
+      type = types.submodule placementOptions;
+      default = {};
+      description = ''
+        Automatic placement of the virtual machine on a node (optional)
       '';
     };
     deployment.proxmox.pool = mkOption {
@@ -307,11 +454,58 @@ in
       description = "Virtual machine ID for Proxmox, if not provided, an attempt to grab a free VM id is performed.";
     };
     deployment.proxmox.installISO = mkOption {
-      type = types.str;
+      type = types.nullOr types.str;
+      default = null;
       description = ''
         Install ISO for NixOS.
         This ISO must support cloud-init initialization and QEMU agent.
         So that Proxmox can run the partitionning phase then the NixOS install.
+
+        Mandatory, unless the VM is cloned from `template`.
+      '';
+    };
+    deployment.proxmox.installMode = mkOption {
+      type = types.enum [ "nixos-install" "closure" ];
+      default = "nixos-install";
+      description = ''
+        How NixOS is installed from the live CD.
+
+        - nixos-install: the configuration is evaluated and built inside the
+          virtual machine, fetching everything from its substituters.
+        - closure: the system is built on the deployer and its closure is
+          copied to /mnt over a compressed SSH connection, then only the
+          bootloader is installed in the virtual machine.
+      '';
+    };
+    deployment.proxmox.shareDeployerStore = mkOption {
+      type = types.bool;
+      default = false;
+      description = ''
+        Serve the deployer Nix store as a binary cache to the live CD during
+        `nixos-install`, signed with an ephemeral key.
+
+        Machines installing in parallel then fetch the store paths the
+        deployer already has through the LAN instead of downloading them
+        from the upstream caches. The cache only runs while installations
+        are in progress, on an ephemeral port of the deployer.
+
+        Only the store paths already present in the deployer's store are
+        served: the others are fetched from the usual substituters of the
+        live CD, the deployer never downloads or builds them on its behalf.
+      '';
+    };
+    deployment.proxmox.diskImage = mkOption {
+      type = types.submodule diskImageOptions;
+      default = {};
+      description = ''
+        Disk image to provision the virtual machine from (optional)
+      '';
+    };
+    deployment.proxmox.template = mkOption {
+      type = types.submodule templateOptions;
+      default = {};
+      description = ''
+        Template to clone the virtual machine from (optional)
       '';
     };
   };
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from nixops_proxmox.proxmox_utils import ConnectionKey
+
+# Placements made by this process are accounted for until the cluster
+# resources reflect the new VMs.
+RESERVATION_TTL = 300.0
+
+
+class NodeCapacity(NamedTuple):
+    node: str
+    maxmem: int
+    mem: int
+    maxcpu: int
+    cpu: float  # Load, from 0 to 1.
+    storage_free: Dict[str, int]
+    storage_types: Dict[str, str]
+
+
+class DiskRequest(NamedTuple):
+    """
+    A disk of `size` bytes, on one of `candidates` and of `storage_type` if
+    set: a disk with a fixed volume has that storage as its only candidate.
+    """
+    size: int
+    candidates: Tuple[str, ...] = ()
+    storage_type: Optional[str] = None
+
+    def accepts(self, storage: str, storage_type: Optional[str]) -> bool:
+        return ((not self.candidates or storage in self.candidates)
+                and (self.storage_type is None or storage_type == self.storage_type))
+
+    def describe(self) -> str:
+        return ", ".join(self.candidates) if self.candidates else f"type {self.storage_type}"
+
+
+class Reservation(NamedTuple):
+    node: str
+    memory: int  # Bytes.
+    cores: int
+    group: Optional[str]
+    disks: Dict[str, int]
+    at: float
+
+
+class NoEligibleNode(Exception):
+    pass
+
+
+def node_capacities(resources: Iterable[Dict[str, Any]]) -> Dict[str, NodeCapacity]:
+    """Online nodes and their storages, from a `cluster/resources` listing."""
+    nodes = {}
+    storages: Dict[str, Dict[str, int]] = {}
+    types: Dict[str, Dict[str, str]] = {}
+    for res in resources:
+        if res.get("type") == "node" and res.get("status") == "online":
+            nodes[res["node"]] = res
+        elif res.get("type") == "storage" and res.get("status", "available") == "available":
+            storages.setdefault(res["node"], {})[res["storage"]] = \
+                int(res.get("maxdisk", 0)) - int(res.get("disk", 0))
+            types.setdefault(res["node"], {})[res["storage"]] = res.get("plugintype", "")
+
+    return {name: NodeCapacity(name, int(res.get("maxmem", 0)), int(res.get("mem", 0)),
+                               int(res.get("maxcpu", 1)), float(res.get("cpu", 0)),
+                               storages.get(name, {}), types.get(name, {}))
+            for name, res in nodes.items()}
+
+
+def fit_disks(cap: NodeCapacity, committed: Dict[str, int],
+              disks: Iterable[DiskRequest]) -> Tuple[Optional[Dict[str, int]], List[str]]:
+    """
+    Bytes each storage of the node would get for `disks`, the largest disks
+    going first to the accepting storage with the most free space, like the
+    storage selector does. The second value lists the disks which do not fit.
+    """
+    used: Counter = Counter()
+    missing = []
+    for disk in sorted(disks, key=lambda disk: -disk.size):
+        free = {storage: avail - committed.get(storage, 0) - used[storage]
+                for storage, avail in cap.storage_free.items()
+                if disk.accepts(storage, cap.storage_types.get(storage))}
+        fitting = [storage for storage, avail in free.items() if avail >= disk.size]
+        if not fitting:
+            missing.append(disk.describe())
+            continue
+        used[max(fitting, key=lambda storage: (free[storage], storage))] += disk.size
+    return (None if missing else dict(used)), missing
+
+
+class Placer:
+    """
+    Pick a node for new VMs from the current load of the cluster.
+
+    Nodes which cannot fit the VM memory, vCPUs or disks are ruled out. Among the
+    remaining ones, those hosting the fewest machines of the same
+    anti-affinity group come first, and then the one with the most memory
+    and CPU headroom left after placing the VM, so that the load spreads
+    instead of piling up on the first node.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reservations: Dict[str, Reservation] = {}
+
+    def _live_reservations(self) -> Dict[str, Reservation]:
+        now = time.monotonic()
+        self._reservations = {name: res for name, res in self._reservations.items()
+                              if now - res.at < RESERVATION_TTL}
+        return self._reservations
+
+    def place(self, api, machine: str, *, memory_mib: int, cores: int,
+              disks: Iterable[DiskRequest], eligible: Iterable[str] = (),
+              group: Optional[str] = None,
+              group_members: Optional[Dict[str, str]] = None) -> Tuple[str, str]:
+        """
+        Return the node for `machine` and the reason of the choice.
+
+        `cores` are the vCPUs of the VM. `group_members` maps the other
+        machines of the anti-affinity group which already have a node to
+        that node.
+        """
+        memory = memory_mib * 1024 ** 2
+        disks = list(disks)
+        eligible = set(eligible)
+        with self._lock:
+            capacities = node_capacities(api.cluster.resources.get())
+            reservations = {name: res for name, res in self._live_reservations().items()
+                            if name != machine}
+
+            spread = Counter(node for name, node in (group_members or {}).items()
+                             if name not in reservations)
+            committed_mem: Counter = Counter()
+            committed_cores: Counter = Counter()
+            committed_disk: Dict[str, Counter] = {node: Counter() for node in capacities}
+            for res in reservations.values():
+                committed_mem[res.node] += res.memory
+                committed_cores[res.node] += res.cores
+                committed_disk.setdefault(res.node, Counter()).update(res.disks)
+                if group is not None and res.group == group:
+                    spread[res.node] += 1
+
+            candidates = []
+            rejected = []
+            for cap in capacities.values():
+                if eligible and cap.node not in eligible:
+                    continue
+                free_mem = cap.maxmem - cap.mem - committed_mem[cap.node] - memory
+                if free_mem < 0:
+                    rejected.append(f"{cap.node}: not enough memory")
+                    continue
+                if cores > cap.maxcpu:
+                    rejected.append(f"{cap.node}: only {cap.maxcpu} CPUs")
+                    continue
+                storages, missing = fit_disks(cap, committed_disk[cap.node], disks)
+                if storages is None:
+                    rejected.append(f"{cap.node}: not enough space on {'; '.join(missing)}")
+                    continue
+                cpu_free = 1 - cap.cpu - (committed_cores[cap.node] + cores) / max(cap.maxcpu, 1)
+                headroom = (free_mem / max(cap.maxmem, 1) + cpu_free) / 2
+                candidates.append((spread[cap.node] if group is not None else 0,
+                                   -headroom, cap.node, storages))
+
+            if not candidates:
+                raise NoEligibleNode(
+                    f"No node can host '{machine}' ({memory_mib} MiB, {cores} cores): "
+                    + ("; ".join(rejected) or "no eligible online node"))
+
+            siblings, headroom, node, storages = min(candidates, key=lambda c: c[:3])
+            self._reservations[machine] = Reservation(node, memory, cores, group,
+                                                      storages, time.monotonic())
+
+        reason = f"{-headroom:.0%} headroom left"
+        if group is not None:
+            reason += f", {siblings} other machine(s) of group '{group}' on it"
+        return node, reason
+
+    def release(self, machine: str) -> None:
+        with self._lock:
+            self._reservations.pop(machine, None)
+
+
+_placers_lock = threading.Lock()
+_placers: Dict[ConnectionKey, Placer] = {}
+
+
+def placer_for(key: ConnectionKey) -> Placer:
+    with _placers_lock:
+        if key not in _placers:
+            _placers[key] = Placer()
+        return _placers[key]
@@ -2,11 +2,26 @@
 
 import proxmoxer.backends.https
 from proxmoxer import ProxmoxAPI
-from typing import Optional, List, Dict
-import socket
+from nixops_proxmox.instrumentation import instrument
+from nixops_proxmox.cassette import cassette_from_env
+from nixops_proxmox.async_client import use_async_session
+from typing import Optional, List, Dict, Tuple, NamedTuple, Any
+from contextlib import contextmanager
+import threading
+import asyncio
+import math
+import fcntl
+import json
+import stat
+import time
 import os
 import toml
 
+# Proxmox tickets are valid for two hours, we re-authenticate a bit earlier
+# so that long-running operations never start with an almost-dead ticket.
+TICKET_LIFETIME = 7200
+TICKET_RENEW_MARGIN = 300
+
 
 def get_xdg_config_home() -> str:
     home = os.environ.get('HOME', None)
@@ -18,26 +33,352 @@ def get_xdg_config_home() -> str:
                           os.path.join(home, '.config'))
 
 
+def get_xdg_cache_home() -> str:
+    home = os.environ.get('HOME', None)
+    if home is None:
+        raise RuntimeError("This platform is not POSIX compliant, "
+                           "cannot get $HOME.")
+
+    return os.environ.get('XDG_CACHE_HOME',
+                          os.path.join(home, '.cache'))
+
+
+def get_credentials_file_path() -> str:
+    return os.environ.get('PROXMOX_CREDENTIALS_FILE',
+                          os.path.join(get_xdg_config_home(),
+                                       'proxmox', 'credentials'))
+
+
+class ProfileStore:
+    """
+    Process-wide index of the credentials profiles.
+
+    The credentials file is parsed once and then only `stat`-ed: it is
+    parsed again when its inode, size or modification time changes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._path: Optional[str] = None
+        self._signature: Optional[Tuple[int, int, int, int]] = None
+        self._profiles: Dict[str, Dict[str, Any]] = {}
+        self.loads = 0
+
+    def _refresh(self, path: str) -> Dict[str, Dict[str, Any]]:
+        st = os.stat(path)
+        signature = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+        with self._lock:
+            if path != self._path or signature != self._signature:
+                with open(path, 'r') as cred_file:
+                    self._profiles = toml.load(cred_file)
+                self._path = path
+                self._signature = signature
+                self.loads += 1
+            return self._profiles
+
+    def profiles(self, path: Optional[str] = None) -> Dict[str, Dict[str, Any]]:
+        return self._refresh(path or get_credentials_file_path())
+
+    def has(self, profile_name: str, path: Optional[str] = None) -> bool:
+        try:
+            return profile_name in self.profiles(path)
+        except OSError:
+            return False
+
+    def get(self, profile_name: str, path: Optional[str] = None) -> Dict[str, Any]:
+        path = path or get_credentials_file_path()
+        try:
+            profiles = self.profiles(path)
+        except OSError as exc:
+            print(f'Failed to open credentials file ({path}) '
+                  f'for profile `{profile_name}`, verify if the file exists and/or '
+                  'permissions.')
+            raise exc
+        if profile_name not in profiles:
+            raise RuntimeError(
+                f"{path} has no such profile `{profile_name}`")
+        # Callers may update the profile, never hand out the cached one.
+        return dict(profiles[profile_name])
+
+    def clear(self) -> None:
+        with self._lock:
+            self._path = None
+            self._signature = None
+            self._profiles = {}
+
+
+profile_store = ProfileStore()
+
+
 def read_proxmox_profile(profile_name: str) -> Dict[str, str]:
-    credentials_file_path = os.environ.get('PROXMOX_CREDENTIALS_FILE',
-                                           os.path.join(
-                                               get_xdg_config_home(),
-                                               'proxmox', 'credentials'))
+    return profile_store.get(profile_name)
+
+
+def has_proxmox_profile(profile_name: str) -> bool:
+    return profile_store.has(profile_name)
+
+
+SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_size(size, default_unit: str = 'K') -> int:
+    """
+    Parse a Proxmox size (`32G`, `512M`, `4096`) into bytes.
+
+    Bare numbers are in `default_unit`: kilobytes when allocating volumes,
+    but bytes in the `size=` property of a disk.
+    """
+    text = str(size).strip().upper()
+    unit = default_unit.upper()
+    if text and text[-1] in SIZE_UNITS:
+        unit = text[-1]
+        text = text[:-1]
+    elif text.endswith('B'):
+        unit = 'B'
+        text = text[:-1]
+
+    return int(float(text) * SIZE_UNITS.get(unit, 1))
+
+
+def format_size_kib(size_bytes: int) -> str:
+    return f"{math.ceil(size_bytes / 1024)}K"
+
+
+def get_ticket_cache_path() -> str:
+    return os.environ.get('PROXMOX_TICKET_CACHE_FILE',
+                          os.path.join(get_xdg_config_home(),
+                                       'proxmox', 'tickets'))
+
+
+class CachedTicket(NamedTuple):
+    ticket: str
+    csrf_token: str
+    issued_at: float
+    expires_at: float
+
+
+class TicketCache:
+    """
+    On-disk cache of PVEAuthCookie/CSRF tickets, keyed by profile.
+
+    The file lives next to the credentials file, it is only ever read if it
+    belongs to the current user and is not readable by anybody else, and
+    every access happens under an exclusive lock on a sibling `.lock` file.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or get_ticket_cache_path()
+
+    @contextmanager
+    def _locked(self):
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def _read(self) -> Dict[str, Any]:
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return {}
+
+        if st.st_uid != os.getuid() or stat.S_IMODE(st.st_mode) & 0o077:
+            print(f'Ignoring ticket cache ({self.path}), it must be owned by '
+                  'the current user and not accessible by group or others.')
+            return {}
+
+        try:
+            with open(self.path, 'r') as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+
+    def _write(self, entries: Dict[str, Any]) -> None:
+        tmp_path = self.path + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as cache_file:
+            json.dump(entries, cache_file)
+        os.replace(tmp_path, self.path)
+
+    def load(self, cache_key: str, server_url: str,
+             username: str) -> Optional[CachedTicket]:
+        with self._locked():
+            entry = self._read().get(cache_key)
+
+        if not entry or entry.get('server_url') != server_url \
+                or entry.get('username') != username:
+            return None
+
+        if time.time() >= entry['expires_at']:
+            return None
+
+        return CachedTicket(entry['ticket'], entry['csrf_token'],
+                            entry['issued_at'], entry['expires_at'])
+
+    def store(self, cache_key: str, server_url: str, username: str,
+              ticket: str, csrf_token: str, issued_at: float) -> None:
+        with self._locked():
+            entries = self._read()
+            now = time.time()
+            entries = {key: entry for key, entry in entries.items()
+                       if entry.get('expires_at', 0) > now}
+            entries[cache_key] = {
+                'server_url': server_url,
+                'username': username,
+                'ticket': ticket,
+                'csrf_token': csrf_token,
+                'issued_at': issued_at,
+                'expires_at': issued_at + TICKET_LIFETIME - TICKET_RENEW_MARGIN
+            }
+            self._write(entries)
+
+    def drop(self, cache_key: str) -> None:
+        with self._locked():
+            entries = self._read()
+            if entries.pop(cache_key, None) is not None:
+                self._write(entries)
+
+
+class CachedTicketAuth(proxmoxer.backends.https.ProxmoxHTTPAuth):
+    """`ProxmoxHTTPAuth` resumed from a cached ticket, without logging in."""
+
+    def __init__(self, base_url: str, username: str, cached: CachedTicket,
+                 verify_ssl: bool = False, timeout: int = 5,
+                 service: str = "PVE"):
+        self.base_url = base_url
+        self.username = username
+        self.verify_ssl = verify_ssl
+        self.timeout = timeout
+        # `get_cookies` names the ticket cookie after the service.
+        self.service = service
+        self.pve_auth_ticket = cached.ticket
+        self.csrf_prevention_token = cached.csrf_token
+        # proxmoxer renews tickets based on a monotonic birth time.
+        self.birth_time = proxmoxer.backends.https.get_time() \
+            - (time.time() - cached.issued_at)
+
+
+ConnectionKey = Tuple[str, str, Optional[str], str]
+
+
+def connection_key(
+        server_url: str,
+        username: str,
+        token_name: Optional[str] = None,
+        use_ssh: bool = False) -> ConnectionKey:
+    return (server_url, username, token_name,
+            "ssh_paramiko" if use_ssh else "https")
+
+
+class PooledConnection(NamedTuple):
+    api: ProxmoxAPI
+    authenticated_at: float
+    expires_at: Optional[float]
+
+
+class ConnectionPool:
+    """
+    Process-wide registry of authenticated Proxmox API sessions.
+
+    Every machine talking to the same endpoint with the same identity shares
+    one `ProxmoxAPI` object, hence one login and one keep-alive HTTP session.
+    """
 
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._key_locks: Dict[ConnectionKey, threading.Lock] = {}
+        self._connections: Dict[ConnectionKey, PooledConnection] = {}
+        self.hits = 0
+        self.misses = 0
+        self.reauthentications = 0
+
+    def _lock_for(self, key: ConnectionKey) -> threading.Lock:
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def get(self, key: ConnectionKey, factory) -> ProxmoxAPI:
+        # One lock per key: concurrent machines on the same endpoint wait for
+        # a single login instead of racing each other to the ticket endpoint.
+        with self._lock_for(key):
+            conn = self._connections.get(key)
+            if conn is not None and (conn.expires_at is None
+                                     or time.time() < conn.expires_at):
+                with self._lock:
+                    self.hits += 1
+                return conn.api
+
+            with self._lock:
+                if conn is None:
+                    self.misses += 1
+                else:
+                    self.reauthentications += 1
+
+            conn = factory()
+            self._connections[key] = conn
+            return conn.api
+
+    def invalidate(self, key: ConnectionKey, api: Optional[ProxmoxAPI] = None) -> None:
+        """Drop the connection of `key`, only if it is still `api` when given."""
+        with self._lock_for(key):
+            conn = self._connections.get(key)
+            if conn is not None and (api is None or conn.api is api):
+                del self._connections[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._connections.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "reauthentications": self.reauthentications,
+                "connections": len(self._connections)
+            }
+
+
+connection_pool = ConnectionPool()
+
+
+def _check_connection(api: ProxmoxAPI, server_url: str, username: str) -> None:
+    # check if API is working.
     try:
-        with open(credentials_file_path, 'r') as cred_file:
-            profiles = toml.load(cred_file)
-    except OSError as exc:
-        print(f'Failed to open credentials file ({credentials_file_path}) '
-              'for profile `{profile_name}`, verify if the file exists and/or'
-              'permissions.')
-        raise exc
-    if profile_name not in profiles:
-        raise RuntimeError(
-            f"{credentials_file_path} has no such profile `{profile_name}`")
-    return profiles[profile_name]
+        nodes = api.nodes().get()
+        if not nodes:
+            raise Exception(f"Failed to connect to Proxmox server '{server_url}@{username}' OR empty Proxmox cluster (no nodes found), verify credentials")
+    except proxmoxer.backends.https.AuthenticationError:
+            raise Exception(f"Failed to connect to Proxmox server '{server_url}@{username}', verify credentials (authentication error)")
 
-def connect(
+
+def _resume_from_ticket(server_url: str, username: str,
+                        cached: CachedTicket,
+                        verify_ssl: bool) -> Optional[ProxmoxAPI]:
+    # An empty API token makes proxmoxer build its session without any
+    # network round-trip, we then swap in the ticket authentication.
+    api = ProxmoxAPI(server_url, user=username, token_name='', token_value='',
+                     verify_ssl=verify_ssl, backend='https')
+    auth = CachedTicketAuth(api._backend.get_base_url(), username, cached,
+                            verify_ssl)
+    api._backend.auth = auth
+    api._store["session"].auth = auth
+
+    try:
+        if api.nodes().get():
+            return api
+    except Exception:
+        # Expired, revoked or unusable: whatever the reason, a full login
+        # is the way out.
+        pass
+
+    return None
+
+
+def _open_connection(
         server_url: str,
         username: str,
         *,
@@ -45,7 +386,8 @@ def connect(
         token_name: Optional[str] = None,
         token_value: Optional[str] = None,
         verify_ssl: bool = False,
-        use_ssh: bool = False):
+        use_ssh: bool = False,
+        ticket_cache_key: Optional[str] = None) -> PooledConnection:
 
     kwargs = {
         "host": server_url,
@@ -54,69 +396,225 @@ def connect(
         "backend": "ssh_paramiko" if use_ssh else "https"
     }
 
-    if token_name and token_value and not use_ssh:
+    uses_token = bool(token_name and token_value and not use_ssh)
+    if uses_token:
         kwargs["token_name"] = token_name
         kwargs["token_value"] = token_value
 
     if not use_ssh:
         kwargs['verify_ssl'] = verify_ssl
 
+    # Only password logins produce tickets worth caching.
+    ticket_cache = None
+    if ticket_cache_key and not use_ssh and not uses_token:
+        ticket_cache = TicketCache()
+        cached = ticket_cache.load(ticket_cache_key, server_url, username)
+        if cached is not None:
+            api = _resume_from_ticket(server_url, username, cached, verify_ssl)
+            if api is not None:
+                return PooledConnection(api, cached.issued_at,
+                                        cached.expires_at)
+            # The ticket has been rejected, fall back to a full login.
+            ticket_cache.drop(ticket_cache_key)
 
+    authenticated_at = time.time()
     api = ProxmoxAPI(**kwargs)
+    _check_connection(api, server_url, username)
 
-    # check if API is working.
-    try:
-        nodes = api.nodes().get()
-        if not nodes:
-            raise Exception(f"Failed to connect to Proxmox server '{server_url}@{username}' OR empty Proxmox cluster (no nodes found), verify credentials")
-    except proxmoxer.backends.https.AuthenticationError:
-            raise Exception(f"Failed to connect to Proxmox server '{server_url}@{username}', verify credentials (authentication error)")
+    # API tokens and SSH sessions do not expire, password tickets do.
+    expires_at = None
+    if not use_ssh and not uses_token:
+        expires_at = authenticated_at + TICKET_LIFETIME - TICKET_RENEW_MARGIN
 
-    return api
+    if ticket_cache is not None and ticket_cache_key is not None:
+        ticket, csrf_token = api.get_tokens()
+        if ticket and csrf_token:
+            ticket_cache.store(ticket_cache_key, server_url, username,
+                               ticket, csrf_token, authenticated_at)
 
-def tcp_ping(host, port: int = 22, max_count: int = 20, timeout: int = 3):
-    failed = 0
-    count = 0
-    rtt = []
-    successes = []
-    while count < max_count:
-        success = False
-        count += 1
+    return PooledConnection(api, authenticated_at, expires_at)
 
-        s = socket.socket(
-                socket.AF_INET, socket.SOCK_STREAM)
 
-        s.settimeout(timeout)
+def _renew_on_unauthorized(api: ProxmoxAPI, key: ConnectionKey, factory) -> None:
+    """
+    Evict the pooled connection of `api` as soon as pveproxy refuses its
+    ticket (revoked, or expired early), and retry the request once over a
+    freshly authenticated connection.
+    """
+    session = api._store["session"]
+    request = session.request
 
-        start = time.time()
-        try:
-            s.connect(host, port)
-            s.shutdown(socket.SHUT_RD)
-            success = True
-        except socket.timeout:
-            failed += 1
-        except OSError as e:
-            failed += 1
+    def request_or_renew(method, url, *args, **kwargs):
+        resp = request(method, url, *args, **kwargs)
+        if resp.status_code != 401:
+            return resp
+
+        # Only the first thread hitting the 401 evicts, the others reuse
+        # the connection it opened.
+        connection_pool.invalidate(key, api)
+        fresh = connection_pool.get(key, factory)
+        if fresh is api:
+            return resp
+        return fresh._store["session"]._nixops_unrenewed_request(method, url, *args, **kwargs)
+
+    session._nixops_unrenewed_request = request
+    session.request = request_or_renew
+
+
+def connect(
+        server_url: str,
+        username: str,
+        *,
+        password: Optional[str] = None,
+        token_name: Optional[str] = None,
+        token_value: Optional[str] = None,
+        verify_ssl: bool = False,
+        use_ssh: bool = False,
+        ticket_cache_key: Optional[str] = None):
+    """
+    Return a pooled, authenticated Proxmox API session.
+
+    A session whose ticket gets refused is evicted from the pool, the
+    request is retried once over a freshly authenticated one.
+
+    If `ticket_cache_key` is set (usually the profile name), password tickets
+    are persisted in the on-disk ticket cache and reused by later invocations.
+
+    With `PROXMOX_API_CLIENT=async`, HTTPS requests go through the shared
+    asyncio client instead of one requests session per endpoint.
+    """
+
+    key = connection_key(server_url, username, token_name, use_ssh)
+    cassette = cassette_from_env()
+
+    def factory() -> PooledConnection:
+        if cassette is not None and cassette[0] == "replay":
+            conn = PooledConnection(cassette[1].api(server_url, username), time.time(), None)
+        else:
+            conn = _open_connection(
+                server_url, username,
+                password=password,
+                token_name=token_name, token_value=token_value,
+                verify_ssl=verify_ssl,
+                use_ssh=use_ssh,
+                ticket_cache_key=ticket_cache_key)
+            if os.environ.get("PROXMOX_API_CLIENT") == "async" and not use_ssh:
+                use_async_session(conn.api, key, verify_ssl=verify_ssl)
+            if not use_ssh:
+                _renew_on_unauthorized(conn.api, key, factory)
+            if cassette is not None:
+                cassette[1].wrap(conn.api)
+        if os.environ.get("PROXMOX_API_METRICS") != "off":
+            instrument(conn.api)
+        return conn
+
+    return connection_pool.get(key, factory)
+
+
+class RTTStats(NamedTuple):
+    host: str
+    port: int
+    samples: List[Optional[float]]  # None for a failed connection.
+
+    @property
+    def successes(self) -> List[float]:
+        return [rtt for rtt in self.samples if rtt is not None]
+
+    @property
+    def loss(self) -> float:
+        if not self.samples:
+            return 1.0
+        return 1 - len(self.successes) / len(self.samples)
+
+    def percentile(self, q: float) -> Optional[float]:
+        values = sorted(self.successes)
+        if not values:
+            return None
+        # Nearest-rank percentile, good enough for a handful of samples.
+        rank = math.ceil(q / 100 * len(values))
+        return values[max(0, min(len(values), rank) - 1)]
 
-        elapsed = time.time() - start
-        successes.append(success)
-        rtt.append(elapsed)
+    @property
+    def min(self) -> Optional[float]:
+        return self.percentile(0)
 
-        if count < max_count:
-            time.sleep(1)
+    @property
+    def median(self) -> Optional[float]:
+        return self.percentile(50)
 
-    return rtt, successes
+    @property
+    def p90(self) -> Optional[float]:
+        return self.percentile(90)
 
-def select_fastest_ip_address(ips: List[str]):
+
+async def _tcp_connect_rtt(host: str, port: int, timeout: float) -> Optional[float]:
+    start = time.perf_counter()
+    try:
+        _, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port), timeout)
+    except (asyncio.TimeoutError, OSError):
+        return None
+
+    elapsed = time.perf_counter() - start
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return elapsed
+
+
+async def _probe_host(host: str, port: int, count: int, timeout: float,
+                      interval: float) -> RTTStats:
+    samples: List[Optional[float]] = []
+    for index in range(count):
+        if index:
+            await asyncio.sleep(interval)
+        samples.append(await _tcp_connect_rtt(host, port, timeout))
+    return RTTStats(host, port, samples)
+
+
+async def _probe_hosts(hosts: List[str], port: int, count: int,
+                       timeout: float, interval: float) -> List[RTTStats]:
+    return await asyncio.gather(*(
+        _probe_host(host, port, count, timeout, interval) for host in hosts))
+
+
+def probe_rtts(
+        hosts: List[str],
+        port: int = 22,
+        *,
+        count: int = 5,
+        timeout: float = 3,
+        interval: float = 0.1) -> Dict[str, RTTStats]:
     """
-    Select the fastest & reachable IP address based on TCP ping.
+    Measure the TCP connect round-trip time to all the hosts concurrently.
+
+    Samples of a given host are sequential, hosts are probed in parallel, so
+    the whole probe costs about `count * (rtt + interval)` whatever the
+    number of hosts.
     """
-    delays = {}
-    successes = {}
-    for ip in ips:
-        rtts, succ = tcp_ping(ip)
-        nbSuccess = succ.count(True)
-        delays[ip] = rtts
-        successes[ip] = nbSuccess
+    if not hosts:
+        return {}
+
+    stats = asyncio.run(_probe_hosts(list(hosts), port, count, timeout, interval))
+    return {s.host: s for s in stats}
+
+
+def tcp_ping(host: str, port: int = 22, max_count: int = 5,
+             timeout: float = 3) -> RTTStats:
+    return probe_rtts([host], port, count=max_count, timeout=timeout)[host]
 
-    return sorted(ips, key=lambda ip: (successes[ip], avg(delays[ip])))
+
+def select_fastest_ip_address(ips: List[str], port: int = 22, *,
+                              count: int = 5,
+                              timeout: float = 3) -> List[str]:
+    """
+    Select the fastest & reachable IP addresses based on TCP ping.
+
+    Unreachable addresses are dropped, the others are sorted by packet loss
+    then median round-trip time.
+    """
+    stats = probe_rtts(ips, port, count=count, timeout=timeout)
+    reachable = [ip for ip in ips if stats[ip].successes]
+    return sorted(reachable, key=lambda ip: (stats[ip].loss, stats[ip].median))
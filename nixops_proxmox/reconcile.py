@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+import re
+from typing import Any, Dict, FrozenSet, List, NamedTuple, Optional, Union
+
+# What `hotplug: 1` stands for, and the Proxmox default.
+DEFAULT_HOTPLUG = frozenset({"network", "disk", "usb"})
+
+# Options qemu-server applies to a running VM whatever `hotplug` says.
+ALWAYS_LIVE = {"name", "description", "onboot", "protection", "tags",
+               "hotplug", "cpulimit", "cpuunits", "startup"}
+
+# Values Proxmox assumes for options absent from the configuration.
+DEFAULTS = {
+    "agent": "0",
+    "cores": "1",
+    "cpulimit": "0",
+    "onboot": "0",
+    "protection": "0",
+}
+
+# Property strings whose first value may be given without its key.
+DEFAULT_PROPERTY_KEYS = {"agent": "enabled", "cpu": "cputype"}
+
+NET_KEY_RE = re.compile(r"^net\d+$")
+IPCONFIG_KEY_RE = re.compile(r"^ipconfig\d+$")
+DISK_KEY_RE = re.compile(r"^(scsi|virtio|sata|ide)\d+$")
+
+# Proxmox stores a NIC as `<model>=<mac>,bridge=...`.
+NIC_MODELS = {"e1000", "e1000-82540em", "e1000-82544gc", "e1000-82545em",
+              "e1000e", "i82551", "i82557b", "i82559er", "ne2k_isa",
+              "ne2k_pci", "pcnet", "rtl8139", "virtio", "vmxnet3"}
+
+
+class ConfigChange(NamedTuple):
+    key: str
+    current: Optional[str]
+    wanted: Optional[str]  # None to delete the option.
+    live: bool  # Whether it can be applied without a reboot.
+
+    def __str__(self) -> str:
+        action = "removed" if self.wanted is None else f"{self.current} -> {self.wanted}"
+        return f"{self.key} ({action}, {'live' if self.live else 'on reboot'})"
+
+
+def hotplug_features(value: Optional[Any]) -> FrozenSet[str]:
+    text = "1" if value is None else str(value).strip()
+    if text == "1":
+        return DEFAULT_HOTPLUG
+    if text in ("0", ""):
+        return frozenset()
+    return frozenset(feature.strip() for feature in text.split(",") if feature.strip())
+
+
+def parse_property(value: Any, default_key: Optional[str] = None) -> Dict[str, str]:
+    parsed = {}
+    for part in str(value).split(","):
+        if not part:
+            continue
+        key, sep, val = part.partition("=")
+        if sep:
+            parsed[key] = val
+        else:
+            parsed[default_key or part] = part if default_key else ""
+    return parsed
+
+
+def parse_nic(value: Any) -> Dict[str, str]:
+    parsed = parse_property(value)
+    for model in NIC_MODELS & parsed.keys():
+        parsed["model"] = model
+        parsed["macaddr"] = parsed.pop(model)
+    return parsed
+
+
+def normalize(key: str, value: Any) -> Union[str, Dict[str, str], FrozenSet[str]]:
+    if key == "hotplug":
+        return hotplug_features(value)
+    if NET_KEY_RE.match(key):
+        nic = parse_nic(value)
+        # The MAC address is generated by Proxmox, do not diff on it.
+        nic.pop("macaddr", None)
+        return nic
+    if key in DEFAULT_PROPERTY_KEYS or IPCONFIG_KEY_RE.match(key):
+        return parse_property(value, DEFAULT_PROPERTY_KEYS.get(key))
+    return str(value)
+
+
+def is_live(key: str, hotplug: FrozenSet[str]) -> bool:
+    if key in ALWAYS_LIVE:
+        return True
+    if NET_KEY_RE.match(key):
+        return "network" in hotplug
+    if DISK_KEY_RE.match(key):
+        return "disk" in hotplug
+    if key == "memory":
+        return "memory" in hotplug
+    if key == "vcpus":
+        return "cpu" in hotplug
+    return False
+
+
+def diff_config(current: Dict[str, Any], wanted: Dict[str, Any]) -> List[ConfigChange]:
+    """
+    Minimal set of changes bringing `current` (the VM config, pending values
+    included) to `wanted`. Options set to None in `wanted` are left alone.
+
+    Whether a change is live is decided by the `hotplug` features the VM
+    currently runs with, not the wanted ones.
+    """
+    hotplug = hotplug_features(current.get("hotplug"))
+    changes = []
+    for key, value in wanted.items():
+        if value is None:
+            continue
+        old = current.get(key, DEFAULTS.get(key))
+        if old is not None and normalize(key, old) == normalize(key, value):
+            continue
+        changes.append(ConfigChange(key, None if old is None else str(old), str(value),
+                                    is_live(key, hotplug)))
+
+    # Interfaces which were dropped from the definition.
+    for key in sorted(current):
+        if (NET_KEY_RE.match(key) or IPCONFIG_KEY_RE.match(key)) and key not in wanted:
+            changes.append(ConfigChange(key, str(current[key]), None, is_live(key, hotplug)))
+
+    return changes
+
+
+def config_update(changes: List[ConfigChange], current: Dict[str, Any]) -> Dict[str, str]:
+    """Parameters of the single `config.put` applying `changes`."""
+    params = {}
+    deleted = []
+    for change in changes:
+        if change.wanted is None:
+            deleted.append(change.key)
+            continue
+        value = change.wanted
+        if NET_KEY_RE.match(change.key) and change.key in current:
+            # Keep the MAC address, or the guest sees a brand new NIC.
+            mac = parse_nic(current[change.key]).get("macaddr")
+            if mac and "macaddr" not in parse_nic(value):
+                value = f"{value},macaddr={mac}"
+        params[change.key] = value
+    if deleted:
+        params["delete"] = ",".join(deleted)
+    return params
+
+
+def pending_keys(pending: List[Dict[str, Any]]) -> List[str]:
+    """Options of `qemu/{vmid}/pending` which only apply on the next boot."""
+    return sorted(entry["key"] for entry in pending
+                  if "pending" in entry or entry.get("delete"))
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import re
+import subprocess
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, Hashable, Iterable, List, NamedTuple, Optional
+
+from nixops_proxmox.proxmox_utils import get_xdg_cache_home, ConnectionKey
+
+# Benchmarks are cheap but not free, a week-old measurement is good enough.
+BENCHMARK_TTL = 7 * 24 * 3600
+BENCHMARK_SIZE_MIB = 256
+# Never a real VM id: MAX_VMID of nixops_proxmox.vmid.
+BENCHMARK_VMID = 999999999
+DD_SECONDS_RE = re.compile(r"copied, ([\d.]+) s")
+# Storages whose volumes are files, named after their format.
+FILE_STORAGE_TYPES = {"dir", "nfs", "cifs", "cephfs"}
+# Storages whose volumes have no path the node can write to directly
+# (`pvesm path` returns a URL, or the volumes live on a remote target).
+PATHLESS_STORAGE_TYPES = {"rbd", "iscsi", "iscsidirect", "zfs", "glusterfs"}
+
+
+class StorageChoice(NamedTuple):
+    storage: str
+    reason: str
+
+
+class NoEligibleStorage(Exception):
+    pass
+
+
+def get_benchmark_cache_path() -> str:
+    return os.environ.get('PROXMOX_STORAGE_BENCHMARK_FILE',
+                          os.path.join(get_xdg_cache_home(),
+                                       'proxmox', 'storage-benchmarks.json'))
+
+
+class BenchmarkCache:
+    """Measured write throughputs, in MiB/s, keyed by `node/storage`."""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or get_benchmark_cache_path()
+        self._lock = threading.Lock()
+
+    def _read(self) -> Dict[str, Dict[str, float]]:
+        try:
+            with open(self.path) as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, node: str, storage: str) -> Optional[float]:
+        with self._lock:
+            entry = self._read().get(f"{node}/{storage}")
+        if entry is None or time.time() - entry["measured_at"] > BENCHMARK_TTL:
+            return None
+        return entry["mib_per_s"]
+
+    def put(self, node: str, storage: str, mib_per_s: float) -> None:
+        with self._lock:
+            entries = self._read()
+            entries[f"{node}/{storage}"] = {"mib_per_s": mib_per_s, "measured_at": time.time()}
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, "w") as cache_file:
+                json.dump(entries, cache_file)
+            os.replace(tmp, self.path)
+
+
+def benchmark_storage(node_address: str, storage: str, storage_type: str) -> float:
+    """
+    Measure the direct write throughput of a storage, in MiB/s.
+
+    This runs as root on the node through SSH: a scratch volume is
+    allocated with `pvesm`, written with `dd` and freed.
+    """
+    if storage_type in PATHLESS_STORAGE_TYPES:
+        raise Exception(f"{storage_type} storages have no path to benchmark through")
+    name = f"vm-{BENCHMARK_VMID}-disk-bench"
+    if storage_type in FILE_STORAGE_TYPES:
+        name += ".raw"
+    script = f"""set -e
+volid=$(pvesm alloc {storage} {BENCHMARK_VMID} {name} {BENCHMARK_SIZE_MIB}M | sed -n "s/.*'\\(.*\\)'.*/\\1/p")
+trap 'pvesm free "$volid"' EXIT
+dd if=/dev/zero of="$(pvesm path "$volid")" bs=4M count={BENCHMARK_SIZE_MIB // 4} oflag=direct conv=fsync 2>&1 | tail -n 1
+"""
+    out = subprocess.check_output(
+        ["ssh", "-o", "BatchMode=yes", f"root@{node_address}", "sh"],
+        input=script, text=True, timeout=300)
+    match = DD_SECONDS_RE.search(out)
+    if not match:
+        raise Exception(f"Unexpected benchmark output for {storage} on {node_address}: {out}")
+    return BENCHMARK_SIZE_MIB / max(float(match.group(1)), 1e-3)
+
+
+def node_address(api, node: str) -> str:
+    for entry in api.cluster.status.get():
+        if entry.get("type") == "node" and entry.get("name") == node and entry.get("ip"):
+            return entry["ip"]
+    return node
+
+
+def format_bytes(size: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TiB"
+
+
+class StorageSelector:
+    """
+    Pick the storage of a disk among candidates, by free space or speed.
+
+    Storages picked by this process are reserved until the process exits,
+    so that machines created in parallel do not all see the same free
+    space and pile onto the same storage.
+    """
+
+    def __init__(self, benchmarks: Optional[BenchmarkCache] = None):
+        self.benchmarks = benchmarks or BenchmarkCache()
+        self._lock = threading.Lock()
+        self._reserved: Counter = Counter()
+        self._benchmark_locks: Dict[Hashable, threading.Lock] = {}
+
+    def _throughput(self, api, node: str, storage: str, storage_type: str,
+                    log=None) -> Optional[float]:
+        if storage_type in PATHLESS_STORAGE_TYPES:
+            if log:
+                log(f"not benchmarking storage {storage} on {node}, {storage_type} volumes have no path")
+            return None
+
+        with self._lock:
+            lock = self._benchmark_locks.setdefault((node, storage), threading.Lock())
+        # Machines created in parallel measure a storage once.
+        with lock:
+            mib_per_s = self.benchmarks.get(node, storage)
+            if mib_per_s is None:
+                if log:
+                    log(f"benchmarking storage {storage} on {node}...")
+                try:
+                    mib_per_s = benchmark_storage(node_address(api, node), storage, storage_type)
+                except Exception as e:
+                    if log:
+                        log(f"could not benchmark storage {storage} on {node}: {e}")
+                    return None
+                self.benchmarks.put(node, storage, mib_per_s)
+        return mib_per_s
+
+    def _available(self, node: str, storages: List[Dict[str, Any]], size: int) -> Dict[str, int]:
+        available = {st["storage"]: int(st.get("avail", 0)) - self._reserved[node, st["storage"]]
+                     for st in storages}
+        return {name: avail for name, avail in available.items() if avail >= size}
+
+    def select(self, api, node: str, size: int, *,
+               candidates: Iterable[str] = (), storage_type: Optional[str] = None,
+               benchmark: bool = False, prefer: Optional[str] = None,
+               log=None) -> StorageChoice:
+        """
+        Return the storage to allocate a disk of `size` bytes on.
+
+        Eligible storages are active, accept disk images, are part of
+        `candidates` and of type `storage_type` if set, and have enough
+        space left. `prefer` wins if it is eligible, e.g. the storage an
+        image is imported from.
+        """
+        candidates = list(candidates)
+        storages = []
+        for st in api.nodes(node).storage.get(enabled=1):
+            if candidates and st["storage"] not in candidates:
+                continue
+            if storage_type is not None and st.get("type") != storage_type:
+                continue
+            if not st.get("active") or "images" not in st.get("content", "").split(","):
+                continue
+            storages.append(st)
+        types = {st["storage"]: st.get("type", "") for st in storages}
+
+        with self._lock:
+            eligible = self._available(node, storages, size)
+
+        # Benchmarks take a while, other selections go on meanwhile.
+        measured: Dict[str, float] = {}
+        if prefer not in eligible and benchmark and len(eligible) > 1:
+            speeds = {name: self._throughput(api, node, name, types[name], log) for name in eligible}
+            measured = {name: speed for name, speed in speeds.items() if speed is not None}
+
+        with self._lock:
+            eligible = self._available(node, storages, size)
+            if not eligible:
+                wanted = ", ".join(candidates) if candidates else f"type {storage_type}"
+                raise NoEligibleStorage(
+                    f"No storage among {wanted} on {node} accepts a {format_bytes(size)} disk image")
+
+            measured = {name: speed for name, speed in measured.items() if name in eligible}
+            if prefer in eligible:
+                choice = StorageChoice(prefer, f"same storage as the image, {format_bytes(eligible[prefer])} available")
+            elif measured:
+                name = max(measured, key=lambda n: (measured[n], eligible[n]))
+                choice = StorageChoice(name, f"fastest ({measured[name]:.0f} MiB/s), "
+                                             f"{format_bytes(eligible[name])} available")
+            else:
+                name = max(eligible, key=lambda n: (eligible[n], n))
+                choice = StorageChoice(name, f"most free space, {format_bytes(eligible[name])} available")
+
+            self._reserved[node, choice.storage] += size
+            return choice
+
+
+_selectors_lock = threading.Lock()
+_selectors: Dict[ConnectionKey, StorageSelector] = {}
+
+
+def selector_for(key: ConnectionKey) -> StorageSelector:
+    with _selectors_lock:
+        if key not in _selectors:
+            _selectors[key] = StorageSelector()
+        return _selectors[key]
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+import base64
+import os
+import re
+import shutil
+import socket
+import subprocess
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from cryptography.hazmat.primitives import serialization
+
+STORE_DIR = "/nix/store"
+# Lower is preferred, cache.nixos.org has 40.
+PRIORITY = 10
+# Hash part of a store path, in Nix's base-32 alphabet.
+HASH_PART_RE = re.compile(r"[0-9a-df-np-sv-z]{32}")
+
+
+class PathInfo(NamedTuple):
+    path: str
+    nar_hash: str
+    nar_size: int
+    references: List[str]
+
+
+def query_path_info(path: str) -> PathInfo:
+    def query(flag: str) -> str:
+        return subprocess.check_output(
+            ["nix-store", "--query", flag, path], text=True,
+            stderr=subprocess.DEVNULL).strip()
+
+    return PathInfo(path, query("--hash"), int(query("--size")),
+                    sorted(query("--references").split()))
+
+
+def path_from_hash_part(hash_part: str) -> Optional[str]:
+    """The valid store path with this hash part, asked to the Nix database."""
+    try:
+        path = subprocess.check_output(
+            ["nix", "--extra-experimental-features", "nix-command",
+             "store", "path-from-hash-part", hash_part], text=True,
+            stderr=subprocess.DEVNULL).strip()
+    except subprocess.CalledProcessError:
+        return None
+    return path or None
+
+
+def local_address_for(client_ip: str) -> str:
+    """Address of the deployer on the route to `client_ip`."""
+    family = socket.AF_INET6 if ":" in client_ip else socket.AF_INET
+    with socket.socket(family, socket.SOCK_DGRAM) as probe:
+        # No packet is sent, this only asks the kernel for a route.
+        probe.connect((client_ip, 9))
+        return probe.getsockname()[0]
+
+
+class SigningKey:
+    """Ephemeral ed25519 key, in the formats Nix expects."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._key = Ed25519PrivateKey.generate()
+        public = self._key.public_key().public_bytes(
+            serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+        self.public_key = f"{name}:{base64.b64encode(public).decode()}"
+
+    def sign(self, info: PathInfo) -> str:
+        fingerprint = ";".join([
+            "1", info.path, info.nar_hash, str(info.nar_size),
+            ",".join(info.references)])
+        signature = self._key.sign(fingerprint.encode())
+        return f"{self.name}:{base64.b64encode(signature).decode()}"
+
+
+class SubstituterStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.narinfo_hits = 0
+        self.narinfo_misses = 0
+        self.nars_served = 0
+        self.bytes_served = 0
+
+    def add(self, **counters: int) -> None:
+        with self._lock:
+            for name, value in counters.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def summary(self) -> str:
+        return (f"{self.narinfo_hits} hits, {self.narinfo_misses} misses, "
+                f"{self.nars_served} NARs / {self.bytes_served / 1024 ** 2:.1f} MiB served")
+
+
+class LocalBinaryCache:
+    """
+    Minimal binary cache serving NARs straight from the deployer's store.
+
+    Virtual machines installing in parallel all fetch the store paths the
+    deployer already has from it, through the LAN, instead of each of them
+    downloading the same paths from the upstream caches. The cache is not
+    authenticated: it only listens on the addresses routing to the machines.
+    """
+
+    def __init__(self):
+        self.key = SigningKey(f"nixops-proxmox-{socket.gethostname()}-1")
+        self.stats = SubstituterStats()
+        self._lock = threading.Lock()
+        self._infos: Dict[str, PathInfo] = {}
+        self._servers: Dict[str, Tuple[ThreadingHTTPServer, threading.Thread]] = {}
+
+    def path_info(self, hash_part: str) -> Optional[PathInfo]:
+        if hash_part in self._infos:
+            return self._infos[hash_part]
+        if not HASH_PART_RE.fullmatch(hash_part):
+            return None
+
+        # Misses are not remembered: the path may be built in the meantime.
+        path = path_from_hash_part(hash_part)
+        if path is None or path.endswith(".drv"):
+            return None
+        try:
+            info = query_path_info(path)
+        except subprocess.CalledProcessError:
+            # Not a valid path (yet), e.g. a build in progress.
+            return None
+        self._infos[hash_part] = info
+        return info
+
+    def narinfo(self, info: PathInfo) -> str:
+        hash_part = os.path.basename(info.path).split("-", 1)[0]
+        return "".join([
+            f"StorePath: {info.path}\n",
+            f"URL: nar/{hash_part}.nar\n",
+            "Compression: none\n",
+            f"NarHash: {info.nar_hash}\n",
+            f"NarSize: {info.nar_size}\n",
+            f"References: {' '.join(os.path.basename(r) for r in info.references)}\n",
+            f"Sig: {self.key.sign(info)}\n",
+        ])
+
+    def _handler(self):
+        cache = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status: int, body: bytes = b"",
+                      content_type: str = "text/plain", length: Optional[int] = None):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body) if length is None else length))
+                self.end_headers()
+                if self.command != "HEAD" and body:
+                    self.wfile.write(body)
+
+            def do_HEAD(self):
+                self.do_GET()
+
+            def do_GET(self):
+                name = self.path.lstrip("/")
+                if name == "nix-cache-info":
+                    self._send(200, f"StoreDir: {STORE_DIR}\nWantMassQuery: 1\nPriority: {PRIORITY}\n".encode())
+                elif name.endswith(".narinfo"):
+                    info = cache.path_info(name[:-len(".narinfo")])
+                    if info is None:
+                        cache.stats.add(narinfo_misses=1)
+                        self._send(404)
+                        return
+                    cache.stats.add(narinfo_hits=1)
+                    self._send(200, cache.narinfo(info).encode(), "text/x-nix-narinfo")
+                elif name.startswith("nar/") and name.endswith(".nar"):
+                    info = cache.path_info(name[len("nar/"):-len(".nar")])
+                    if info is None:
+                        self._send(404)
+                        return
+                    self._send(200, content_type="application/x-nix-nar", length=info.nar_size)
+                    if self.command == "HEAD":
+                        return
+                    dump = subprocess.Popen(["nix-store", "--dump", info.path],
+                                            stdout=subprocess.PIPE)
+                    assert dump.stdout is not None
+                    try:
+                        shutil.copyfileobj(dump.stdout, self.wfile)
+                    finally:
+                        dump.stdout.close()
+                        dump.wait()
+                    cache.stats.add(nars_served=1, bytes_served=info.nar_size)
+                else:
+                    self._send(404)
+
+        return Handler
+
+    def _listen(self, address: str) -> ThreadingHTTPServer:
+        class Server(ThreadingHTTPServer):
+            address_family = socket.AF_INET6 if ":" in address else socket.AF_INET
+            daemon_threads = True
+
+        server = Server((address, 0), self._handler())
+        thread = threading.Thread(target=server.serve_forever,
+                                  name=f"nixops-proxmox-substituter-{address}",
+                                  daemon=True)
+        thread.start()
+        self._servers[address] = (server, thread)
+        return server
+
+    def stop(self) -> None:
+        with self._lock:
+            servers, self._servers = self._servers, {}
+        for server, _ in servers.values():
+            server.shutdown()
+            server.server_close()
+
+    def url_for(self, client_ip: str) -> str:
+        """
+        URL of the cache as reachable from `client_ip`, listening on the
+        address of the route to it if not already.
+        """
+        local = local_address_for(client_ip)
+        with self._lock:
+            server = self._servers[local][0] if local in self._servers else self._listen(local)
+        host = f"[{local}]" if ":" in local else local
+        return f"http://{host}:{server.server_address[1]}"
+
+
+class SharedSubstituter:
+    """Reference-counted cache, running while at least one machine installs."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._users = 0
+        self.cache: Optional[LocalBinaryCache] = None
+
+    def acquire(self) -> LocalBinaryCache:
+        with self._lock:
+            if self.cache is None:
+                self.cache = LocalBinaryCache()
+            self._users += 1
+            return self.cache
+
+    def release(self, log=None) -> None:
+        with self._lock:
+            self._users -= 1
+            if self._users == 0 and self.cache is not None:
+                self.cache.stop()
+                if log:
+                    log(f"deployer substituter: {self.cache.stats.summary()}")
+                self.cache = None
+
+
+shared_substituter = SharedSubstituter()
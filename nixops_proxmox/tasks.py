@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+import random
+import time
+from typing import Optional, List, Dict, Any, Iterable, Callable, NamedTuple
+
+from nixops_proxmox import timing
+
+
+class Upid(NamedTuple):
+    node: str
+    type: str
+    id: str
+    user: str
+
+
+def parse_upid(upid: str) -> Upid:
+    # UPID:$node:$pid:$pstart:$starttime:$type:$id:$user:
+    parts = upid.split(":")
+    if len(parts) < 8 or parts[0] != "UPID":
+        raise ValueError(f"'{upid}' is not a valid Proxmox task identifier")
+
+    return Upid(node=parts[1], type=parts[5], id=parts[6], user=parts[7])
+
+
+class TaskFailed(Exception):
+    def __init__(self, upid: str, exitstatus: str, log: List[str]):
+        self.upid = upid
+        self.exitstatus = exitstatus
+        self.log = log
+        tail = "\n".join(log)
+        super().__init__(f"Proxmox task {upid} failed: {exitstatus}\n{tail}")
+
+
+class TaskTimeout(Exception):
+    def __init__(self, upids: Iterable[str], timeout: float):
+        self.upids = list(upids)
+        super().__init__(
+            f"Timed out after {timeout}s waiting for Proxmox task(s) {', '.join(self.upids)}")
+
+
+class Backoff:
+    """
+    Exponential backoff with jitter.
+
+    Starts short so that operations finishing fast are noticed quickly, and
+    grows so that long-running ones are not polled needlessly.
+    """
+
+    def __init__(self, initial: float = 0.2, maximum: float = 5.0,
+                 factor: float = 1.6):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.current = initial
+
+    def reset(self) -> None:
+        self.current = self.initial
+
+    def next_delay(self) -> float:
+        delay = random.uniform(self.current / 2, self.current)
+        self.current = min(self.maximum, self.current * self.factor)
+        return delay
+
+    def sleep(self, deadline: Optional[float] = None) -> None:
+        delay = self.next_delay()
+        if deadline is not None:
+            delay = max(0.0, min(delay, deadline - time.monotonic()))
+        timing.sleep(delay)
+
+
+def task_status(api, upid: str) -> Dict[str, Any]:
+    return api.nodes(parse_upid(upid).node).tasks(upid).status.get()
+
+
+def task_log_tail(api, upid: str, lines: int = 20) -> List[str]:
+    try:
+        log = api.nodes(parse_upid(upid).node).tasks(upid).log.get(limit=1000)
+    except Exception:
+        return []
+
+    return [entry.get("t", "") for entry in log][-lines:]
+
+
+def has_warnings(status: Dict[str, Any]) -> bool:
+    return str(status.get("exitstatus", "")).startswith("WARNINGS")
+
+
+def is_successful(status: Dict[str, Any]) -> bool:
+    # Tasks that succeeded but logged warnings end on `WARNINGS: <count>`.
+    return status.get("exitstatus") == "OK" or has_warnings(status)
+
+
+def warning_lines(log: List[str]) -> List[str]:
+    return [line for line in log if line.startswith("WARN")] or log[-20:]
+
+
+def task_warnings(api, upid: str) -> List[str]:
+    return warning_lines(task_log_tail(api, upid, lines=1000))
+
+
+def wait_for_tasks(
+        api,
+        upids: Iterable[str],
+        *,
+        timeout: Optional[float] = None,
+        raise_on_failure: bool = True,
+        backoff: Optional[Backoff] = None,
+        callback: Optional[Callable[[], None]] = None,
+        warn: Optional[Callable[[str], None]] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    Wait until all the tasks are stopped, polling only the ones still running.
+
+    Returns the final status of every task, keyed by UPID. The final status
+    carries `exitstatus` and, for failed tasks, a `log` tail. For tasks that
+    succeeded with warnings, `log` holds the warnings, also passed to `warn`.
+    """
+    pending = [upid for upid in upids if upid]
+    results: Dict[str, Dict[str, Any]] = {}
+    backoff = backoff or Backoff()
+    deadline = time.monotonic() + timeout if timeout is not None else None
+
+    while pending:
+        still_running = []
+        for upid in pending:
+            status = task_status(api, upid)
+            if status.get("status") == "stopped":
+                if has_warnings(status):
+                    status["log"] = task_warnings(api, upid)
+                    if warn:
+                        warn(f"Proxmox task {upid} ended with {status['exitstatus']}:\n"
+                             + "\n".join(status["log"]))
+                elif not is_successful(status):
+                    status["log"] = task_log_tail(api, upid)
+                results[upid] = status
+            else:
+                still_running.append(upid)
+        pending = still_running
+
+        if not pending:
+            break
+
+        if timeout is not None and deadline is not None and time.monotonic() >= deadline:
+            raise TaskTimeout(pending, timeout)
+
+        if callback:
+            callback()
+        backoff.sleep(deadline)
+
+    if raise_on_failure:
+        for upid, status in results.items():
+            if not is_successful(status):
+                raise TaskFailed(upid, status.get("exitstatus", "unknown"),
+                                 status.get("log", []))
+
+    return results
+
+
+def wait_for_task(api, upid: Optional[str], **kwargs) -> Optional[Dict[str, Any]]:
+    """
+    Wait for a single task, see `wait_for_tasks`.
+
+    Some API calls return nothing when there is nothing to do, in that case
+    there is nothing to wait for either.
+    """
+    if not upid:
+        return None
+
+    return wait_for_tasks(api, [upid], **kwargs)[upid]
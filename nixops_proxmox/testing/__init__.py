@@ -0,0 +1,4 @@
+# -*- coding: utf-8 -*-
+from nixops_proxmox.testing.fake_pve import FakeCluster, FakeProxmox
+
+__all__ = ["FakeCluster", "FakeProxmox"]
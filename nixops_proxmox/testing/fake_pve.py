@@ -0,0 +1,660 @@
+# -*- coding: utf-8 -*-
+"""
+In-process fake of pveproxy, to exercise and measure the backend offline.
+
+It implements the subset of the Proxmox VE API the backend uses, over
+HTTPS with a throwaway self-signed certificate, with a configurable
+per-request latency, task duration and guest boot time:
+
+    with FakeProxmox(nodes=3, latency=0.005, task_duration=0.2) as pve:
+        api = ProxmoxAPI(pve.host, user="root@pam", password="fake",
+                         verify_ssl=False)
+
+VMs are plain records: they boot instantly once their start task is over,
+and their guest agent answers after `boot_time` seconds with canned
+results, enough for the clone/disk image provisioning paths. Tickets are
+checked: the ones not issued by the server, or revoked, are refused.
+"""
+import email.parser
+import email.policy
+import hashlib
+import ipaddress
+import json
+import os
+import re
+import secrets
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+from collections import Counter
+from http.cookies import SimpleCookie
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from nixops_proxmox.instrumentation import normalize_path
+
+GIB = 1024 ** 3
+STEP_MARKER_RE = re.compile(r"printf '\\n%s %d %d\\n' (__nixops_step_[0-9a-f]+) (\d+) \"\$__rc\"")
+FAKE_HOST_KEY = "ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIFakeHostKeyOfAFakeProxmoxGuestAgentVM root@fake"
+
+
+class FakeError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class FakeVM:
+    def __init__(self, vmid: int, node: str, config: Dict[str, Any]):
+        self.vmid = vmid
+        self.node = node
+        self.config = config
+        self.status = "stopped"
+        self.started_at: Optional[float] = None
+        # Created from an install ISO: the guest runs the live CD.
+        self.live_cd = "cdrom" in config
+
+    @property
+    def template(self) -> bool:
+        return bool(int(self.config.get("template", 0)))
+
+    def resource(self) -> Dict[str, Any]:
+        return {"id": f"qemu/{self.vmid}", "type": "qemu", "vmid": self.vmid,
+                "node": self.node, "name": self.config.get("name", f"VM {self.vmid}"),
+                "status": self.status, "template": int(self.template),
+                "maxmem": int(self.config.get("memory", 512)) * 1024 ** 2,
+                "maxcpu": int(self.config.get("cores", 1))}
+
+
+class FakeTask:
+    def __init__(self, upid: str, duration: float, action: Optional[Callable[[float], None]],
+                 warnings: Iterable[str] = ()):
+        self.upid = upid
+        self.done_at = time.monotonic() + duration
+        self.action = action
+        self.warnings = list(warnings)
+        self.exitstatus: Optional[str] = None
+
+
+class FakeCluster:
+    """The state behind the fake API, safe to use from the server threads."""
+
+    def __init__(self, nodes: int = 1, *, storages: Optional[Dict[str, str]] = None,
+                 pools: Tuple[str, ...] = (), task_duration: float = 0.1,
+                 boot_time: float = 0.2, node_memory_gib: int = 256,
+                 node_cpus: int = 64, storage_gib: int = 4096):
+        self.lock = threading.RLock()
+        self.nodes = [f"pve{index + 1}" for index in range(nodes)]
+        self.storages = storages or {"local": "dir", "local-lvm": "lvmthin"}
+        self.storage_size = storage_gib * GIB
+        self.node_memory = node_memory_gib * GIB
+        self.node_cpus = node_cpus
+        self.pools = list(pools)
+        self.task_duration = task_duration
+        self.boot_time = boot_time
+        self.vms: Dict[int, FakeVM] = {}
+        self.volumes: Dict[str, int] = {}  # volid -> size in bytes.
+        self.tasks: Dict[str, FakeTask] = {}
+        self.exec_results: Dict[Tuple[int, int], Dict[str, Any]] = {}
+        self.next_pid = 1000
+        self.tickets: Set[str] = set()
+        self.calls: Counter = Counter()
+
+    # Templates ----------------------------------------------------------
+
+    def add_template(self, vmid: int, node: Optional[str] = None,
+                     disk_gib: int = 8, storage: str = "local-lvm") -> None:
+        """A pre-installed NixOS template, as made by `qm template`."""
+        with self.lock:
+            volid = f"{storage}:base-{vmid}-disk-0"
+            self.volumes[volid] = disk_gib * GIB
+            vm = FakeVM(vmid, node or self.nodes[0], {
+                "name": f"nixos-template-{vmid}", "template": 1, "memory": 1024,
+                "cores": 1, "agent": "1", "scsi0": f"{volid},size={disk_gib}G"})
+            self.vms[vmid] = vm
+
+    # Tasks --------------------------------------------------------------
+
+    def task(self, node: str, kind: str, vmid: Any,
+             action: Optional[Callable[[float], None]] = None,
+             warnings: Iterable[str] = ()) -> str:
+        """
+        Start a task, `action` runs with its completion time once it is over.
+        A task with `warnings` logs them and ends on `WARNINGS: <count>`.
+        """
+        upid = (f"UPID:{node}:{os.getpid():08X}:{secrets.randbelow(1 << 32):08X}:"
+                f"{int(time.time()):08X}:{kind}:{vmid}:root@pam:")
+        self.tasks[upid] = FakeTask(upid, self.task_duration, action, warnings)
+        return upid
+
+    def settle(self) -> None:
+        """Run the actions of the tasks which are over, tasks progress lazily."""
+        now = time.monotonic()
+        for task in self.tasks.values():
+            if task.exitstatus is None and now >= task.done_at:
+                try:
+                    if task.action is not None:
+                        task.action(task.done_at)
+                    task.exitstatus = f"WARNINGS: {len(task.warnings)}" if task.warnings else "OK"
+                except FakeError as e:
+                    task.exitstatus = str(e)
+
+    # Lookups ------------------------------------------------------------
+
+    def vm(self, node: str, vmid: Any) -> FakeVM:
+        vm = self.vms.get(int(vmid))
+        if vm is None or vm.node != node:
+            raise FakeError(500, f"Configuration file 'nodes/{node}/qemu-server/{vmid}.conf' does not exist")
+        return vm
+
+    def agent_ready(self, vm: FakeVM) -> bool:
+        return (vm.status == "running" and vm.started_at is not None
+                and time.monotonic() - vm.started_at >= self.boot_time)
+
+    def storage_used(self, storage: str) -> int:
+        return sum(size for volid, size in self.volumes.items()
+                   if volid.startswith(f"{storage}:"))
+
+    def next_vmid(self) -> int:
+        vmid = 100
+        while vmid in self.vms:
+            vmid += 1
+        return vmid
+
+    def start(self, vm: FakeVM, at: float) -> None:
+        vm.status = "running"
+        vm.started_at = at
+
+    def stop(self, vm: FakeVM, at: float) -> None:
+        vm.status = "stopped"
+        vm.started_at = None
+
+
+def parse_size_bytes(value: str) -> int:
+    match = re.search(r"(\d+)([KMGT]?)", value)
+    if not match:
+        return 0
+    number, unit = int(match.group(1)), match.group(2) or "K"
+    return number * {"K": 1024, "M": 1024 ** 2, "G": GIB, "T": 1024 * GIB}[unit]
+
+
+def disk_index(key: str) -> str:
+    """`scsi1` -> `1`."""
+    return re.sub(r"\D", "", key)
+
+
+Route = Tuple[str, "re.Pattern[str]", Callable[..., Any]]
+
+
+class FakeProxmoxAPI:
+    """Request dispatching, one method per endpoint of the API."""
+
+    def __init__(self, cluster: FakeCluster):
+        self.cluster = cluster
+        node = r"(?P<node>[^/]+)"
+        vmid = r"(?P<vmid>\d+)"
+        qemu = rf"/nodes/{node}/qemu/{vmid}"
+        routes: List[Tuple[str, str, Callable[..., Any]]] = [
+            ("POST", r"/access/ticket", self.ticket),
+            ("GET", r"/version", self.version),
+            ("GET", r"/nodes", self.list_nodes),
+            ("GET", r"/pools", self.list_pools),
+            ("GET", r"/cluster/nextid", self.nextid),
+            ("GET", r"/cluster/resources", self.resources),
+            ("GET", r"/cluster/status", self.cluster_status),
+            ("GET", rf"/nodes/{node}/storage", self.list_storages),
+            ("GET", rf"/nodes/{node}/storage/(?P<storage>[^/]+)/content", self.list_content),
+            ("POST", rf"/nodes/{node}/storage/(?P<storage>[^/]+)/content", self.alloc),
+            ("DELETE", rf"/nodes/{node}/storage/(?P<storage>[^/]+)/content/(?P<volid>[^/]+)", self.free),
+            ("POST", rf"/nodes/{node}/storage/(?P<storage>[^/]+)/upload", self.upload),
+            ("GET", rf"/nodes/{node}/tasks/(?P<upid>[^/]+)/status", self.task_status),
+            ("GET", rf"/nodes/{node}/tasks/(?P<upid>[^/]+)/log", self.task_log),
+            ("POST", rf"/nodes/{node}/qemu", self.create_vm),
+            ("DELETE", qemu, self.delete_vm),
+            ("GET", rf"{qemu}/config", self.get_config),
+            ("PUT", rf"{qemu}/config", self.put_config),
+            ("POST", rf"{qemu}/config", self.post_config),
+            ("GET", rf"{qemu}/pending", self.pending),
+            ("PUT", rf"{qemu}/resize", self.resize),
+            ("POST", rf"{qemu}/clone", self.clone),
+            ("GET", rf"{qemu}/status/current", self.current_status),
+            ("POST", rf"{qemu}/status/(?P<action>start|stop|shutdown|reboot|reset)", self.vm_action),
+            ("POST", rf"{qemu}/agent/exec", self.agent_exec),
+            ("GET", rf"{qemu}/agent/exec-status", self.agent_exec_status),
+            ("POST", rf"{qemu}/agent/file-write", self.agent_file_write),
+            ("POST", rf"{qemu}/agent/ping", self.agent_ping),
+            ("GET", rf"{qemu}/agent/network-get-interfaces", self.agent_interfaces),
+        ]
+        self.routes: List[Route] = [(method, re.compile(f"^{pattern}$"), handler)
+                                    for method, pattern, handler in routes]
+
+    def dispatch(self, method: str, path: str, params: Dict[str, Any]) -> Any:
+        for route_method, pattern, handler in self.routes:
+            match = pattern.match(path)
+            if match and route_method == method:
+                with self.cluster.lock:
+                    self.cluster.calls[method, normalize_path(path)] += 1
+                    self.cluster.settle()
+                    return handler(params, **{key: unquote(value)
+                                              for key, value in match.groupdict().items()})
+        raise FakeError(501, f"Method '{method} {path}' not implemented")
+
+    # Access and cluster -------------------------------------------------
+
+    def ticket(self, params):
+        ticket = f"PVE:{params.get('username')}:{secrets.token_hex(16)}"
+        self.cluster.tickets.add(ticket)
+        return {"ticket": ticket, "CSRFPreventionToken": secrets.token_hex(16),
+                "username": params.get("username")}
+
+    def version(self, params):
+        return {"version": "8.2.0", "release": "8.2", "repoid": "fake"}
+
+    def list_nodes(self, params):
+        return [{"node": node, "status": "online", "type": "node",
+                 "maxmem": self.cluster.node_memory, "maxcpu": self.cluster.node_cpus}
+                for node in self.cluster.nodes]
+
+    def list_pools(self, params):
+        return [{"poolid": pool} for pool in self.cluster.pools]
+
+    def nextid(self, params):
+        return str(self.cluster.next_vmid())
+
+    def resources(self, params):
+        kind = params.get("type")
+        result: List[Dict[str, Any]] = []
+        if kind in (None, "vm"):
+            result.extend(vm.resource() for vm in self.cluster.vms.values())
+        if kind in (None, "node"):
+            for node in self.cluster.nodes:
+                running = [vm for vm in self.cluster.vms.values()
+                           if vm.node == node and vm.status == "running"]
+                result.append({"id": f"node/{node}", "type": "node", "node": node,
+                               "status": "online", "maxmem": self.cluster.node_memory,
+                               "mem": sum(vm.resource()["maxmem"] for vm in running),
+                               "maxcpu": self.cluster.node_cpus,
+                               "cpu": min(1.0, len(running) / self.cluster.node_cpus)})
+        if kind in (None, "storage"):
+            for node in self.cluster.nodes:
+                for storage in self.cluster.storages:
+                    result.append({"id": f"storage/{node}/{storage}", "type": "storage",
+                                   "node": node, "storage": storage, "status": "available",
+                                   "plugintype": self.cluster.storages[storage],
+                                   "maxdisk": self.cluster.storage_size,
+                                   "disk": self.cluster.storage_used(storage)})
+        return result
+
+    def cluster_status(self, params):
+        return [{"type": "cluster", "name": "fake", "quorate": 1}] + [
+            {"type": "node", "name": node, "ip": "127.0.0.1", "online": 1}
+            for node in self.cluster.nodes]
+
+    # Storage ------------------------------------------------------------
+
+    def list_storages(self, params, node):
+        result = []
+        for storage, storage_type in self.cluster.storages.items():
+            used = self.cluster.storage_used(storage)
+            content = "images,rootdir" if storage_type != "dir" else "images,iso,vztmpl,import"
+            if params.get("content") and params["content"] not in content.split(","):
+                continue
+            result.append({"storage": storage, "type": storage_type, "content": content,
+                           "active": 1, "enabled": 1, "shared": 0,
+                           "total": self.cluster.storage_size, "used": used,
+                           "avail": self.cluster.storage_size - used})
+        return result
+
+    def list_content(self, params, node, storage):
+        content = params.get("content")
+        return [{"volid": volid, "size": size,
+                 "content": "import" if ":import/" in volid else "images"}
+                for volid, size in self.cluster.volumes.items()
+                if volid.startswith(f"{storage}:")
+                and (content is None or (content == "import") == (":import/" in volid))]
+
+    def alloc(self, params, node, storage):
+        volid = f"{storage}:{params['filename']}"
+        if volid in self.cluster.volumes:
+            raise FakeError(500, f"volume '{volid}' already exists")
+        self.cluster.volumes[volid] = parse_size_bytes(str(params.get("size", "0")))
+        return volid
+
+    def free(self, params, node, storage, volid):
+        if self.cluster.volumes.pop(volid, None) is None:
+            raise FakeError(500, f"volume '{volid}' does not exist")
+        return None
+
+    def upload(self, params, node, storage):
+        name, data = params["filename"]
+        volid = f"{storage}:{params['content']}/{name}"
+        if params.get("checksum") and hashlib.sha256(data).hexdigest() != params["checksum"]:
+            raise FakeError(500, f"checksum mismatch for '{name}'")
+
+        def store(at):
+            self.cluster.volumes[volid] = len(data)
+
+        return self.cluster.task(node, "imgcopy", None, action=store)
+
+    # Tasks --------------------------------------------------------------
+
+    def task_status(self, params, node, upid):
+        task = self.cluster.tasks.get(upid)
+        if task is None:
+            raise FakeError(500, f"no such task '{upid}'")
+        if task.exitstatus is None:
+            return {"upid": upid, "node": node, "status": "running"}
+        return {"upid": upid, "node": node, "status": "stopped", "exitstatus": task.exitstatus}
+
+    def task_log(self, params, node, upid):
+        task = self.cluster.tasks.get(upid)
+        if task is None:
+            return [{"n": 1, "t": "no such task"}]
+        lines = [f"WARN: {warning}" for warning in task.warnings] if task.exitstatus else []
+        lines.append(f"TASK {task.exitstatus}" if task.exitstatus else "running")
+        return [{"n": index + 1, "t": line} for index, line in enumerate(lines)]
+
+    # VMs ----------------------------------------------------------------
+
+    def create_vm(self, params, node):
+        vmid = int(params["vmid"])
+        if vmid in self.cluster.vms:
+            raise FakeError(500, f"unable to create VM {vmid} - VM {vmid} already exists on node '{node}'")
+        config = {key: value for key, value in params.items()
+                  if key not in ("vmid", "start", "unique", "archive", "pool")}
+        for key, value in list(config.items()):
+            # `storage:size` allocations and `import-from` imports.
+            match = re.match(r"^(?:file=)?([^:,=]+):(\d+)(,.*|$)", str(value))
+            if re.match(r"^(scsi|virtio|sata|ide)\d+$", key) and match:
+                storage, size_gib, rest = match.groups()
+                volid = f"{storage}:vm-{vmid}-disk-{disk_index(key)}"
+                self.cluster.volumes[volid] = int(size_gib) * GIB or 8 * GIB
+                config[key] = f"{volid},size={int(size_gib) or 8}G"
+            elif re.match(r"^(scsi|virtio|sata|ide)\d+$", key):
+                config[key] = re.sub(r"^file=", "", str(value))
+        vm = FakeVM(vmid, node, config)
+        self.cluster.vms[vmid] = vm
+        start = str(params.get("start", "0")) == "1"
+        return self.cluster.task(node, "qmcreate", vmid,
+                                 (lambda at: self.cluster.start(vm, at)) if start else None)
+
+    def delete_vm(self, params, node, vmid):
+        vm = self.cluster.vm(node, vmid)
+        if vm.status != "stopped":
+            raise FakeError(500, f"VM {vmid} is running - destroy failed")
+
+        def destroy(at):
+            self.cluster.vms.pop(vm.vmid, None)
+            for volid in [v for v in self.cluster.volumes if f"-{vm.vmid}-disk-" in v]:
+                del self.cluster.volumes[volid]
+        return self.cluster.task(node, "qmdestroy", vmid, destroy)
+
+    def get_config(self, params, node, vmid):
+        vm = self.cluster.vm(node, vmid)
+        return dict(vm.config, digest=secrets.token_hex(20))
+
+    def put_config(self, params, node, vmid):
+        vm = self.cluster.vm(node, vmid)
+        for key in filter(None, str(params.pop("delete", "")).split(",")):
+            vm.config.pop(key, None)
+        for key, value in params.items():
+            match = re.match(r"^([^:,=]+):(\d+)$", str(value))
+            if re.match(r"^(scsi|virtio|sata|ide)\d+$", key) and match:
+                volid = f"{match.group(1)}:vm-{vm.vmid}-disk-{disk_index(key)}"
+                self.cluster.volumes[volid] = int(match.group(2)) * GIB
+                value = f"{volid},size={match.group(2)}G"
+            vm.config[key] = value
+        return None
+
+    def post_config(self, params, node, vmid):
+        self.put_config(params, node, vmid)
+        return self.cluster.task(node, "qmconfig", vmid)
+
+    def pending(self, params, node, vmid):
+        vm = self.cluster.vm(node, vmid)
+        return [{"key": key, "value": value} for key, value in vm.config.items()]
+
+    def resize(self, params, node, vmid):
+        vm = self.cluster.vm(node, vmid)
+        disk = params["disk"]
+        if disk not in vm.config:
+            raise FakeError(500, f"disk '{disk}' does not exist")
+        size = parse_size_bytes(str(params["size"]).lstrip("+"))
+        volid = vm.config[disk].split(",")[0]
+        self.cluster.volumes[volid] = size
+        vm.config[disk] = re.sub(r"size=[^,]+", f"size={size // 1024}K", vm.config[disk])
+        return None
+
+    def clone(self, params, node, vmid):
+        template = self.cluster.vm(node, vmid)
+        newid = int(params["newid"])
+        if newid in self.cluster.vms:
+            raise FakeError(500, f"unable to create VM {newid}: config file already exists")
+        target = params.get("target", node)
+        config = {key: value for key, value in template.config.items() if key != "template"}
+        config["name"] = params.get("name", f"Copy-of-VM-{template.config.get('name')}")
+        for key, value in list(config.items()):
+            if re.match(r"^(scsi|virtio|sata|ide)\d+$", key):
+                storage = value.split(":")[0]
+                volid = f"{storage}:vm-{newid}-disk-{disk_index(key)}"
+                self.cluster.volumes[volid] = self.cluster.volumes.get(value.split(",")[0], 8 * GIB)
+                config[key] = re.sub(r"^[^,]+", volid, value)
+        # Locked until the clone task is over, as with Proxmox.
+        clone = FakeVM(newid, target, dict(config, lock="clone"))
+        self.cluster.vms[newid] = clone
+        return self.cluster.task(node, "qmclone", vmid, lambda at: clone.config.pop("lock", None))
+
+    def current_status(self, params, node, vmid):
+        vm = self.cluster.vm(node, vmid)
+        return dict(vm.resource(), agent=1 if str(vm.config.get("agent", "0"))[:1] in ("1", "e") else 0,
+                    qmpstatus=vm.status)
+
+    def vm_action(self, params, node, vmid, action):
+        vm = self.cluster.vm(node, vmid)
+        if action == "start":
+            if vm.template:
+                raise FakeError(500, "you can't start a vm if it's a template")
+            return self.cluster.task(node, "qmstart", vmid, lambda at: self.cluster.start(vm, at))
+        if action in ("stop", "shutdown"):
+            return self.cluster.task(node, f"qm{action}", vmid, lambda at: self.cluster.stop(vm, at))
+
+        def restart(at):
+            vm.live_cd = False
+            self.cluster.start(vm, at)
+        return self.cluster.task(node, f"qm{action}", vmid, restart)
+
+    # Guest agent --------------------------------------------------------
+
+    def _agent_vm(self, node, vmid) -> FakeVM:
+        vm = self.cluster.vm(node, vmid)
+        if not self.cluster.agent_ready(vm):
+            raise FakeError(500, "QEMU guest agent is not running")
+        return vm
+
+    def agent_exec(self, params, node, vmid):
+        vm = self._agent_vm(node, vmid)
+        command = params.get("command")
+        command = " ".join(command) if isinstance(command, list) else str(command)
+        script = params.get("input-data", "") if command in ("sh", "bash") else command
+
+        exitcode, out = 0, ""
+        if "test -e /.install_status" in script:
+            exitcode = 1 if vm.live_cd else 0
+        elif "cat /etc/ssh/ssh_host_" in script:
+            out = FAKE_HOST_KEY + "\n"
+        elif "stat -c %s" in script:
+            out = "0\n"
+        markers = STEP_MARKER_RE.findall(script)
+        if markers:
+            out = "".join(f"\n{marker} {index} 0\n" for marker, index in markers)
+
+        self.cluster.next_pid += 1
+        pid = self.cluster.next_pid
+        self.cluster.exec_results[vm.vmid, pid] = {"exited": 1, "exitcode": exitcode, "out-data": out}
+        return {"pid": pid}
+
+    def agent_exec_status(self, params, node, vmid):
+        vm = self._agent_vm(node, vmid)
+        result = self.cluster.exec_results.pop((vm.vmid, int(params["pid"])), None)
+        if result is None:
+            raise FakeError(500, f"Agent error: PID {params['pid']} does not exist")
+        return result
+
+    def agent_file_write(self, params, node, vmid):
+        self._agent_vm(node, vmid)
+        return None
+
+    def agent_ping(self, params, node, vmid):
+        self._agent_vm(node, vmid)
+        return None
+
+    def agent_interfaces(self, params, node, vmid):
+        vm = self._agent_vm(node, vmid)
+        address = ipaddress.IPv4Address("10.99.0.0") + vm.vmid
+        return {"result": [
+            {"name": "lo", "hardware-address": "00:00:00:00:00:00",
+             "ip-addresses": [{"ip-address": "127.0.0.1", "ip-address-type": "ipv4", "prefix": 8}]},
+            {"name": "ens18", "hardware-address": f"bc:24:11:00:{vm.vmid >> 8 & 0xff:02x}:{vm.vmid & 0xff:02x}",
+             "ip-addresses": [{"ip-address": str(address), "ip-address-type": "ipv4", "prefix": 16}]},
+        ]}
+
+
+def self_signed_certificate(directory: str) -> Tuple[str, str]:
+    cert_path = os.path.join(directory, "cert.pem")
+    key_path = os.path.join(directory, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1",
+                    "-nodes", "-days", "1", "-subj", "/CN=fake-pveproxy",
+                    "-keyout", key_path, "-out", cert_path],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert_path, key_path
+
+
+class FakeProxmox:
+    """The fake pveproxy server, listening on an ephemeral localhost port."""
+
+    def __init__(self, nodes: int = 1, *, latency: float = 0.0, **cluster_options):
+        self.cluster = FakeCluster(nodes, **cluster_options)
+        self.api = FakeProxmoxAPI(self.cluster)
+        self.latency = latency
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+        self._tmpdir: Optional[tempfile.TemporaryDirectory] = None
+
+    @property
+    def port(self) -> int:
+        assert self._server is not None
+        return self._server.server_address[1]
+
+    @property
+    def host(self) -> str:
+        """`host:port`, as `serverUrl` expects it."""
+        return f"127.0.0.1:{self.port}"
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _params(self) -> Dict[str, Any]:
+                url = urlsplit(self.path)
+                fields: Dict[str, List[Any]] = dict(parse_qs(url.query, keep_blank_values=True))
+                length = int(self.headers.get("Content-Length") or 0)
+                content_type = self.headers.get("Content-Type", "")
+                if length and content_type.startswith("multipart/form-data"):
+                    # Uploaded files come as (filename, content) pairs.
+                    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+                        f"Content-Type: {content_type}\r\n\r\n".encode() + self.rfile.read(length))
+                    for part in message.iter_parts():
+                        name = str(part.get_param("name", header="content-disposition"))
+                        filename = part.get_filename()
+                        payload = part.get_payload(decode=True)
+                        assert isinstance(payload, bytes)
+                        fields.setdefault(name, []).append(
+                            (filename, payload) if filename else payload.decode())
+                elif length:
+                    body = self.rfile.read(length).decode()
+                    for key, values in parse_qs(body, keep_blank_values=True).items():
+                        fields.setdefault(key, []).extend(values)
+                return {key: values if len(values) > 1 else values[0]
+                        for key, values in fields.items()}
+
+            def _reply(self, status: int, payload: Any, reason: Optional[str] = None):
+                body = json.dumps({"data": payload}).encode()
+                self.send_response(status, reason)
+                self.send_header("Content-Type", "application/json;charset=UTF-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _handle(self, method: str):
+                params = self._params()
+                if fake.latency:
+                    time.sleep(fake.latency)
+                path = re.sub(r"^/api2/json", "", urlsplit(self.path).path).rstrip("/")
+                cookies = SimpleCookie(self.headers.get("Cookie", ""))
+                if "PVEAuthCookie" in cookies:
+                    with fake.cluster.lock:
+                        known = cookies["PVEAuthCookie"].value in fake.cluster.tickets
+                    if not known:
+                        self._reply(401, None, "authentication failure")
+                        return
+                try:
+                    self._reply(200, fake.api.dispatch(method, path, params))
+                except FakeError as e:
+                    self._reply(e.status, None, str(e))
+
+            def do_GET(self):
+                self._handle("GET")
+
+            def do_POST(self):
+                self._handle("POST")
+
+            def do_PUT(self):
+                self._handle("PUT")
+
+            def do_DELETE(self):
+                self._handle("DELETE")
+
+        return Handler
+
+    def start(self) -> "FakeProxmox":
+        self._tmpdir = tempfile.TemporaryDirectory(prefix="fake-pve-")
+        cert, key = self_signed_certificate(self._tmpdir.name)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+
+        class TLSServer(ThreadingHTTPServer):
+            daemon_threads = True
+            request_queue_size = 128
+
+            def get_request(self):
+                sock, address = super().get_request()
+                return context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False), address
+
+        self._server = TLSServer(("127.0.0.1", 0), self._handler())
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name="fake-pveproxy", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self._tmpdir is not None:
+            self._tmpdir.cleanup()
+            self._tmpdir = None
+
+    def __enter__(self) -> "FakeProxmox":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
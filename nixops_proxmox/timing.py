@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+import functools
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+_local = threading.local()
+
+
+class Span:
+    """A timed phase of a machine creation, `path` is `parent/child`."""
+
+    __slots__ = ("path", "start", "duration", "slept", "retries")
+
+    def __init__(self, path: str, start: float):
+        self.path = path
+        self.start = start
+        self.duration = 0.0
+        self.slept = 0.0
+        self.retries = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"path": self.path, "start": round(self.start, 3),
+                "duration": round(self.duration, 3), "slept": round(self.slept, 3),
+                "retries": self.retries}
+
+
+class Timeline:
+    """The spans of one machine, recorded from the thread creating it."""
+
+    def __init__(self, machine: str):
+        self.machine = machine
+        self.spans: List[Span] = []
+        self._stack: List[Span] = []
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[Span]:
+        path = f"{self._stack[-1].path}/{name}" if self._stack else name
+        span = Span(path, time.time())
+        started = time.monotonic()
+        self.spans.append(span)
+        self._stack.append(span)
+        try:
+            yield span
+        finally:
+            span.duration = time.monotonic() - started
+            self._stack.pop()
+
+    def slept(self, seconds: float) -> None:
+        # Accounted in every enclosing span.
+        for span in self._stack:
+            span.slept += seconds
+
+    def retried(self) -> None:
+        if self._stack:
+            self._stack[-1].retries += 1
+
+    def to_json(self) -> List[Dict[str, Any]]:
+        return [span.to_dict() for span in self.spans]
+
+
+@contextmanager
+def recording(timeline: Timeline) -> Iterator[Timeline]:
+    """Record the spans opened by the current thread into `timeline`."""
+    previous = getattr(_local, "timeline", None)
+    _local.timeline = timeline
+    try:
+        yield timeline
+    finally:
+        _local.timeline = previous
+
+
+def current() -> Optional[Timeline]:
+    return getattr(_local, "timeline", None)
+
+
+@contextmanager
+def span(name: str) -> Iterator[Optional[Span]]:
+    """Time a phase of the current timeline, a no-op outside of `recording`."""
+    timeline = current()
+    if timeline is None:
+        yield None
+        return
+    with timeline.span(name) as opened:
+        yield opened
+
+
+def sleep(seconds: float) -> None:
+    time.sleep(seconds)
+    timeline = current()
+    if timeline is not None:
+        timeline.slept(seconds)
+
+
+def retry() -> None:
+    timeline = current()
+    if timeline is not None:
+        timeline.retried()
+
+
+def export_json(timelines: Dict[str, List[Dict[str, Any]]]) -> str:
+    return json.dumps({"machines": timelines}, indent=2, sort_keys=True)
+
+
+def _label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+METRICS = [
+    ("nixops_proxmox_phase_duration_seconds", "duration", "Wall-clock duration of a provisioning phase."),
+    ("nixops_proxmox_phase_sleep_seconds", "slept", "Time spent sleeping or polling in a provisioning phase."),
+    ("nixops_proxmox_phase_retries", "retries", "Retries within a provisioning phase."),
+]
+
+
+def export_prometheus(timelines: Dict[str, List[Dict[str, Any]]],
+                      deployment: Optional[str] = None) -> str:
+    """Prometheus textfile collector format, one sample per machine and phase."""
+    lines = []
+    for metric, field, help_text in METRICS:
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} gauge")
+        for machine, spans in sorted(timelines.items()):
+            for span_dict in spans:
+                labels = [f'machine="{_label(machine)}"', f'phase="{_label(span_dict["path"])}"']
+                if deployment is not None:
+                    labels.insert(0, f'deployment="{_label(str(deployment))}"')
+                lines.append(f"{metric}{{{','.join(labels)}}} {span_dict[field]}")
+    return "\n".join(lines) + "\n"
+
+
+def fleet_summary(timelines: Dict[str, List[Dict[str, Any]]], limit: int = 10) -> str:
+    """Table of the slowest phases across the machines."""
+    per_phase: Dict[str, List[Any]] = defaultdict(list)
+    for machine, spans in timelines.items():
+        for span_dict in spans:
+            per_phase[span_dict["path"]].append((span_dict["duration"], machine, span_dict))
+
+    rows = []
+    for path, entries in per_phase.items():
+        slowest, machine, _ = max(entries, key=lambda entry: entry[0])
+        rows.append((slowest, path, len(entries), sum(e[0] for e in entries),
+                     sum(e[2]["slept"] for e in entries), sum(e[2]["retries"] for e in entries),
+                     machine))
+    rows.sort(reverse=True)
+
+    header = f"{'phase':<40} {'count':>5} {'total':>9} {'max':>8} {'slept':>8} {'retries':>7}  slowest machine"
+    table = [header, "-" * len(header)]
+    for slowest, path, count, total, slept, retries, machine in rows[:limit]:
+        table.append(f"{path:<40} {count:>5} {total:>8.1f}s {slowest:>7.1f}s {slept:>7.1f}s {retries:>7}  {machine}")
+    return "\n".join(table)
+
+
+def write_exports(timelines: Dict[str, List[Dict[str, Any]]],
+                  deployment: Optional[str] = None) -> None:
+    """Write the exports requested through `PROXMOX_TIMINGS_JSON` / `PROXMOX_TIMINGS_TEXTFILE`."""
+    for variable, render in (("PROXMOX_TIMINGS_JSON", lambda: export_json(timelines)),
+                             ("PROXMOX_TIMINGS_TEXTFILE", lambda: export_prometheus(timelines, deployment))):
+        path = os.environ.get(variable)
+        if not path:
+            continue
+        # Atomic, the textfile collector may read it at any time.
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as export:
+            export.write(render())
+        os.replace(tmp, path)
+
+
+def timed(name: str):
+    """Decorator running the function in a span of the current timeline."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import threading
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Set
+
+from nixops_proxmox.proxmox_utils import ConnectionKey
+
+# Proxmox VM identifiers range.
+MIN_VMID = 100
+MAX_VMID = 999999999
+
+
+class VmidAllocator:
+    """
+    Hand out VM identifiers from a leased range.
+
+    `cluster/nextid` returns the same identifier to every concurrent caller,
+    so creating many machines at once used to end in a retry storm. Instead,
+    we lease enough identifiers for every pending creation with one
+    `cluster/nextid` plus one `cluster/resources` call, and then hand them
+    out locally.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._free: Deque[int] = deque()
+        self._handed_out: Set[int] = set()
+        self._taken: Set[int] = set()
+        self.leases = 0
+
+    def _lease(self, api, reserved: Set[int], count: int) -> None:
+        start = max(MIN_VMID, int(api.cluster.nextid.get()))
+        used = {int(res["vmid"]) for res in api.cluster.resources.get(type="vm")}
+        used |= reserved | self._handed_out | self._taken
+
+        candidate = start
+        leased: List[int] = []
+        while len(leased) < count and candidate <= MAX_VMID:
+            if candidate not in used:
+                leased.append(candidate)
+            candidate += 1
+
+        if not leased:
+            raise Exception("There is no free VM id left in the Proxmox cluster")
+
+        self._free.extend(leased)
+        self.leases += 1
+
+    def allocate(self, api, reserved: Iterable[int] = (), count_hint: int = 1) -> int:
+        """
+        Return a VM id, none of `reserved` (identifiers recorded in the
+        deployment state) nor any VM currently known by the cluster.
+
+        `count_hint` is the number of identifiers worth leasing if the
+        current lease is exhausted.
+        """
+        reserved = set(reserved)
+        with self._lock:
+            while True:
+                while self._free:
+                    vmid = self._free.popleft()
+                    if vmid not in reserved and vmid not in self._taken:
+                        self._handed_out.add(vmid)
+                        return vmid
+                self._lease(api, reserved, max(1, count_hint))
+
+    def mark_taken(self, vmid: int) -> None:
+        """Someone else created this VM id behind our back, never hand it out again."""
+        with self._lock:
+            self._taken.add(vmid)
+            self._handed_out.discard(vmid)
+
+
+_allocators_lock = threading.Lock()
+_allocators: Dict[ConnectionKey, VmidAllocator] = {}
+
+
+def allocator_for(key: ConnectionKey) -> VmidAllocator:
+    with _allocators_lock:
+        if key not in _allocators:
+            _allocators[key] = VmidAllocator()
+        return _allocators[key]
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+import base64
+import hashlib
+import os
+import subprocess
+import tempfile
+import unittest
+from types import SimpleNamespace
+from typing import Any, Dict, List
+
+from nixops_proxmox.agent import AgentExecutor, TransferFailed
+
+
+class ShellAgent:
+    """
+    Stub of the guest agent endpoints of a VM, running the commands on this
+    host. Commands are reported as running for `polls` status requests.
+    """
+
+    def __init__(self, polls: int = 1):
+        self.polls = polls
+        self.scripts: List[str] = []
+        self._results: Dict[int, Dict[str, Any]] = {}
+        self._pending: Dict[int, int] = {}
+        self.exec = SimpleNamespace(post=self.run)
+
+    def __call__(self, endpoint: str):
+        assert endpoint == "exec-status"
+        return SimpleNamespace(get=self.status)
+
+    def run(self, command, **params):
+        script = params.get("input-data", "")
+        self.scripts.append(script)
+        done = subprocess.run(command if isinstance(command, list) else [command],
+                              input=script, capture_output=True, text=True)
+        pid = len(self.scripts)
+        self._results[pid] = {"exited": 1, "exitcode": done.returncode,
+                              "out-data": done.stdout, "err-data": done.stderr}
+        self._pending[pid] = self.polls
+        return {"pid": pid}
+
+    def status(self, pid):
+        if self._pending[pid] > 1:
+            self._pending[pid] -= 1
+            return {"exited": 0}
+        return self._results.pop(pid)
+
+
+def executor(agent: ShellAgent) -> AgentExecutor:
+    return AgentExecutor(lambda: SimpleNamespace(agent=agent),
+                         initial_delay=0.001, max_delay=0.01)
+
+
+class RunStepsTest(unittest.TestCase):
+    def test_splits_the_output_per_step(self):
+        results = executor(ShellAgent()).run_steps(["echo one; echo two", "true", "echo three"])
+
+        self.assertEqual([step.exitcode for step in results], [0, 0, 0])
+        self.assertEqual([step.out for step in results], ["one\ntwo\n", "", "three\n"])
+
+    def test_output_without_a_final_newline(self):
+        results = executor(ShellAgent()).run_steps(["printf 'no newline'", "printf 'a\\nb'", "echo last"])
+
+        self.assertEqual([step.out for step in results], ["no newline", "a\nb", "last\n"])
+        self.assertEqual([step.exitcode for step in results], [0, 0, 0])
+
+    def test_marker_text_in_the_output(self):
+        agent = ShellAgent()
+        results = executor(agent).run_steps(["echo x __nixops_step_0 0 1"])
+
+        self.assertEqual(results[0].exitcode, 0)
+        self.assertEqual(results[0].out, "x __nixops_step_0 0 1\n")
+
+    def test_stops_on_the_first_error(self):
+        results = executor(ShellAgent()).run_steps(["echo before", "(exit 3)", "echo after"])
+
+        self.assertEqual([step.exitcode for step in results], [0, 3, None])
+        self.assertEqual(results[2].out, "")
+
+    def test_runs_every_step_when_asked_to(self):
+        results = executor(ShellAgent()).run_steps(["false", "echo after"], stop_on_error=False)
+
+        self.assertEqual([step.exitcode for step in results], [1, 0])
+        self.assertEqual(results[1].out, "after\n")
+
+    def test_single_round_trip(self):
+        agent = ShellAgent(polls=3)
+        executor(agent).run_steps(["true", "true", "true"])
+
+        self.assertEqual(len(agent.scripts), 1)
+
+
+class CorruptingAgent(ShellAgent):
+    """Flips the first byte of every chunk appended to a file."""
+
+    def run(self, command, **params):
+        script = params.get("input-data", "")
+        if script.startswith("base64 -d >>"):
+            head, encoded, tail = script.split("\n", 2)
+            chunk = bytearray(base64.b64decode(encoded))
+            chunk[0] ^= 0xff
+            params["input-data"] = "\n".join([head, base64.b64encode(chunk).decode(), tail])
+        return super().run(command, **params)
+
+
+class WriteFileTest(unittest.TestCase):
+    content = b"0123456789abcdefghij"
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.path = os.path.join(tmpdir.name, "etc", "file")
+
+    def appends(self, agent: ShellAgent) -> int:
+        return sum(script.startswith("base64 -d >>") for script in agent.scripts)
+
+    def read(self, path: str) -> bytes:
+        with open(path, "rb") as f:
+            return f.read()
+
+    def test_writes_the_file(self):
+        agent = ShellAgent()
+        digest = executor(agent).write_file(self.content, self.path, mode="0600", chunk_size=8)
+
+        self.assertEqual(digest, hashlib.sha256(self.content).hexdigest())
+        self.assertEqual(self.read(self.path), self.content)
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+        self.assertFalse(os.path.exists(self.path + ".partial"))
+        self.assertEqual(self.appends(agent), 3)
+
+    def test_resumes_a_partial_file(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path + ".partial", "wb") as f:
+            f.write(self.content[:12])
+        agent = ShellAgent()
+
+        executor(agent).write_file(self.content, self.path, chunk_size=8)
+
+        self.assertEqual(self.read(self.path), self.content)
+        self.assertEqual(self.appends(agent), 1)
+
+    def test_restarts_a_foreign_partial_file(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path + ".partial", "wb") as f:
+            f.write(b"something else")
+        agent = ShellAgent()
+
+        executor(agent).write_file(self.content, self.path, chunk_size=8)
+
+        self.assertEqual(self.read(self.path), self.content)
+        self.assertEqual(self.appends(agent), 3)
+
+    def test_restarts_when_not_resuming(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path + ".partial", "wb") as f:
+            f.write(self.content[:12])
+
+        executor(ShellAgent()).write_file(self.content, self.path, resume=False)
+
+        self.assertEqual(self.read(self.path), self.content)
+
+    def test_checksum_mismatch(self):
+        with self.assertRaises(TransferFailed) as raised:
+            executor(CorruptingAgent()).write_file(self.content, self.path, chunk_size=8)
+
+        self.assertIn("Checksum mismatch", str(raised.exception))
+        self.assertFalse(os.path.exists(self.path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import unittest
+from typing import List
+
+from proxmoxer.core import ResourceException
+
+from nixops_proxmox.async_client import AsyncProxmoxClient, SyncProxmoxClient
+from nixops_proxmox.tasks import TaskFailed
+from nixops_proxmox.testing import FakeProxmox
+from nixops_proxmox.testing.fake_pve import FakeError
+
+
+class AsyncClientTest(unittest.TestCase):
+    def setUp(self):
+        self.pve = FakeProxmox(task_duration=0.05, boot_time=0.2).start()
+        self.addCleanup(self.pve.stop)
+        self.client = SyncProxmoxClient(AsyncProxmoxClient(
+            f"https://{self.pve.host}/api2/json", verify_ssl=False))
+        self.addCleanup(self.client.close)
+
+    def create_vm(self, vmid: int, start: bool) -> None:
+        upid = self.client.post("/nodes/pve1/qemu", vmid=vmid, memory=512, start=int(start))
+        self.client.wait_for_task(upid)
+
+    def test_errors_are_resource_exceptions(self):
+        with self.assertRaises(ResourceException) as raised:
+            self.client.vm_config("pve1", 999)
+        self.assertEqual(raised.exception.status_code, 500)
+        self.assertIn("999.conf' does not exist", str(raised.exception))
+
+    def test_errors_carry_the_reason_phrase(self):
+        with self.assertRaises(ResourceException) as raised:
+            self.client.vm_status("pve1", 999)
+        self.assertEqual(raised.exception.status_message,
+                         "Configuration file 'nodes/pve1/qemu-server/999.conf' does not exist")
+
+    def test_wait_for_agent(self):
+        self.create_vm(100, start=True)
+        self.client.wait_for_agent("pve1", 100, timeout=5)
+        self.assertEqual(self.client.agent_exec("pve1", 100, ["true"]).exitcode, 0)
+
+    def test_wait_for_agent_times_out_while_the_agent_is_down(self):
+        self.create_vm(100, start=False)
+        with self.assertRaises(TimeoutError):
+            self.client.wait_for_agent("pve1", 100, timeout=0.3)
+
+    def test_wait_for_agent_raises_other_errors(self):
+        with self.assertRaises(ResourceException):
+            self.client.wait_for_agent("pve1", 999, timeout=5)
+
+    def test_wait_for_task_with_warnings(self):
+        logged: List[str] = []
+        with self.pve.cluster.lock:
+            upid = self.pve.cluster.task("pve1", "qmstart", 100, warnings=["iothread is ignored"])
+
+        status = self.client.wait_for_task(upid, warn=logged.append)
+
+        self.assertEqual(status["exitstatus"], "WARNINGS: 1")
+        self.assertEqual(status["log"], ["WARN: iothread is ignored"])
+        self.assertEqual(len(logged), 1)
+
+    def test_wait_for_task_failure(self):
+        def fail(at):
+            raise FakeError(500, "start failed: QEMU exited with code 1")
+
+        with self.pve.cluster.lock:
+            upid = self.pve.cluster.task("pve1", "qmstart", 100, action=fail)
+        with self.assertRaises(TaskFailed) as raised:
+            self.client.wait_for_task(upid)
+        self.assertEqual(raised.exception.log, ["TASK start failed: QEMU exited with code 1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
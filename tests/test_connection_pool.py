@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+import unittest
+import warnings
+
+from nixops_proxmox.proxmox_utils import connect, connection_pool
+from nixops_proxmox.testing import FakeProxmox
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        warnings.filterwarnings("ignore", message="Unverified HTTPS request")
+        self.pve = FakeProxmox().start()
+        self.addCleanup(self.pve.stop)
+        connection_pool.clear()
+        self.addCleanup(connection_pool.clear)
+
+    def connect(self):
+        return connect(self.pve.host, "root@pam", password="fake")
+
+    def logins(self) -> int:
+        return self.pve.cluster.calls["POST", "/access/ticket"]
+
+    def test_shares_one_login(self):
+        self.assertIs(self.connect(), self.connect())
+        self.assertEqual(self.logins(), 1)
+
+    def test_renews_a_refused_session(self):
+        api = self.connect()
+        self.pve.cluster.tickets.clear()
+
+        # The request is retried over a new session, which then replaces
+        # the refused one in the pool.
+        self.assertEqual(len(api.nodes.get()), 1)
+        self.assertEqual(self.logins(), 2)
+        renewed = self.connect()
+        self.assertIsNot(renewed, api)
+        self.assertEqual(len(renewed.nodes.get()), 1)
+        self.assertEqual(self.logins(), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import unittest
+from typing import List
+from unittest import mock
+
+import nixops_proxmox.coordinator
+from nixops_proxmox.coordinator import CreateCoordinator
+
+
+class CreateCoordinatorTest(unittest.TestCase):
+    def setUp(self):
+        self.coordinator = CreateCoordinator({"endpoint": 8, "node": 4, "storage": 1, "install": 4})
+        self.logged: List[str] = []
+        self.inside = 0
+        self.most_inside = 0
+
+    def create(self, machine: str, expected=("a", "b")) -> None:
+        self.coordinator.enter(machine, expected)
+        with self.coordinator.phase(machine, "provision", node="pve1", storages=["local-lvm"]):
+            self.inside += 1
+            self.most_inside = max(self.most_inside, self.inside)
+            time.sleep(0.01)
+            self.inside -= 1
+        self.coordinator.leave(machine, self.logged.append)
+
+    def test_reports_once_every_expected_machine_is_done(self):
+        self.create("a")
+        self.assertEqual(self.logged, [])
+
+        self.create("b")
+        self.assertEqual(len(self.logged), 1)
+        self.assertIn("created 2 machine(s)", self.logged[0])
+
+    def test_reports_without_the_machines_which_never_join(self):
+        with mock.patch.object(nixops_proxmox.coordinator, "REPORT_GRACE", 0.05):
+            self.create("a")
+            self.assertEqual(self.logged, [])
+            time.sleep(0.2)
+
+        self.assertEqual(len(self.logged), 1)
+        self.assertIn("created 1 machine(s)", self.logged[0])
+
+    def test_a_late_machine_joins_the_batch(self):
+        with mock.patch.object(nixops_proxmox.coordinator, "REPORT_GRACE", 0.1):
+            self.create("a")
+            self.coordinator.enter("b", ["a", "b"])
+            time.sleep(0.2)
+            self.assertEqual(self.logged, [])
+            self.coordinator.leave("b", self.logged.append)
+
+        self.assertEqual(len(self.logged), 1)
+        self.assertIn("created 1 machine(s)", self.logged[0])
+
+    def test_limits_the_machines_per_storage(self):
+        threads = [threading.Thread(target=self.create, args=(machine, ("a", "b", "c")))
+                   for machine in ("a", "b", "c")]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(self.logged), 1)
+        self.assertIn("created 3 machine(s)", self.logged[0])
+        self.assertEqual(self.most_inside, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
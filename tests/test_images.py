@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+import unittest
+import warnings
+
+from proxmoxer import ProxmoxAPI
+
+from nixops_proxmox.async_client import use_async_session
+from nixops_proxmox.images import ensure_image_uploaded, image_digest, image_volume_name
+from nixops_proxmox.testing import FakeProxmox
+
+
+class UploadImageTest(unittest.TestCase):
+    def setUp(self):
+        warnings.filterwarnings("ignore", message="Unverified HTTPS request")
+        self.pve = FakeProxmox(task_duration=0.05).start()
+        self.addCleanup(self.pve.stop)
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.image = os.path.join(tmpdir.name, "nixos.qcow2")
+        with open(self.image, "wb") as f:
+            f.write(os.urandom(3 * 1024 * 1024 + 17))
+        self.volid = f"local:import/{image_volume_name(image_digest(self.image), 'qcow2')}"
+
+    def api(self) -> ProxmoxAPI:
+        return ProxmoxAPI(self.pve.host, user="root@pam", password="fake", verify_ssl=False)
+
+    def uploads(self) -> int:
+        return self.pve.cluster.calls["POST", "/nodes/{node}/storage/{storage}/upload"]
+
+    def test_uploads_once(self):
+        api = self.api()
+
+        self.assertEqual(ensure_image_uploaded(api, "pve1", "local", self.image, "qcow2"), self.volid)
+        self.assertEqual(ensure_image_uploaded(api, "pve1", "local", self.image, "qcow2"), self.volid)
+
+        self.assertEqual(self.pve.cluster.volumes[self.volid], os.path.getsize(self.image))
+        self.assertEqual(self.uploads(), 1)
+
+    def test_uploads_through_the_async_session(self):
+        api = use_async_session(self.api(), ("upload", self.pve.host))
+
+        self.assertEqual(ensure_image_uploaded(api, "pve1", "local", self.image, "qcow2"), self.volid)
+
+        self.assertEqual(self.pve.cluster.volumes[self.volid], os.path.getsize(self.image))
+        self.assertEqual(self.uploads(), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
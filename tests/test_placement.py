@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import unittest
+from types import SimpleNamespace
+from typing import Any, Dict, List
+
+from nixops_proxmox.placement import DiskRequest, NoEligibleNode, Placer
+
+GIB = 1024 ** 3
+
+
+class StubCluster:
+    """`cluster/resources` of nodes with an LVM-thin and a ZFS storage each."""
+
+    def __init__(self, **free_memory_gib: int):
+        self.resources: List[Dict[str, Any]] = []
+        for node, free in free_memory_gib.items():
+            self.resources.append({"type": "node", "node": node, "status": "online",
+                                   "maxmem": 64 * GIB, "mem": (64 - free) * GIB,
+                                   "maxcpu": 16, "cpu": 0.1})
+            for storage, plugintype in (("local-lvm", "lvmthin"), ("tank", "zfspool")):
+                self.resources.append({"type": "storage", "node": node, "storage": storage,
+                                       "plugintype": plugintype, "status": "available",
+                                       "maxdisk": 100 * GIB, "disk": 0})
+        self.api = SimpleNamespace(cluster=SimpleNamespace(
+            resources=SimpleNamespace(get=lambda: self.resources)))
+
+    def storage(self, node: str, storage: str) -> Dict[str, Any]:
+        return next(res for res in self.resources
+                    if res.get("node") == node and res.get("storage") == storage)
+
+
+class PlacerTest(unittest.TestCase):
+    def setUp(self):
+        self.cluster = StubCluster(pve1=8, pve2=16)
+        self.placer = Placer()
+
+    def place(self, machine: str, memory_gib: int = 4, cores: int = 2, disks=(), **kwargs) -> str:
+        node, _ = self.placer.place(self.cluster.api, machine, memory_mib=memory_gib * 1024,
+                                    cores=cores, disks=disks, **kwargs)
+        return node
+
+    def test_picks_the_node_with_the_most_headroom(self):
+        self.assertEqual(self.place("a"), "pve2")
+
+    def test_reservations_count_until_released(self):
+        self.assertEqual(self.place("a", memory_gib=12), "pve2")
+        # pve2 has 4 GiB left once `a` is accounted for.
+        self.assertEqual(self.place("b", memory_gib=6), "pve1")
+
+        self.placer.release("a")
+
+        self.assertEqual(self.place("c", memory_gib=6), "pve2")
+
+    def test_rules_out_nodes_without_enough_memory(self):
+        self.assertEqual(self.place("a", memory_gib=12), "pve2")
+        with self.assertRaises(NoEligibleNode) as raised:
+            self.place("b", memory_gib=10)
+        self.assertIn("pve1: not enough memory", str(raised.exception))
+        self.assertIn("pve2: not enough memory", str(raised.exception))
+
+    def test_placing_again_replaces_the_reservation(self):
+        self.assertEqual(self.place("a", memory_gib=12), "pve2")
+        self.assertEqual(self.place("a", memory_gib=12), "pve2")
+
+    def test_rules_out_nodes_without_enough_cpus(self):
+        with self.assertRaises(NoEligibleNode) as raised:
+            self.place("a", cores=32)
+        self.assertIn("pve2: only 16 CPUs", str(raised.exception))
+
+    def test_spreads_an_anti_affinity_group(self):
+        self.assertEqual(self.place("a", group="web"), "pve2")
+        self.assertEqual(self.place("b", group="web"), "pve1")
+        # Already placed by a previous deployment.
+        self.assertEqual(self.place("c", group="db", group_members={"d": "pve1"}), "pve2")
+
+    def test_counts_disks_on_their_candidate_storages(self):
+        for node in ("pve1", "pve2"):
+            self.cluster.storage(node, "tank")["disk"] = 90 * GIB
+        self.cluster.storage("pve2", "local-lvm")["disk"] = 90 * GIB
+
+        node = self.place("a", disks=[DiskRequest(20 * GIB, ("local-lvm", "tank"))])
+
+        self.assertEqual(node, "pve1")
+
+    def test_counts_disks_by_storage_type(self):
+        self.cluster.storage("pve2", "tank")["disk"] = 90 * GIB
+
+        self.assertEqual(self.place("a", disks=[DiskRequest(20 * GIB, storage_type="zfspool")]), "pve1")
+        with self.assertRaises(NoEligibleNode) as raised:
+            self.place("b", disks=[DiskRequest(90 * GIB, storage_type="zfspool")])
+        self.assertIn("not enough space on type zfspool", str(raised.exception))
+
+    def test_counts_every_disk_of_the_machine(self):
+        disks = [DiskRequest(60 * GIB, ("local-lvm",)), DiskRequest(60 * GIB, ("local-lvm",))]
+        with self.assertRaises(NoEligibleNode):
+            self.place("a", disks=disks)
+
+        disks[1] = DiskRequest(60 * GIB, ("local-lvm", "tank"))
+        self.assertEqual(self.place("a", disks=disks), "pve2")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import unittest
+from typing import Any, Dict, List
+
+from nixops_proxmox.reconcile import ConfigChange, config_update, diff_config, pending_keys
+
+CURRENT = {
+    "name": "web",
+    "memory": "2048",
+    "cores": "2",
+    "agent": "1",
+    "hotplug": "network,disk",
+    "net0": "virtio=BC:24:11:5E:7A:01,bridge=vmbr0",
+    "ipconfig0": "ip=dhcp",
+    "scsi0": "local-lvm:vm-100-disk-0,size=32G",
+}
+
+
+class DiffConfigTest(unittest.TestCase):
+    def test_nothing_changed(self):
+        wanted = {"name": "web", "memory": 2048, "cores": 2, "agent": "enabled=1",
+                  "hotplug": "disk,network", "net0": "model=virtio,bridge=vmbr0",
+                  "ipconfig0": "ip=dhcp", "description": None}
+
+        changes = diff_config(CURRENT, wanted)
+
+        self.assertEqual(changes, [])
+        self.assertEqual(config_update(changes, CURRENT), {})
+
+    def test_defaults_are_not_changes(self):
+        self.assertEqual(diff_config({}, {"onboot": 0, "protection": "0"}), [])
+
+    def test_hotplug_decides_what_is_live(self):
+        changes = diff_config(CURRENT, {"memory": 4096, "name": "api",
+                                        "net0": "model=virtio,bridge=vmbr1", "ipconfig0": "ip=dhcp"})
+
+        self.assertEqual(changes, [
+            ConfigChange("memory", "2048", "4096", live=False),
+            ConfigChange("name", "web", "api", live=True),
+            ConfigChange("net0", CURRENT["net0"], "model=virtio,bridge=vmbr1", live=True),
+        ])
+
+    def test_unknown_nic_is_removed(self):
+        current = dict(CURRENT, net1="e1000=BC:24:11:5E:7A:02,bridge=vmbr1", ipconfig1="ip=dhcp")
+
+        changes = diff_config(current, {"net0": "model=virtio,bridge=vmbr0"})
+
+        self.assertEqual([(change.key, change.wanted) for change in changes],
+                         [("ipconfig0", None), ("ipconfig1", None), ("net1", None)])
+        self.assertEqual(config_update(changes, current), {"delete": "ipconfig0,ipconfig1,net1"})
+
+
+class ConfigUpdateTest(unittest.TestCase):
+    def test_keeps_the_mac_on_a_bridge_change(self):
+        changes = diff_config(CURRENT, {"net0": "model=virtio,bridge=vmbr1", "ipconfig0": "ip=dhcp"})
+
+        self.assertEqual(config_update(changes, CURRENT),
+                         {"net0": "model=virtio,bridge=vmbr1,macaddr=BC:24:11:5E:7A:01"})
+
+    def test_keeps_the_mac_on_a_tag_change(self):
+        changes = diff_config(CURRENT, {"net0": "model=virtio,bridge=vmbr0,tag=42", "ipconfig0": "ip=dhcp"})
+
+        self.assertEqual(config_update(changes, CURRENT),
+                         {"net0": "model=virtio,bridge=vmbr0,tag=42,macaddr=BC:24:11:5E:7A:01"})
+
+    def test_an_explicit_mac_wins(self):
+        changes = diff_config(CURRENT, {"net0": "virtio=BC:24:11:00:00:01,bridge=vmbr1", "ipconfig0": "ip=dhcp"})
+
+        self.assertEqual(config_update(changes, CURRENT),
+                         {"net0": "virtio=BC:24:11:00:00:01,bridge=vmbr1"})
+
+    def test_new_nic_gets_no_mac(self):
+        changes = diff_config(CURRENT, {"net0": "model=virtio,bridge=vmbr0", "ipconfig0": "ip=dhcp",
+                                        "net1": "model=virtio,bridge=vmbr1"})
+
+        self.assertEqual(config_update(changes, CURRENT), {"net1": "model=virtio,bridge=vmbr1"})
+
+
+class PendingKeysTest(unittest.TestCase):
+    def test_reports_pending_and_deleted_options(self):
+        pending: List[Dict[str, Any]] = [
+            {"key": "name", "value": "web"},
+            {"key": "memory", "value": "2048", "pending": "4096"},
+            {"key": "cores", "pending": "4"},
+            {"key": "net1", "value": "virtio=BC:24:11:5E:7A:02,bridge=vmbr1", "delete": 1},
+            {"key": "ipconfig1", "value": "ip=dhcp", "delete": 0},
+        ]
+
+        self.assertEqual(pending_keys(pending), ["cores", "memory", "net1"])
+
+    def test_nothing_pending(self):
+        self.assertEqual(pending_keys([{"key": "name", "value": "web"}]), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+import threading
+import unittest
+from types import SimpleNamespace
+from typing import Any, Dict, List
+from unittest import mock
+
+import nixops_proxmox.storage
+from nixops_proxmox.storage import BenchmarkCache, NoEligibleStorage, StorageSelector
+
+GIB = 1024 ** 3
+
+
+class StubNode:
+    """The storage listing of a node, and the cluster status giving its address."""
+
+    def __init__(self):
+        self.storages: List[Dict[str, Any]] = [
+            {"storage": "local", "type": "dir", "content": "iso,vztmpl,images", "active": 1, "avail": 50 * GIB},
+            {"storage": "local-lvm", "type": "lvmthin", "content": "images,rootdir", "active": 1, "avail": 100 * GIB},
+            {"storage": "tank", "type": "zfspool", "content": "images,rootdir", "active": 1, "avail": 80 * GIB},
+            {"storage": "ceph", "type": "rbd", "content": "images", "active": 1, "avail": 500 * GIB},
+            {"storage": "backup", "type": "nfs", "content": "backup", "active": 1, "avail": 900 * GIB},
+            {"storage": "offline", "type": "lvmthin", "content": "images", "active": 0, "avail": 900 * GIB},
+        ]
+        storage = SimpleNamespace(get=lambda enabled: self.storages)
+        self.api = SimpleNamespace(
+            nodes=lambda node: SimpleNamespace(storage=storage),
+            cluster=SimpleNamespace(status=SimpleNamespace(
+                get=lambda: [{"type": "node", "name": "pve1", "ip": "192.0.2.1"}])))
+
+
+class StorageSelectorTest(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.benchmarks = BenchmarkCache(os.path.join(tmpdir.name, "benchmarks.json"))
+        self.selector = StorageSelector(self.benchmarks)
+        self.node = StubNode()
+        self.speeds = {"local": 300.0, "local-lvm": 200.0, "tank": 900.0}
+        benchmark = mock.patch.object(nixops_proxmox.storage, "benchmark_storage",
+                                      side_effect=lambda address, storage, storage_type: self.speeds[storage])
+        self.benchmark = benchmark.start()
+        self.addCleanup(benchmark.stop)
+
+    def select(self, size_gib: int = 10, **kwargs) -> str:
+        storage, _ = self.selector.select(self.node.api, "pve1", size_gib * GIB, **kwargs)
+        return storage
+
+    def test_most_free_space(self):
+        self.assertEqual(self.select(), "ceph")
+        self.assertEqual(self.select(candidates=["local", "local-lvm", "backup", "offline"]), "local-lvm")
+
+    def test_storage_type(self):
+        self.assertEqual(self.select(storage_type="zfspool"), "tank")
+
+    def test_reserves_the_picked_space(self):
+        picks = [self.select(40, candidates=["local-lvm", "tank"]) for _ in range(4)]
+
+        self.assertEqual(picks, ["local-lvm", "tank", "local-lvm", "tank"])
+        with self.assertRaises(NoEligibleStorage):
+            self.select(40, candidates=["local-lvm", "tank"])
+
+    def test_prefers_the_image_storage(self):
+        self.assertEqual(self.select(prefer="local", benchmark=True), "local")
+        self.benchmark.assert_not_called()
+
+    def test_fastest_storage(self):
+        self.assertEqual(self.select(candidates=["local", "local-lvm", "tank"], benchmark=True), "tank")
+        self.assertEqual(self.select(candidates=["local", "local-lvm"], benchmark=True), "local")
+
+        # Measured once per storage, then cached.
+        self.assertEqual(self.benchmark.call_count, 3)
+        self.assertEqual(self.benchmarks.get("pve1", "tank"), 900.0)
+        self.benchmark.assert_any_call("192.0.2.1", "local", "dir")
+
+    def test_pathless_storages_are_not_benchmarked(self):
+        self.assertEqual(self.select(candidates=["ceph", "local-lvm"], benchmark=True), "local-lvm")
+        self.assertEqual(self.benchmark.call_count, 1)
+
+    def test_failed_benchmarks_fall_back_to_free_space(self):
+        self.benchmark.side_effect = Exception("ssh: connect to host 192.0.2.1 port 22: Connection refused")
+        self.assertEqual(self.select(candidates=["local", "tank"], benchmark=True), "tank")
+
+    def test_other_selections_go_on_during_a_benchmark(self):
+        benchmarking = threading.Event()
+        done = threading.Event()
+
+        def slow_benchmark(address, storage, storage_type):
+            benchmarking.set()
+            done.wait(5)
+            return self.speeds[storage]
+
+        self.benchmark.side_effect = slow_benchmark
+        thread = threading.Thread(target=self.select, kwargs={"candidates": ["local", "tank"], "benchmark": True})
+        thread.start()
+        try:
+            self.assertTrue(benchmarking.wait(5))
+            self.assertEqual(self.select(), "ceph")
+        finally:
+            done.set()
+            thread.join()
+
+
+class BenchmarkStorageTest(unittest.TestCase):
+    def run_benchmark(self, storage: str, storage_type: str) -> str:
+        with mock.patch("subprocess.check_output",
+                        return_value="268435456 bytes (268 MB, 256 MiB) copied, 0.5 s, 537 MB/s\n") as ssh:
+            self.assertEqual(nixops_proxmox.storage.benchmark_storage("192.0.2.1", storage, storage_type), 512)
+        return ssh.call_args.kwargs["input"]
+
+    def test_names_the_scratch_volume(self):
+        script = self.run_benchmark("local-lvm", "lvmthin")
+        self.assertIn("pvesm alloc local-lvm 999999999 vm-999999999-disk-bench 256M", script)
+
+    def test_file_storages_get_a_format_extension(self):
+        script = self.run_benchmark("local", "dir")
+        self.assertIn("pvesm alloc local 999999999 vm-999999999-disk-bench.raw 256M", script)
+
+    def test_pathless_storage(self):
+        with self.assertRaises(Exception):
+            nixops_proxmox.storage.benchmark_storage("192.0.2.1", "ceph", "rbd")
+
+
+if __name__ == "__main__":
+    unittest.main()
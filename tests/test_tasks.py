@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import unittest
+import warnings
+from typing import List
+
+from proxmoxer import ProxmoxAPI
+
+from nixops_proxmox.tasks import TaskFailed, TaskTimeout, wait_for_task, wait_for_tasks
+from nixops_proxmox.testing import FakeProxmox
+from nixops_proxmox.testing.fake_pve import FakeError
+
+
+class WaitForTaskTest(unittest.TestCase):
+    def setUp(self):
+        warnings.filterwarnings("ignore", message="Unverified HTTPS request")
+        self.pve = FakeProxmox(task_duration=0.05).start()
+        self.addCleanup(self.pve.stop)
+        self.api = ProxmoxAPI(self.pve.host, user="root@pam", password="fake",
+                              verify_ssl=False)
+
+    def task(self, **kwargs) -> str:
+        with self.pve.cluster.lock:
+            return self.pve.cluster.task("pve1", "qmcreate", 100, **kwargs)
+
+    def test_succeeds(self):
+        upid = self.task()
+        status = wait_for_tasks(self.api, [upid])[upid]
+        self.assertEqual(status["exitstatus"], "OK")
+
+    def test_succeeds_with_warnings(self):
+        logged: List[str] = []
+        upid = self.task(warnings=["volume 'local-lvm:vm-100-disk-0' is over-provisioned"])
+
+        status = wait_for_tasks(self.api, [upid], warn=logged.append)[upid]
+
+        self.assertEqual(status["exitstatus"], "WARNINGS: 1")
+        self.assertEqual(status["log"], ["WARN: volume 'local-lvm:vm-100-disk-0' is over-provisioned"])
+        self.assertEqual(len(logged), 1)
+        self.assertIn("over-provisioned", logged[0])
+
+    def test_raises_on_failure(self):
+        def fail(at):
+            raise FakeError(500, "storage 'local-lvm' is full")
+
+        with self.assertRaises(TaskFailed) as raised:
+            wait_for_task(self.api, self.task(action=fail))
+        self.assertEqual(raised.exception.exitstatus, "storage 'local-lvm' is full")
+
+    def test_times_out(self):
+        self.pve.cluster.task_duration = 60
+        with self.assertRaises(TaskTimeout):
+            wait_for_task(self.api, self.task(), timeout=0.2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+import unittest
+import warnings
+from unittest import mock
+
+from nixops_proxmox.proxmox_utils import TicketCache, _open_connection
+from nixops_proxmox.testing import FakeProxmox
+
+
+class CachedTicketTest(unittest.TestCase):
+    def setUp(self):
+        warnings.filterwarnings("ignore", message="Unverified HTTPS request")
+        self.pve = FakeProxmox().start()
+        self.addCleanup(self.pve.stop)
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        environ = mock.patch.dict(os.environ, {
+            "PROXMOX_TICKET_CACHE_FILE": os.path.join(tmpdir.name, "tickets")})
+        environ.start()
+        self.addCleanup(environ.stop)
+
+    def connect(self):
+        return _open_connection(self.pve.host, "root@pam", password="fake",
+                                ticket_cache_key="default")
+
+    def logins(self) -> int:
+        return self.pve.cluster.calls["POST", "/access/ticket"]
+
+    def test_resumes_the_cached_ticket(self):
+        first = self.connect()
+        resumed = self.connect()
+
+        self.assertEqual(self.logins(), 1)
+        self.assertEqual(resumed.authenticated_at, first.authenticated_at)
+        # Requests of the resumed session carry the cached ticket.
+        self.assertEqual(len(resumed.api.nodes.get()), 1)
+        self.assertTrue(resumed.api.nodes("pve1").qemu.post(vmid=100, memory=512).startswith("UPID:"))
+
+    def test_logs_in_again_when_the_ticket_is_refused(self):
+        self.connect()
+        self.pve.cluster.tickets.clear()
+
+        conn = self.connect()
+
+        self.assertEqual(self.logins(), 2)
+        self.assertEqual(len(conn.api.nodes.get()), 1)
+        cached = TicketCache().load("default", self.pve.host, "root@pam")
+        assert cached is not None
+        self.assertIn(cached.ticket, self.pve.cluster.tickets)
+
+
+if __name__ == "__main__":
+    unittest.main()
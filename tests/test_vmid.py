@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import unittest
+from types import SimpleNamespace
+from typing import Iterable
+
+from nixops_proxmox.vmid import MAX_VMID, VmidAllocator
+
+
+class StubCluster:
+    """The `cluster` endpoints of a cluster whose `nextid` ignores pending creations."""
+
+    def __init__(self, vmids: Iterable[int] = ()):
+        self.vmids = set(vmids)
+        self.start = 100
+        self.nextid = SimpleNamespace(get=self.next_id)
+        self.resources = SimpleNamespace(get=self.vms)
+
+    def next_id(self) -> str:
+        vmid = self.start
+        while vmid in self.vmids:
+            vmid += 1
+        return str(vmid)
+
+    def vms(self, type: str):
+        assert type == "vm"
+        return [{"vmid": vmid, "type": "qemu"} for vmid in sorted(self.vmids)]
+
+
+class VmidAllocatorTest(unittest.TestCase):
+    def setUp(self):
+        self.cluster = StubCluster({100, 102})
+        self.api = SimpleNamespace(cluster=self.cluster)
+        self.allocator = VmidAllocator()
+
+    def test_leases_for_every_pending_creation(self):
+        vmids = [self.allocator.allocate(self.api, count_hint=3) for _ in range(3)]
+
+        self.assertEqual(vmids, [101, 103, 104])
+        self.assertEqual(self.allocator.leases, 1)
+
+    def test_skips_identifiers_handed_out_in_this_process(self):
+        # The VMs are not created yet, so `nextid` returns 101 every time.
+        vmids = [self.allocator.allocate(self.api) for _ in range(3)]
+
+        self.assertEqual(vmids, [101, 103, 104])
+        self.assertEqual(self.allocator.leases, 3)
+
+    def test_skips_reserved_identifiers(self):
+        vmid = self.allocator.allocate(self.api, reserved=[101, 103])
+
+        self.assertEqual(vmid, 104)
+
+    def test_retries_after_a_collision(self):
+        first = self.allocator.allocate(self.api, count_hint=3)
+        # Someone else created the next leased identifier behind our back.
+        self.cluster.vmids.add(103)
+        self.allocator.mark_taken(103)
+
+        second = self.allocator.allocate(self.api)
+        third = self.allocator.allocate(self.api)
+
+        self.assertEqual((first, second, third), (101, 104, 105))
+        self.assertEqual(self.allocator.leases, 2)
+
+    def test_a_taken_identifier_is_never_handed_out_again(self):
+        vmid = self.allocator.allocate(self.api)
+        self.allocator.mark_taken(vmid)
+        # The creation failed and the cluster forgot the VM again.
+        self.assertNotEqual(self.allocator.allocate(self.api), vmid)
+
+    def test_no_identifier_left(self):
+        self.cluster.start = MAX_VMID
+        self.cluster.vmids.add(MAX_VMID)
+
+        with self.assertRaises(Exception) as raised:
+            self.allocator.allocate(self.api)
+        self.assertIn("no free VM id left", str(raised.exception))
+
+
+if __name__ == "__main__":
+    unittest.main()